@@ -1,4 +1,8 @@
-import string, cherrypy, os, sys, argparse, time, sys
+import string, cherrypy, os, sys, argparse, time, sys, json, heapq, threading, zlib, collections, bisect, signal
+import radioTelemetry
+from stateStore import StateStore
+from sampling import RingBuffer
+from archive import Archive, KIND_STATE, KIND_ANALOG, KIND_VCC, KIND_NAMES, VCC_PIN
 
 # Auxiliary functions
 def dbgPrint(msg):
@@ -8,6 +12,10 @@ def dbgPrint(msg):
 def enum(**enums):
     return type('Enum', (), enums)
 
+def gzipText(text):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(text) + compressor.flush()
+
 
 '''==============================================================
    Section 1 - classes defining behavior of the structure 
@@ -20,11 +28,376 @@ PinTypes = enum(momentary_switch='momentary_switch', toggle_switch='toggle_switc
 # This is an ID of the control hub, this numbe will be sent as a first byt in all communication packets to edge devices
 CONTROL_HUB_ID = 1
 
+# Highest edge device id, the id is added to the last byte of its radio addresses (see
+# radioComm.readingAddress) which must not overflow
+MAX_DEVICE_ID = 0x1F
+
+# Width of a momentary switch pulse (sec) on edge devices which time it themselves, about what
+# three separate writes give on a quiet link. Queued in radioQueue in place of a bit, PULSE
+# stands for the whole 0-1-0 pulse
+PULSE_WIDTH = 0.1
+PULSE = "pulse"
+
+# Parse "HH:MM" schedule time into (hour, minute), '---' means not scheduled.
+# Raises ValueError if text is neither
+def parseScheduleTime(text):
+  if (text == '---'):
+    return None
+  (hour, minute) = map(int, text.split(":"))
+  if (not (0 <= hour < 24 and 0 <= minute < 60)):
+    raise ValueError("Invalid time " + text)
+  return (hour, minute)
+
+# Timestamp of the first hour:minute local time later than timestamp 'after'
+def nextFireTime(hourMinute, after):
+  (hour, minute) = hourMinute
+  tm = time.localtime(after)
+  for day in range(3):
+    # mktime normalizes day overflow, -1 lets it figure out daylight saving time
+    fireAt = time.mktime((tm.tm_year, tm.tm_mon, tm.tm_mday + day, hour, minute, 0, 0, 0, -1))
+    if (fireAt > after):
+      return fireAt
+
+# Read device registry from a JSON file:
+#  {"name": "<hub name>", "devices": [{"id": 3, "name": "...", "radioPolicy": {...},
+#    "pins": [{"id": 2, "type": "momentary_switch", "startTime": "21:30", "endTime": "22:00"}, ...],
+#    "sampling": {"interval": 60, "vcc": true}}, ...]}
+# radioPolicy, sampling, startTime and endTime are optional. sampling turns on polling of analog_input
+# pins (id of A0 is 14) and Vcc if vcc is true, every 'interval' seconds. Returns the registry with 
+# defaults filled in, raises ValueError if it's not valid
+def readRegistry(path):
+  with open(path) as registryFile:
+    registry = json.load(registryFile)
+  deviceIds = set()
+  for device in registry["devices"]:
+    if (not 0 < device["id"] <= MAX_DEVICE_ID or device["id"] in deviceIds):
+      raise ValueError("Invalid or duplicate device id %s" % device["id"])
+    deviceIds.add(device["id"])
+    device.setdefault("radioPolicy", None)
+    sampling = device.setdefault("sampling", None)
+    if sampling is not None:
+      sampling.setdefault("interval", 60)
+      sampling.setdefault("vcc", False)
+      if (not sampling["interval"] > 0):
+        raise ValueError("Invalid sampling interval of device %d" % device["id"])
+    pinIds = set()
+    for pin in device["pins"]:
+      if (pin["id"] in pinIds):
+        raise ValueError("Duplicate pin %d of device %d" % (pin["id"], device["id"]))
+      pinIds.add(pin["id"])
+      if (not hasattr(PinTypes, pin["type"])):
+        raise ValueError("Unknown type %s of pin %d of device %d" % (pin["type"], pin["id"], device["id"]))
+      pin.setdefault("startTime", "---")
+      pin.setdefault("endTime", "---")
+      parseScheduleTime(pin["startTime"])
+      parseScheduleTime(pin["endTime"])
+  return registry
+
+# Keeps the next automatic turn on and turn off of every scheduled pin in a heap ordered by 
+# time, so every tick only looks at pins which are due. When the schedule of a pin changes
+# its version grows and its old heap entries are dropped as they come up
+class PinScheduler:
+  # Longest sleep between checks, guards against jumps of the system clock 
+  # (Raspberry has no RTC, its clock is set over the network after boot)
+  MAX_SLEEP = 60
+
+  def __init__(self):
+    self.events = []    # (fireAt, sequence, pin, state, (hour, minute), pin schedule version)
+    self.sequence = 0
+    self.condition = threading.Condition()
+    self.running = True
+
+  def push(self, fireAt, pin, state, hourMinute):
+    self.sequence += 1
+    heapq.heappush(self.events, (fireAt, self.sequence, pin, state, hourMinute, pin.scheduleVersion))
+
+  # Index startTime/endTime of a pin, called when the pin is added and whenever its times change
+  def schedulePin(self, pin, now=None):
+    if now is None:
+      now = time.time()
+    start = parseScheduleTime(pin.startTime)
+    end = parseScheduleTime(pin.endTime)
+    with self.condition:
+      pin.scheduleVersion += 1
+      if (start and end):
+        self.push(nextFireTime(start, now), pin, 1, start)
+        self.push(nextFireTime(end, now), pin, 0, end)
+      self.condition.notify()
+
+  # Forget scheduled events of a pin, e.g. when it's removed
+  def unschedulePin(self, pin):
+    with self.condition:
+      pin.scheduleVersion += 1
+
+  # Pop all events due at 'now' and schedule their next occurrence. Events missed because 
+  # a tick came late are caught up, if several events of one pin are due, the latest wins.
+  # Returns list of (fireAt, pin, state) ordered by time
+  def popDue(self, now):
+    due = {}
+    with self.condition:
+      while self.events and self.events[0][0] <= now:
+        (fireAt, sequence, pin, state, hourMinute, version) = heapq.heappop(self.events)
+        if (version != pin.scheduleVersion):
+          continue
+        due[pin] = (fireAt, pin, state)
+        self.push(nextFireTime(hourMinute, now), pin, state, hourMinute)
+    return sorted(due.values(), key=lambda event: event[0])
+
+  # Turn on/off pins whose time has come
+  def runDue(self, now=None):
+    if now is None:
+      now = time.time()
+    for (fireAt, pin, state) in self.popDue(now):
+      if (pin.state != state):
+        dbgPrint("refreshing state of pin %d of device %d to %d (due %s)" % \
+                 (pin.id, pin.deviceId, state, time.strftime("%H:%M", time.localtime(fireAt))))
+        pin.setState(state, PRIORITY_SCHEDULED)
+
+  # Run due events until stop() is called, sleeping until the next event is due
+  def run(self):
+    while self.running:
+      self.runDue()
+      with self.condition:
+        delay = self.MAX_SLEEP
+        if self.events:
+          delay = min(delay, self.events[0][0] - time.time())
+        if (delay > 0 and self.running):
+          self.condition.wait(delay)
+
+  def stop(self):
+    with self.condition:
+      self.running = False
+      self.condition.notify()
+
+# Checks in the background that edge devices really have the pin states the hub shows.
+# Reads all pins of one device at a time (0xA3), going round the devices, but only when the
+# radio has been idle for QUIET seconds and at most 'budget' reads per minute. A toggle switch
+# which differs (e.g. the edge device rebooted) gets its state sent again. Momentary switches 
+# are not checked, their pins are back at 0 after every pulse
+class StateReconciler:
+  QUIET = 1.0
+  # (counter in stats, metric name, help text) for the metrics page
+  COUNTERS = [("reads", "reconcile_reads_total", "State reads sent to the device"),
+              ("failedReads", "reconcile_failed_reads_total", "State reads the device didn't answer"),
+              ("mismatches", "reconcile_mismatches_total", "Pins found in a state different from the hub's")]
+
+  def __init__(self, hub, budget):
+    self.hub = hub
+    self.interval = 60.0 / budget
+    self.nextDevice = 0
+    self.stats = {}   # device id -> {"reads": ..., "failedReads": ..., "mismatches": ...}
+    self.sweeps = 0   # times all devices were checked
+    self.condition = threading.Condition()
+    self.running = True
+    self.thread = threading.Thread(target=self.run, name="StateReconciler")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def run(self):
+    while self.running:
+      with self.condition:
+        self.condition.wait(self.interval)
+      if (self.running and transceiver.waitIdle(self.QUIET, self.interval)):
+        device = self.pickDevice()
+        if device:
+          self.check(device)
+
+  # Next device with toggle switches, round robin
+  def pickDevice(self):
+    devices = [device for device in list(self.hub.edgeDevices) \
+               if any(pin.type == PinTypes.toggle_switch for pin in device.getPins())]
+    if not devices:
+      return None
+    if (self.nextDevice >= len(devices)):
+      self.nextDevice = 0
+      self.sweeps += 1
+    device = devices[self.nextDevice]
+    self.nextDevice += 1
+    return device
+
+  # Read pins of the device and reconcile its toggle switches, one try only: a lost read
+  # is repeated on the next sweep rather than taking more airtime now
+  def check(self, device):
+    pins = [pin for pin in device.getPins() if pin.type == PinTypes.toggle_switch]
+    sentBefore = dict((pin, pin.radioFuture) for pin in pins)
+    future = transceiver.readPins(device.id, sender_id=CONTROL_HUB_ID, attempts=1)
+    response = future.result()
+    stats = self.stats.setdefault(device.id, {"reads": 0, "failedReads": 0, "mismatches": 0})
+    stats["reads"] += 1
+    if response is None:
+      stats["failedReads"] += 1
+      return
+    values = future.command.values(response)
+    for pin in pins:
+      if pin.reconcile(values.get(pin.id), sentBefore[pin]):
+        stats["mismatches"] += 1
+
+  def stop(self):
+    with self.condition:
+      self.running = False
+      self.condition.notify()
+
+  def getInfo(self):
+    return {"sweeps": self.sweeps, "devices": dict((str(deviceId), dict(stats)) for deviceId, stats in self.stats.items())}
+
+  def showAsPrometheus(self):
+    lines = []
+    for name, metric, text in self.COUNTERS:
+      lines.append("# HELP %s %s" % (metric, text))
+      lines.append("# TYPE %s counter" % metric)
+      for deviceId, stats in sorted(self.stats.items()):
+        lines.append('%s{device="%s"} %d' % (metric, deviceId, stats[name]))
+    return "\n".join(lines) + "\n"
+
+# Polls analog input pins (0xA5) and Vcc (0xA7, mV) of edge devices which have sampling
+# in the registry and keeps the values in a RingBuffer per channel, so memory stays the
+# same however long the hub runs. A channel is (device id, pin id) or (device id, "vcc").
+# Reads are sent with background priority and only MAX_IN_FLIGHT at a time, so however
+# many channels there are a switching command waits for one exchange at most
+class Sampler:
+  SAMPLES = 1440        # samples kept per channel, a day of samples taken every minute
+  MAX_IN_FLIGHT = 1
+  # Longest sleep between checks for changed devices
+  MAX_SLEEP = 10
+
+  def __init__(self, hub):
+    self.hub = hub
+    self.channels = {}    # channel -> RingBuffer
+    self.intervals = {}   # channel -> sampling interval (sec)
+    self.nextAt = {}      # channel -> time of the next read
+    self.due = []         # heap of (time, sequence, channel)
+    self.sequence = 0
+    self.inFlight = 0
+    self.failed = 0
+    self.hubVersion = None
+    self.condition = threading.Condition()
+    self.running = True
+    self.thread = threading.Thread(target=self.run, name="Sampler")
+    self.thread.daemon = True
+    self.thread.start()
+
+  # Bring channels in line with the hub's devices, called with condition held
+  def sync(self, now):
+    wanted = {}
+    for device in list(self.hub.edgeDevices):
+      if not device.sampling:
+        continue
+      if device.sampling["vcc"]:
+        wanted[(device.id, "vcc")] = device.sampling["interval"]
+      for pin in device.getPins():
+        if (pin.type == PinTypes.analog_input):
+          wanted[(device.id, pin.id)] = device.sampling["interval"]
+    for channel in list(self.channels):
+      if channel not in wanted:
+        del self.channels[channel]
+        del self.intervals[channel]
+        del self.nextAt[channel]
+    for channel, interval in wanted.items():
+      if channel not in self.channels:
+        self.channels[channel] = RingBuffer(self.SAMPLES)
+        self.push(channel, now)
+      self.intervals[channel] = interval
+
+  def push(self, channel, at):
+    self.sequence += 1
+    self.nextAt[channel] = at
+    heapq.heappush(self.due, (at, self.sequence, channel))
+
+  def run(self):
+    while self.running:
+      with self.condition:
+        now = time.time()
+        if (self.hub.version != self.hubVersion):
+          self.hubVersion = self.hub.version
+          self.sync(now)
+        delay = self.MAX_SLEEP
+        if (self.due and self.inFlight < self.MAX_IN_FLIGHT):
+          delay = min(delay, self.due[0][0] - now)
+        if (delay > 0):
+          self.condition.wait(delay)
+          continue
+        (dueAt, sequence, channel) = heapq.heappop(self.due)
+        # Entries of removed channels and of channels added again are dropped
+        if (self.nextAt.get(channel) != dueAt):
+          continue
+        # A read which came late doesn't make the next ones come sooner
+        self.push(channel, max(dueAt + self.intervals[channel], now))
+        self.inFlight += 1
+      self.measure(channel)
+
+  def measure(self, channel):
+    (deviceId, pinId) = channel
+    if (pinId == "vcc"):
+      future = transceiver.measure(deviceId, 0xA7, sender_id=CONTROL_HUB_ID, attempts=2)
+    else:
+      future = transceiver.measure(deviceId, 0xA5, pinId, sender_id=CONTROL_HUB_ID, attempts=2)
+    future.addDoneCallback(lambda future: self.sampled(channel, future))
+
+  # Called by the radio transceiver thread
+  def sampled(self, channel, future):
+    with self.condition:
+      self.inFlight -= 1
+      buffer = self.channels.get(channel)
+      if future.response is None:
+        self.failed += 1
+      elif buffer is not None:
+        value = future.command.value(future.response)
+        buffer.append(time.time(), value)
+        if (channel[1] == "vcc"):
+          self.hub.archiveCommand(VCC_PIN, KIND_VCC, value, future)
+        else:
+          self.hub.archiveCommand(channel[1], KIND_ANALOG, value, future)
+      self.condition.notify()
+
+  def stop(self):
+    with self.condition:
+      self.running = False
+      self.condition.notify()
+
+  # Aggregates of channels over the last 'window' seconds, of one device if deviceId is given.
+  # With raw the samples of the window are included as [time, value] pairs
+  def getData(self, deviceId=None, window=3600, raw=False):
+    since = time.time() - window
+    with self.condition:
+      channels = sorted(self.channels.items())
+    data = []
+    for channel, buffer in channels:
+      if (deviceId is not None and channel[0] != deviceId):
+        continue
+      entry = {"deviceId": channel[0], "channel": channel[1], "interval": self.intervals.get(channel), \
+               "aggregate": buffer.aggregate(since)}
+      if raw:
+        entry["samples"] = buffer.samples(since)
+      data.append(entry)
+    return {"window": window, "failedReads": self.failed, "channels": data}
+
 # Instance of ControlHub contains a list of edge device objects
+# version grows with every change of pin state or configuration, the rendered main 
+# page is cached until it changes. Recent changes are logged, so web clients can ask
+# for pins changed since the version they have seen
 class ControlHub:
+  # Number of changes kept in the log, clients further behind get all pins
+  CHANGE_LOG_SIZE = 256
+
   def __init__(self,name):
     self.name = name
     self.edgeDevices=[]
+    self.devicesById = {}
+    self.registryPath = None
+    self.store = None
+    self.scheduler = PinScheduler()
+    self.reconciler = None
+    self.sampler = None
+    self.archive = None
+    # Set once radioComm is loaded, commands can be queued to the transceiver from then on
+    self.radioReady = False
+    self.version = 0
+    self.changes = collections.deque(maxlen=self.CHANGE_LOG_SIZE)  # (version, changed pin or None)
+    self.changeCondition = threading.Condition()
+    # Pages of different runs of the hub must not share ETags
+    self.etagPrefix = "%x" % int(time.time())
+    self.page = None
+    self.pageLock = threading.Lock()
 
   def __repr__(self):
     text = self.name
@@ -34,23 +407,161 @@ class ControlHub:
 
   def addEdgeDevice(self,device):
     self.edgeDevices.append(device)
+    self.devicesById[device.id] = device
+    device.hub = self
+    for pin in device.getPins():
+      self.attachPin(pin)
+    self.changed()
+
+  def removeEdgeDevice(self, deviceId):
+    device = self.devicesById.pop(deviceId)
+    self.edgeDevices.remove(device)
+    for pin in device.getPins():
+      self.scheduler.unschedulePin(pin)
+    self.changed()
+
+  # Make a pin of our device known to the hub, restore its saved state and schedule it
+  def attachPin(self, pin):
+    pin.hub = self
+    pin.scheduler = self.scheduler
+    if self.store:
+      self.restorePin(pin)
+    self.scheduler.schedulePin(pin)
+
+  # Keep pin states and schedules in a StateStore, restoring the saved ones. Saved schedules
+  # win over the registry, so changes made in the web interface survive a restart
+  def attachStore(self, store):
+    store.load()
+    self.store = store
+    for device in self.edgeDevices:
+      for pin in device.getPins():
+        self.restorePin(pin)
+        self.scheduler.schedulePin(pin)
+        self.recordPin(pin)
+
+  def restorePin(self, pin):
+    row = self.store.get(pin.deviceId, pin.id)
+    if row:
+      pin.restore(row)
+
+  # Archive the outcome of a command sent to an edge device: value, attempts and time it took
+  def archiveCommand(self, pinId, kind, value, future):
+    if (self.archive and not future.command.superseded):
+      self.archive.append(future.command.receiver_id, pinId, kind, value, future.attempts, \
+                          time.time() - future.submittedAt)
+
+  # Save pin state and schedule, the store writes it in the background
+  def recordPin(self, pin):
+    if self.store:
+      self.store.record(pin.deviceId, pin.id, {"state": pin.state, "startTime": pin.startTime, "endTime": pin.endTime})
+
+  # Load devices and pins from registry file, see readRegistry
+  def loadRegistry(self, path):
+    registry = readRegistry(path)
+    self.registryPath = path
+    self.name = registry.get("name", self.name)
+    return self.applyRegistry(registry["devices"])
+
+  # Load the registry file again, applying only what changed. If the file is not valid
+  # the current configuration stays
+  def reloadRegistry(self):
+    try:
+      changes = self.loadRegistry(self.registryPath)
+      dbgPrint("Reloaded %s: %s" % (self.registryPath, changes))
+      return changes
+    except (IOError, ValueError, KeyError, TypeError) as e:
+      dbgPrint("Can't reload %s, keeping current devices: %s" % (self.registryPath, e))
+
+  # Bring devices and pins in line with device entries of a registry: add and remove devices,
+  # update the ones which differ. Returns {"added": [...], "removed": [...], "changed": [...]} device ids
+  def applyRegistry(self, devices):
+    changes = {"added": [], "removed": [], "changed": []}
+    wantedIds = set(device["id"] for device in devices)
+    for device in list(self.edgeDevices):
+      if device.id not in wantedIds:
+        self.removeEdgeDevice(device.id)
+        changes["removed"].append(device.id)
+    for spec in devices:
+      pins = [(pin["id"], pin["type"], pin["startTime"], pin["endTime"]) for pin in spec["pins"]]
+      device = self.devicesById.get(spec["id"])
+      if device is None:
+        self.addEdgeDevice(EdgeDevice(spec["id"], spec["name"], pins, spec["radioPolicy"], spec["sampling"]))
+        changes["added"].append(spec["id"])
+      elif device.update(spec["name"], pins, spec["radioPolicy"], spec["sampling"]):
+        changes["changed"].append(spec["id"])
+    if (changes["removed"] or changes["changed"]):
+      self.changed()
+    return changes
+
+  # Called whenever something shown on the main page changes, pin is None if it's not 
+  # just one pin
+  def changed(self, pin=None):
+    with self.changeCondition:
+      self.version += 1
+      self.changes.append((self.version, pin))
+      self.changeCondition.notifyAll()
+
+  # Wait up to timeout sec for a version newer than 'since'. Returns (version, pins changed 
+  # since then), pins is None if the change log doesn't tell, i.e. all pins should be reloaded
+  def waitForChanges(self, since, timeout):
+    with self.changeCondition:
+      if (self.version <= since):
+        self.changeCondition.wait(timeout)
+      version = self.version
+      if (version <= since):
+        return (version, [])
+      if (not self.changes or self.changes[0][0] > since + 1 or since > version):
+        return (version, None)
+      pins = []
+      for (changeVersion, pin) in self.changes:
+        if (changeVersion <= since):
+          continue
+        if pin is None:
+          return (version, None)
+        if pin not in pins:
+          pins.append(pin)
+      return (version, pins)
+
+  # All devices and pins as a JSON friendly structure
+  def getData(self):
+    return {"name": self.name, "version": self.version, "devices": [device.getData() for device in self.edgeDevices]}
+
+  # Return (etag, html, gzipped html) of the main page, rendered again only if 
+  # something changed since the last time
+  def getPage(self):
+    with self.pageLock:
+      version = self.version
+      if self.page is None or self.page[0] != version:
+        html = '''<html> <meta http-equiv="refresh" content="10" />''' + self.showAsHtml() + "</html>"
+        # Names loaded from the registry are unicode
+        if isinstance(html, unicode):
+          html = html.encode("utf-8")
+        self.page = (version, '"%s-%d"' % (self.etagPrefix, version), html, gzipText(html))
+      return self.page[1:]
 
   # Return edge device object  by its id
   def getEdgeDevice(self,id):
-    for device in self.edgeDevices:
-      if device.id == id:
-        return device
+    device = self.devicesById.get(id)
+    if device is not None:
+      return device
 
     dbgPrint('''Error, can't find device %d in  %s''' % (id, self.name))
 
+  # Turn on/off pins whose startTime/endTime has come
   def refreshPinState(self):
-    for device in self.edgeDevices:
-      device.refreshPinState()
+    self.scheduler.runDue()
+
+  # Check which edge devices respond with one broadcast ping (0xA1), followed by unicast
+  # pings to devices which didn't reply to it. Return ids of devices which didn't reply at all
+  def pingEdgeDevices(self):
+    deviceIds = [device.id for device in self.edgeDevices]
+    (acked, followedUp, failed) = broadcastWithFollowUp(CONTROL_HUB_ID, 0xA1, 0, 0, deviceIds)
+    dbgPrint("Ping: devices %s replied to broadcast, %s to unicast, %s didn't reply" % (acked, followedUp, failed))
+    return failed
   # This function starts forming the main web page (table with device and pin status)
-  # refresh meta tag insures periodic refresh of the web page, which means that showAsHtml function 
-  # gets periodically executed
-  # This is necessary for automatic launch of  device.refreshPinState() function, which 
-  # checks if it's time to automatically turn the switch on or off
+  # refresh meta tag insures periodic refresh of the web page. Pins are switched at their
+  # time by the scheduler, rendering the page doesn't touch the radio.
+  # Timestamp on the page is the time of the last change
   def showAsHtml(self):
     tm = time.localtime()
     timeStamp = time.strftime("%d %b %Y %H:%M:%S", tm)
@@ -60,9 +571,6 @@ class ControlHub:
       <table border=1>''' % self.name
 
     for device in self.edgeDevices:
-      # For all pins of all edge devices compare current with startTime and
-      # endTime and set status to 1 or 0 correspondingly
-      device.refreshPinState()
       text += "\n " + device.showAsHtml()
     text += '''
       </table>
@@ -73,11 +581,23 @@ class ControlHub:
 
 # Each instance of this class controls one edge device with few pin switches which can be set to either 0 or 1 
 # pin can control optocoupler, relay or led. Every edge device must have unique ID 
-class EdgeDevice:
-  def __init__(self,deviceId,deviceName,pins):
+# radioPolicy optionally overrides retry policy of the radio link to the device, it's a dictionary 
+# with any of attempts, initialTimeout, minTimeout, maxTimeout, maxPause (see radioComm.RadioLink.POLICY)
+# Pins are kept sorted by id, pins of a device share one lock for their radio state
+class EdgeDevice(object):
+  __slots__ = ("name", "id", "pins", "pinIds", "pinList", "radioPolicy", "sampling", "radioCondition", "hub")
+
+  def __init__(self,deviceId,deviceName,pins,radioPolicy=None,sampling=None):
     self.name = deviceName
     self.id = deviceId
     self.pins = {}
+    self.pinIds = []
+    self.pinList = []
+    self.radioPolicy = radioPolicy
+    # {"interval": sec, "vcc": True|False} if analog pins and Vcc are polled by the Sampler
+    self.sampling = sampling
+    self.radioCondition = threading.Condition()
+    self.hub = None
     
     # Initialize pin objects belonging to this edge device
     # passed var pins is a list of tuples, each consists of 4 parms:
@@ -85,30 +605,74 @@ class EdgeDevice:
       (pinId, pinType, startTime, endTime) = pin
 
       # class var 'pins' is a dictionary whose keys are pinId's and values are Pin objects
-      self.pins[pinId] = Pin(deviceId, pinId, pinType, startTime, endTime)
+      self.addPin(Pin(deviceId, pinId, pinType, startTime, endTime, self.radioCondition))
+
+  def addPin(self, pin):
+    index = bisect.bisect_left(self.pinIds, pin.id)
+    self.pinIds.insert(index, pin.id)
+    self.pinList.insert(index, pin)
+    self.pins[pin.id] = pin
+    if self.hub:
+      self.hub.attachPin(pin)
+
+  def removePin(self, pinId):
+    pin = self.pins.pop(pinId)
+    index = bisect.bisect_left(self.pinIds, pinId)
+    del self.pinIds[index]
+    del self.pinList[index]
+    if self.hub:
+      self.hub.scheduler.unschedulePin(pin)
+
+  # Apply name, pins (list of (pinId, pinType, startTime, endTime) tuples), radio policy and
+  # sampling from the registry, return True if anything changed
+  def update(self, deviceName, pins, radioPolicy, sampling=None):
+    changed = False
+    if (deviceName != self.name or radioPolicy != self.radioPolicy or sampling != self.sampling):
+      self.name = deviceName
+      self.radioPolicy = radioPolicy
+      self.sampling = sampling
+      changed = True
+    wanted = dict((pin[0], pin) for pin in pins)
+    for pinId in list(self.pinIds):
+      if pinId not in wanted:
+        self.removePin(pinId)
+        changed = True
+    for (pinId, pinType, startTime, endTime) in pins:
+      pin = self.pins.get(pinId)
+      if pin is None:
+        self.addPin(Pin(self.id, pinId, pinType, startTime, endTime, self.radioCondition))
+        changed = True
+        continue
+      if (pin.type != pinType):
+        pin.type = pinType
+        changed = True
+      if (pin.startTime != startTime or pin.endTime != endTime):
+        pin.setSchedule(startTime, endTime)
+        changed = True
+    return changed
 
   # Get a hash of name-value parameters from configureEdgeDevice web form 
   # and store this parms as appropriate member vars of the edge device
   # object and its pin objects
   def configure(self,parmHash):
+    # New start/end times by pin id, each pin is re-scheduled once
+    times = {}
     for key, value in parmHash.iteritems():
       if (key=="deviceId"):
         continue
       (pinId, parmName) = key.split(":")
       pinId = int(pinId)
       pin = self.pins[pinId]
-      if (parmName == "startTime"):
-        pin.startTime = value
-      elif (parmName=="endTime"):
-        pin.endTime = value
+      if (parmName == "startTime" or parmName == "endTime"):
+        times.setdefault(pinId, {})[parmName] = value
       elif (parmName=="state"):
-        pin.setState(int(value))
-
-  # Update pin state i.e automatically turn on/off if time is right
-  def refreshPinState(self):
-    for pinId in sorted(self.pins.keys()):
+        pin.setState(int(value), PRIORITY_INTERACTIVE)
+    for pinId, pinTimes in times.items():
       pin = self.pins[pinId]
-      pin.refreshPinState()
+      try:
+        pin.setSchedule(pinTimes.get("startTime", pin.startTime), pinTimes.get("endTime", pin.endTime))
+      except ValueError as e:
+        dbgPrint("Ignoring schedule of pin %d: %s" % (pinId, e))
 
   def __repr__(self):
     return getInfo(self)
@@ -116,16 +680,17 @@ class EdgeDevice:
   # Print textual information about this edge device
   def getInfo(self):
     text = " device name=" + self.name + " id=" + str(self.id) 
-    for pinId in sorted(self.pins.keys()):
-      text += "\n  " + self.pins[pinId].getInfo()  
+    for pin in self.pinList:
+      text += "\n  " + pin.getInfo()  
     return text
 
-  # Return all pin objects which belong to this device
+  # Return all pin objects which belong to this device, sorted by id
   def getPins(self):
-    pins = []
-    for pinId in sorted(self.pins.keys()):
-      pins.append(self.pins[pinId])
-    return pins
+    return list(self.pinList)
+
+  # Device and its pins as a JSON friendly structure
+  def getData(self):
+    return {"id": self.id, "name": self.name, "pins": [pin.getData() for pin in self.pinList]}
 
   # This prints a portion of main HTML table describing the info of this edge device and status of all its pins
   def showAsHtml(self):
@@ -139,8 +704,7 @@ class EdgeDevice:
         <td colspan="5" bgcolor="cyan"> %s (id=%d) %s</td> 
       </tr>''' % (self.name,self.id,configure_btn)
     text += "<tr><td>pin id</td> <td>pin type</td> <td>pin state</td> <td>Turn on at</td> <td>Turn off at</td></tr>"
-    for pinId in sorted(self.pins.keys()):
-      pin = self.pins[pinId]
+    for pin in self.pinList:
       text += pin.showAsHtml()
     return text
 
@@ -152,8 +716,7 @@ class EdgeDevice:
       <form method="post" action="submitEdgeDeviceConfig">''' % (self.name, self.id)
 
     # Print configuration web form sections for each pin
-    for pinId in sorted(self.pins.keys()):
-      pin = self.pins[pinId]
+    for pin in self.pinList:
       text += pin.showConfigDialog()
 
     # Finish web form configuring edge device with Submit button
@@ -172,8 +735,12 @@ class EdgeDevice:
 # One pin on the edge device:
 # Edge device pin can be of the following types:
 #  momentary_switch, toggle_switch, digital_input, analog_input
-class Pin:
-  def __init__(self, deviceId, pinId, pinType, startTime, endTime):
+# radioCondition guards the radio state of the pin, it's usually shared by all pins of the device
+class Pin(object):
+  __slots__ = ("deviceId", "id", "type", "state", "startTime", "endTime", "hub", "scheduler", "scheduleVersion", \
+               "radioQueue", "radioFuture", "radioStatus", "radioFailed", "radioCondition")
+
+  def __init__(self, deviceId, pinId, pinType, startTime, endTime, radioCondition=None):
     self.deviceId = deviceId
     self.id = pinId
     self.type = pinType
@@ -181,9 +748,60 @@ class Pin:
     # Time for automatic turn/on turn off
     self.startTime = startTime
     self.endTime = endTime
+    # Hub the pin belongs to, its PinScheduler and version of the pin's schedule in it
+    self.hub = None
+    self.scheduler = None
+    self.scheduleVersion = 0
+    # Values are sent to the edge device through the radio transceiver. radioFuture is 
+    # the latest value sent, radioStatus is "pending" until it's done, then "ok" or 
+    # "failed" if the edge device didn't confirm some value. radioQueue holds the rest
+    # of a momentary switch pulse
+    self.radioQueue = []
+    self.radioFuture = None
+    self.radioStatus = "ok"
+    self.radioFailed = False
+    self.radioCondition = radioCondition or threading.Condition()
+
+  # Change time for automatic turn on/off, "HH:MM" or '---'. Raises ValueError for other times
+  def setSchedule(self, startTime, endTime):
+    if (startTime == self.startTime and endTime == self.endTime):
+      return
+    parseScheduleTime(startTime)
+    parseScheduleTime(endTime)
+    self.startTime = startTime
+    self.endTime = endTime
+    if self.scheduler:
+      self.scheduler.schedulePin(self)
+    if self.hub:
+      self.hub.recordPin(self)
+    self.changed()
+
+  # Take over state and schedule saved before a restart. The state of a toggle switch
+  # is sent to the edge device again, which may have lost it while the hub was down
+  def restore(self, row):
+    try:
+      parseScheduleTime(row.get("startTime", self.startTime))
+      parseScheduleTime(row.get("endTime", self.endTime))
+      self.startTime = row.get("startTime", self.startTime)
+      self.endTime = row.get("endTime", self.endTime)
+    except ValueError:
+      dbgPrint("Ignoring saved schedule of pin %d of device %d: %s" % (self.id, self.deviceId, row))
+    state = row.get("state", self.state)
+    if (self.type == PinTypes.toggle_switch and state and self.hub and self.hub.radioReady):
+      self.setState(state, PRIORITY_BACKGROUND)
+    else:
+      self.state = state
+    self.changed()
+
+  # Let the hub know that the pin's row of the main page changed
+  def changed(self):
+    if self.hub:
+      self.hub.changed(self)
  
-  # For output pin - set pin state and send signal to edge device
-  def setState(self, pinValue):
+  # For output pin - set pin state and queue signal to edge device. Returns right away,
+  # the signal is sent by the radio transceiver thread, see radioStatus
+  # priority is one of radioComm PRIORITY_*, None means interactive
+  def setState(self, pinValue, priority=None):
     # Reject attempt to set value for input pin
     if (not (self.type==PinTypes.momentary_switch or PinTypes.toggle_switch)):
       dbgPrint("Can't set value to a pin " + pinId + " which is not an output switch") 
@@ -196,45 +814,109 @@ class Pin:
 
     dbgPrint("Switching pin %d %d->%d" % (self.id, self.state, pinValue))
 
-    # For toggle switch, simply send signal to edge device resulting in 
-    # setting its physical out pin with id identical to self.id to a specified value
-    if (self.type == PinTypes.toggle_switch):
-      sendMessageWithConfirm(CONTROL_HUB_ID,self.deviceId,0xA4,self.id,pinValue)
-    elif (self.type == PinTypes.momentary_switch):
-      for bit in [0,1,0]:
-        sendMessageWithConfirm(CONTROL_HUB_ID,self.deviceId,0xA4,self.id,bit)
-    # Remember the state value
-    self.state = pinValue
-    # Let the receiving edge device time to process the packet before sending something new
-    time.sleep(0.2)
-
-  # Update pin state depending on current time
-  def refreshPinState(self):
-    tm = time.localtime()
-    #timeStamp = time.strftime("%d %b %Y %H:%M:%S", tm)
+    if priority is None:
+      priority = PRIORITY_INTERACTIVE
+    with self.radioCondition:
+      # Remember the state value
+      self.state = pinValue
+      if self.hub:
+        self.hub.recordPin(self)
+      if (self.radioStatus != "pending"):
+        self.radioFailed = False
+      self.radioStatus = "pending"
+      self.changed()
+      # For toggle switch, simply send signal to edge device resulting in 
+      # setting its physical out pin with id identical to self.id to a specified value.
+      # Only the latest value matters, a value the transceiver hasn't sent yet is replaced
+      if (self.type == PinTypes.toggle_switch):
+        self.send(pinValue, priority, (self.deviceId, self.id))
+      # Momentary switch gets a 0-1-0 pulse. The transceiver sends it as one command to
+      # edge devices which support it, others get its values in order, each one after the
+      # edge device confirmed the previous one (see radioComm.PulseCommand)
+      elif (self.type == PinTypes.momentary_switch):
+        if self.radioQueue or (self.radioFuture and not self.radioFuture.done()):
+          self.radioQueue.append((PULSE, priority))
+        else:
+          self.send(PULSE, priority)
 
-    if ((self.startTime == '---') or (self.endTime == '---')):
-      return
+  # Send value (or PULSE) to the edge device, called with radioCondition held
+  def send(self, bit, priority, key=None):
+    if (bit == PULSE):
+      future = transceiver.pulse(self.deviceId, self.id, PULSE_WIDTH, sender_id=CONTROL_HUB_ID, priority=priority)
+    else:
+      future = transceiver.send(self.deviceId, 0xA4, self.id, bit, sender_id=CONTROL_HUB_ID, priority=priority, key=key)
+    self.radioFuture = future
+    future.addDoneCallback(self.sent)
+
+  # Called by the radio transceiver thread when a value was sent (or failed)
+  def sent(self, future):
+    pulse = isinstance(future.command, PulseCommand)
+    if self.hub:
+      for value in (future.command.values() if pulse else [future.command.msb_byte]):
+        self.hub.archiveCommand(self.id, KIND_STATE, value, future)
+    with self.radioCondition:
+      if future.response is None:
+        if pulse:
+          dbgPrint("Edge device %d didn't confirm pulse of pin %d" % (self.deviceId, self.id))
+        else:
+          dbgPrint("Edge device %d didn't confirm pin %d value %d" % (self.deviceId, self.id, future.command.msb_byte))
+        self.radioFailed = True
+      if (future is not self.radioFuture):
+        return
+      if self.radioQueue:
+        (bit, priority) = self.radioQueue.pop(0)
+        self.send(bit, priority)
+        return
+      self.radioStatus = "failed" if self.radioFailed else "ok"
+      self.changed()
+      self.radioCondition.notifyAll()
+
+  # Compare state with the value read from the edge device and send the state again if they
+  # differ. radioFuture is the latest value sent when the read was queued, if another one
+  # was sent since then the read may predate it and is ignored. Returns True if they differed
+  def reconcile(self, value, radioFuture):
+    with self.radioCondition:
+      if (value is None or value == self.state or self.radioStatus == "pending" or self.radioFuture is not radioFuture):
+        return False
+      dbgPrint("Pin %d of device %d is %d instead of %d, sending it again" % (self.id, self.deviceId, value, self.state))
+      self.radioFailed = False
+      self.radioStatus = "pending"
+      self.changed()
+      self.send(self.state, PRIORITY_BACKGROUND, (self.deviceId, self.id))
+      return True
 
-    (startHr, startMin) = map(int,self.startTime.split(":"))
-    (endHr, endMin) = map(int,self.endTime.split(":"))
-    if (tm.tm_hour==startHr and tm.tm_min == startMin and self.state == 0):
-      dbgPrint("refreshing state of pin %d of device %d to 1" % (self.id, self.deviceId))
-      self.setState(1)
-    elif (tm.tm_hour==endHr and tm.tm_min == endMin and self.state == 1):
-      dbgPrint("refreshing state of pin %d of device %d to 0" % (self.id, self.deviceId))
-      self.setState(0)
+  # Wait until all queued values are sent, return False if timeout (sec) expired first
+  def waitForRadio(self, timeout=None):
+    deadline = None if timeout is None else time.time() + timeout
+    with self.radioCondition:
+      while (self.radioStatus == "pending"):
+        if deadline is None:
+          self.radioCondition.wait()
+        elif deadline <= time.time():
+          return False
+        else:
+          self.radioCondition.wait(deadline - time.time())
+    return True
 
   # Return info (name, state) about this pin object in gets format
   def __repr__(self):
     return getInfo(self)
 
+  # Pin as a JSON friendly structure
+  def getData(self):
+    return {"deviceId": self.deviceId, "id": self.id, "type": self.type, "state": self.state, \
+            "radioStatus": self.radioStatus, "startTime": self.startTime, "endTime": self.endTime}
+
   def getInfo(self):
-    return "device " + str(self.deviceId) + " pin " + str(self.id) + " type=" + self.type + " state=" + str(self.state)
+    return "device " + str(self.deviceId) + " pin " + str(self.id) + " type=" + self.type + " state=" + str(self.state) + " radio=" + self.radioStatus
 
-  # Show table html representation for the web server
+  # Show table html representation for the web server, state is marked while the edge
+  # device hasn't confirmed it yet or failed to
   def showAsHtml(self):
-    return "\n   <tr><td>%d</td> <td>%s</td> <td>%d</td> <td>%s</td> <td>%s</td>" % (self.id, self.type, self.state, self.startTime, self.endTime)  
+    state = str(self.state)
+    if (self.radioStatus != "ok"):
+      state += " (%s)" % self.radioStatus
+    return "\n   <tr><td>%d</td> <td>%s</td> <td>%s</td> <td>%s</td> <td>%s</td>" % (self.id, self.type, state, self.startTime, self.endTime)  
 
   # Display pin configuration dialog web form
   def showConfigDialog(self): 
@@ -265,7 +947,226 @@ class Pin:
 ================================================================
     Section 2 - web interface 
 ==============================================================='''
+# Send a page with given ETag: 304 Not Modified if the browser has it already, 
+# the gzipped version if the browser accepts it
+def sendCached(etag, text, gzipped):
+  request = cherrypy.request
+  response = cherrypy.response
+  response.headers['ETag'] = etag
+  response.headers['Cache-Control'] = 'no-cache'
+  response.headers['Vary'] = 'Accept-Encoding'
+  if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(",")]:
+    response.status = 304
+    return ""
+  if 'gzip' in request.headers.get('Accept-Encoding', ''):
+    response.headers['Content-Encoding'] = 'gzip'
+    return gzipped
+  return text
+
+# Main page: loads all devices from api/devices, then applies changes pushed by api/events
+LIVE_PAGE = '''<html>
+<head>
+  <title>Switch control hub</title>
+  <style> td { border: solid thin; text-align: center; } </style>
+</head>
+<body>
+  <h2 id="name"></h2>
+  <table border=1 id="devices"></table>
+  <div><br><span id="status">connecting...</span> <a href="table">page without javascript</a></div>
+<script>
+var rows = {};
+function cell(row, text) {
+  var td = row.insertCell(-1);
+  td.textContent = text;
+  return td;
+}
+function post(pin, parms) {
+  var request = new XMLHttpRequest();
+  request.open("POST", "api/pin");
+  request.setRequestHeader("Content-Type", "application/x-www-form-urlencoded");
+  request.send("device_id=" + pin.deviceId + "&pin_id=" + pin.id + "&" + parms);
+}
+function showDevices(hub) {
+  var table = document.getElementById("devices");
+  document.getElementById("name").textContent = hub.name;
+  table.innerHTML = "";
+  rows = {};
+  hub.devices.forEach(function(device) {
+    var td = cell(table.insertRow(-1), device.name + " (id=" + device.id + ") ");
+    td.colSpan = 5;
+    td.bgColor = "cyan";
+    var link = document.createElement("a");
+    link.href = "configureEdgeDevice?device_id=" + device.id;
+    link.textContent = "Configure";
+    td.appendChild(link);
+    var header = table.insertRow(-1);
+    ["pin id", "pin type", "pin state", "Turn on at", "Turn off at"].forEach(function(text) { cell(header, text); });
+    device.pins.forEach(function(pin) {
+      rows[pin.deviceId + ":" + pin.id] = table.insertRow(-1);
+      showPin(pin);
+    });
+  });
+}
+function showPin(pin) {
+  var row = rows[pin.deviceId + ":" + pin.id];
+  if (!row) return;
+  while (row.cells.length) row.deleteCell(0);
+  cell(row, pin.id);
+  cell(row, pin.type);
+  var state = cell(row, pin.state + (pin.radioStatus != "ok" ? " (" + pin.radioStatus + ") " : " "));
+  var button = document.createElement("button");
+  button.textContent = pin.state ? "Turn off" : "Turn on";
+  button.onclick = function() { post(pin, "state=" + (pin.state ? 0 : 1)); };
+  state.appendChild(button);
+  cell(row, pin.startTime);
+  cell(row, pin.endTime);
+}
+var events = new EventSource("api/events");
+events.addEventListener("devices", function(event) { showDevices(JSON.parse(event.data)); });
+events.addEventListener("pins", function(event) { JSON.parse(event.data).forEach(showPin); });
+events.onopen = function() { document.getElementById("status").textContent = "live"; };
+events.onerror = function() { document.getElementById("status").textContent = "reconnecting..."; };
+</script>
+</body>
+</html>'''
+LIVE_PAGE_GZIPPED = gzipText(LIVE_PAGE)
+
+# JSON API of the hub, mounted at /api
+#  GET  /api/devices                  - all devices and their pins
+#  GET  /api/pin?device_id=3&pin_id=2 - one pin
+#  POST /api/pin with device_id, pin_id and any of state, startTime, endTime - change a pin
+#  GET  /api/events                   - server-sent events: first "devices" with all devices,
+#       then "pins" with the pins changed since the previous event. Event ids are hub versions,
+#       a client reconnecting with Last-Event-ID gets only what it missed
+class ApiServer(object):
+  # Seconds between heartbeats of an idle event stream, lets CherryPy notice clients which went away
+  HEARTBEAT = 15
+
+  def sendJson(self, data):
+    cherrypy.response.headers['Content-Type'] = 'application/json'
+    return json.dumps(data, sort_keys=True)
+
+  def getPin(self, device_id, pin_id):
+    device = myHub.getEdgeDevice(int(device_id))
+    if (device is None or int(pin_id) not in device.pins):
+      raise cherrypy.HTTPError(404, "No pin %s of device %s" % (pin_id, device_id))
+    return device.pins[int(pin_id)]
+
+  @cherrypy.expose
+  def devices(self):
+    return self.sendJson(myHub.getData())
+
+  @cherrypy.expose
+  def pin(self, device_id, pin_id, state=None, startTime=None, endTime=None):
+    pin = self.getPin(device_id, pin_id)
+    if (cherrypy.request.method == "POST"):
+      if (startTime is not None or endTime is not None):
+        try:
+          pin.setSchedule(startTime or pin.startTime, endTime or pin.endTime)
+        except ValueError:
+          raise cherrypy.HTTPError(400, "Time must be HH:MM or ---")
+      if (state is not None):
+        if (state not in ("0", "1")):
+          raise cherrypy.HTTPError(400, "State must be 0 or 1")
+        pin.setState(int(state), PRIORITY_INTERACTIVE)
+    return self.sendJson(pin.getData())
+
+  # Statistics of the state reconciler, null if it's not running
+  @cherrypy.expose
+  def reconciler(self):
+    return self.sendJson(myHub.reconciler and myHub.reconciler.getInfo())
+
+  # Min/max/mean/rate of change of sampled analog pins and Vcc over the last 'window' seconds,
+  # with raw=1 the samples too
+  @cherrypy.expose
+  def samples(self, device_id=None, window="3600", raw=None):
+    if myHub.sampler is None:
+      return self.sendJson(None)
+    try:
+      deviceId = None if device_id is None else int(device_id)
+      window = float(window)
+    except ValueError:
+      raise cherrypy.HTTPError(400, "device_id and window must be numbers")
+    return self.sendJson(myHub.sampler.getData(deviceId, window, raw == "1"))
+
+  # Parse query arguments of the archive: ids, kind name and time range (unix time). Without
+  # a range the last 'days' days are taken, starting at local midnight
+  def archiveQuery(self, device_id, pin_id, kind, start, end, days="1"):
+    if myHub.archive is None:
+      raise cherrypy.HTTPError(404, "No archive")
+    if (kind is not None and kind not in KIND_NAMES):
+      raise cherrypy.HTTPError(400, "kind must be one of %s" % ", ".join(sorted(KIND_NAMES)))
+    try:
+      deviceId = None if device_id is None else int(device_id)
+      pinId = None if pin_id is None else int(pin_id)
+      end = time.time() if end is None else float(end)
+      if start is None:
+        day = time.localtime(end)
+        start = time.mktime((day.tm_year, day.tm_mon, day.tm_mday - int(days) + 1, 0, 0, 0, 0, 0, -1))
+      return (deviceId, pinId, KIND_NAMES.get(kind), float(start), end)
+    except ValueError:
+      raise cherrypy.HTTPError(400, "Ids and times must be numbers")
+
+  # Archived pin transitions and samples, the newest 'limit' records of the range
+  @cherrypy.expose
+  def history(self, device_id=None, pin_id=None, kind=None, start=None, end=None, limit="1000"):
+    (deviceId, pinId, kind, start, end) = self.archiveQuery(device_id, pin_id, kind, start, end)
+    if not limit.isdigit():
+      raise cherrypy.HTTPError(400, "limit must be a number")
+    return self.sendJson(myHub.archive.records(start, end, deviceId, pinId, kind, int(limit)))
+
+  # Archive aggregated into buckets of 'step' seconds (a day by default): seconds on for 
+  # kind=state (the default), count/min/max/mean for samples (kind=analog or vcc)
+  @cherrypy.expose
+  def aggregate(self, device_id, pin_id=None, kind="state", start=None, end=None, step="86400", days="7"):
+    if (kind == "vcc"):
+      pin_id = VCC_PIN
+    elif pin_id is None:
+      raise cherrypy.HTTPError(400, "pin_id is required")
+    (deviceId, pinId, kindId, start, end) = self.archiveQuery(device_id, pin_id, kind, start, end, days)
+    try:
+      if (kindId == KIND_STATE):
+        buckets = [{"start": bucketStart, "on": on} for (bucketStart, on) in \
+                   myHub.archive.onTime(start, end, float(step), deviceId, pinId)]
+      else:
+        buckets = [{"start": bucketStart, "count": count, "min": minimum, "max": maximum, "mean": mean} for \
+                   (bucketStart, count, minimum, maximum, mean) in \
+                   myHub.archive.downsample(start, end, float(step), deviceId, pinId, kindId)]
+    except ValueError as e:
+      raise cherrypy.HTTPError(400, str(e))
+    return self.sendJson(buckets)
+
+  @cherrypy.expose
+  def events(self):
+    cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+    cherrypy.response.headers['Cache-Control'] = 'no-cache'
+    # Resume from the version the client has seen, unless it saw another run of the hub
+    since = None
+    (prefix, sep, version) = cherrypy.request.headers.get('Last-Event-ID', '').partition("-")
+    if (prefix == myHub.etagPrefix and version.isdigit() and int(version) <= myHub.version):
+      since = int(version)
+
+    def event(name, version, data):
+      return "id: %s-%d\nevent: %s\ndata: %s\n\n" % (myHub.etagPrefix, version, name, json.dumps(data, sort_keys=True))
+
+    def stream(since):
+      if since is None:
+        since = myHub.version
+        yield event("devices", since, myHub.getData())
+      while True:
+        (version, pins) = myHub.waitForChanges(since, self.HEARTBEAT)
+        if (version == since):
+          yield ": heartbeat\n\n"
+        elif pins is None:
+          yield event("devices", version, myHub.getData())
+        else:
+          yield event("pins", version, [pin.getData() for pin in pins])
+        since = version
+    return stream(since)
+  events._cp_config = {'response.stream': True}
+
 class MainServer(object):
+  api = ApiServer()
 
   def __init__(self):
     print "MainServer initialized"
@@ -275,11 +1176,20 @@ class MainServer(object):
     }'''
 
  
-  # This is the entry point to the web interface
-  # force refresh of the main page every 10 sec
+  # This is the entry point to the web interface: a static page which loads the
+  # devices from the JSON API and keeps them up to date with its event stream
   @cherrypy.expose
   def index(self):
-    return '''<html> <meta http-equiv="refresh" content="10" />''' + myHub.showAsHtml() + "</html>"
+    return sendCached('"live-%s"' % myHub.etagPrefix, LIVE_PAGE, LIVE_PAGE_GZIPPED)
+
+  # Main page rendered on the server, for browsers without javascript
+  # force refresh of the main page every 10 sec
+  # The page is served from the hub's cache. Browsers revalidate it with its ETag and get 
+  # 304 Not Modified while nothing changed
+  @cherrypy.expose
+  def table(self):
+    (etag, html, gzipped) = myHub.getPage()
+    return sendCached(etag, html, gzipped)
 
   # This function calls edge device dialog web form
   # Notice that parameter name must be device_id to match showAsHtml function of EdgeDevice Class
@@ -303,7 +1213,7 @@ deviceId = 3
 
     # Extract device id, get correspondent edge device object and 
     # pass all the parameters collected from configureEdgeDevice form to edge device
-    # configure function. Then simply return to the main page
+    # configure function. Then simply redirect to the main page
     for key, value in kwargs.iteritems():
       if (key=="deviceId"):
         # deviceId value of -1 indicates that user clicked on Cancel button
@@ -314,7 +1224,22 @@ deviceId = 3
           myEdgeDevice.configure(kwargs)
       
     # Go back to main page
-    return "<html>" + myHub.showAsHtml() + "</html>"
+    raise cherrypy.HTTPRedirect("/")
+
+  # Radio link statistics of all edge devices in Prometheus text format
+  @cherrypy.expose
+  def metrics(self):
+    cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    text = radioTelemetry.telemetry.showAsPrometheus()
+    if myHub.reconciler:
+      text += myHub.reconciler.showAsPrometheus()
+    return text
+
+  # The same statistics as JSON, by device id
+  @cherrypy.expose
+  def metricsJson(self):
+    cherrypy.response.headers['Content-Type'] = 'application/json'
+    return json.dumps(radioTelemetry.telemetry.getInfo(), sort_keys=True)
 
 
 '''
@@ -322,40 +1247,70 @@ deviceId = 3
     Section 3 - main proc, can launch working (web) mode or simple testing
 =========================================================================='''
 
-if __name__ == '__main__':
-  # Create control hub no.1 with two edge devices
-  myHub = ControlHub("Switch control hub")
-  
-  # Create and initializate edge devices
-  # Each device has ID, which must match BOARD_ID definition in Arduino code
-  # uploaded to the correspondent device!
-  myHub.addEdgeDevice(EdgeDevice(3,"Yasha's mattress heater", \
-  [[2, PinTypes.momentary_switch, "21:30","22:00"], \
-  [3, PinTypes.toggle_switch,"---","---"]] \
-  ))
- 
-  myHub.addEdgeDevice(EdgeDevice(4,"Gila's mattress heater ", \
-  [[2, PinTypes.momentary_switch, "22:15","22:45"], \
-  [3, PinTypes.toggle_switch,"---","---"]] \
-  ))  
+# Keep a reading pipe open for every edge device (up to 5) of the hub and apply 
+# radio policies of the devices, only of the devices added or changed by a reload if
+# changes (see ControlHub.applyRegistry) are given. Links keep what they learned.
+# The transceiver thread does it between two exchanges, returns an Event set once it's done
+def configureRadio(hub, changes=None):
+  deviceIds = [device.id for device in hub.edgeDevices]
+  updated = deviceIds if changes is None else set(changes["added"] + changes["changed"])
+  policies = [(device.id, device.radioPolicy) for device in hub.edgeDevices if device.id in updated]
+  def configure():
+    preassignReadingPipes(deviceIds)
+    for (deviceId, policy) in policies:
+      if configureLink(deviceId, **(policy or {})):
+        dbgPrint("Radio policy of device %d set to %s" % (deviceId, policy))
+  return transceiver.call(configure)
+
+# Reload the registry on SIGHUP. The reload runs in its own thread, so it doesn't 
+# interrupt whatever the main thread is in the middle of
+def reloadOnSignal(signum, frame):
+  def reload():
+    changes = myHub.reloadRegistry()
+    if changes is not None:
+      configureRadio(myHub, changes)
+  threading.Thread(target=reload, name="RegistryReload").start()
 
+if __name__ == '__main__':
   # Read command line arguments
   parser = argparse.ArgumentParser()
   parser.add_argument('-t','--test', help='Create all objects and print main web page to the terminal',action="store_true")
+  parser.add_argument('-r','--registry', help='JSON file with edge devices and their pins (reloaded on SIGHUP)', \
+                      default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "devices.json"))
+  parser.add_argument('-s','--state', help='Base name of the files pin states and schedules are saved to', \
+                      default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "hubState"))
+  parser.add_argument('-a','--archive', help='Base name of monthly files pin transitions and samples are archived to', \
+                      default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "hubArchive"))
+  parser.add_argument('-b','--reconcile-budget', help='Pin state reads per minute used to check edge devices, 0 - none', \
+                      type=float, default=6)
   args = parser.parse_args()
+
+  # Create control hub no.1 with edge devices from the registry
+  # Each device has ID, which must match BOARD_ID definition in Arduino code
+  # uploaded to the correspondent device!
+  myHub = ControlHub("Switch control hub")
+  myHub.loadRegistry(args.registry)
   
   # Source radioComm.py module and initialize radio object
-  # if radio start fails, override sendMessage function with a bogus
-  # one which doesn't do anything 
+  # if there is no radio hardware (no spidev or RPi.GPIO, no SPI device, not a Raspberry Pi),
+  # run against the emulated radio with a virtual edge device for every device of the hub
   try:
     from radioComm import *
-  except:
-    print("Can't load radio module, will run in emulation mode")
-    def sendMessage(*args):
-      print "sendMessage is invoked, but not executed"
+  except (ImportError, IOError, RuntimeError) as e:
+    print("Can't load radio module (%s), will run in emulation mode" % e)
+    import emulator
+    emulator.install([device.id for device in myHub.edgeDevices])
+    from radioComm import *
+  configureRadio(myHub)
+  myHub.radioReady = True
+  # Pin states and schedules saved by the previous run
+  myHub.attachStore(StateStore(args.state))
+  myHub.archive = Archive(args.archive)
+  signal.signal(signal.SIGHUP, reloadOnSignal)
 
   if args.test:
     print "\nRunning testing in a terminal mode"
+    myHub.pingEdgeDevices()
 
     # Loop through all edge devices in the hub
     for edgeDevice in myHub.edgeDevices:
@@ -363,34 +1318,47 @@ if __name__ == '__main__':
       for pin in edgeDevice.getPins():
         print(" testing pin %d swicth to 1 and then back to 0" % pin.id)
         pin.setState(1)
+        pin.waitForRadio()
         time.sleep(1)
         pin.setState(0)
+        pin.waitForRadio()
         time.sleep(1)
 
     #print myHub
     #print myHub.showAsHtml()
     print("\nCleaning up communication channel ...")
+    transceiver.stop()
     radio.end()
     GPIO.cleanup()
+    myHub.store.close()
+    myHub.archive.close()
   else:
     print "Starting web server"
     try:
-      cherrypy.config.update({'server.socket_host': '0.0.0.0','server.socket_port': 8090})
+      # Every open event stream of the web page holds a server thread
+      cherrypy.config.update({'server.socket_host': '0.0.0.0','server.socket_port': 8090, 'server.thread_pool': 30})
       # Uncomment the next line if you want to suppress Cherrypy own messages
       #cherrypy.config.update({'log.screen': False})
       cherrypy.tree.mount(MainServer(),"/","main.cfg") 
       cherrypy.engine.start()
-      # Go into infinite loop refreshing pin state for time turn on/off
-      while(True):
-        myHub.refreshPinState()
-        time.sleep(10)
+      if (args.reconcile_budget > 0):
+        myHub.reconciler = StateReconciler(myHub, args.reconcile_budget)
+      myHub.sampler = Sampler(myHub)
+      # Go into infinite loop turning pins on/off at their startTime/endTime
+      myHub.scheduler.run()
 
       cherrypy.engine.block()
   
       
     except KeyboardInterrupt:
       print("\nCleaning up communication channel...")
+      if myHub.reconciler:
+        myHub.reconciler.stop()
+      myHub.sampler.stop()
+      transceiver.stop()
       radio.end()
       GPIO.cleanup()
+      myHub.store.close()
+      myHub.archive.close()
       exit()
   
@@ -0,0 +1,379 @@
+# Archive of pin transitions and sensor samples in fixed-width binary records
+# Records are appended by a background writer thread in batches, to one file per month
+# (<path>-YYYYMM.bin, UTC). Within a file records are ordered by time, so a time range is
+# found by binary search. Files are read through mmap; with numpy installed a file is seen
+# as a structured array (one column per field) without copying and queries are vectorized.
+# Seconds on of every pin and count/sum/min/max of every sampled channel are also rolled
+# up per hour in memory as records are written, so aggregates over whole hours (e.g. days
+# from local midnight) over a long range don't read the records, with or without numpy.
+import array, calendar, glob, math, mmap, os, struct, threading, time
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+KIND_STATE = 0      # pin state sent to an edge device, value is the state
+KIND_ANALOG = 1     # analog pin sample, value 0-1023
+KIND_VCC = 2        # Vcc sample in mV, pin id is VCC_PIN
+KIND_NAMES = {"state": KIND_STATE, "analog": KIND_ANALOG, "vcc": KIND_VCC}
+VCC_PIN = 0xFF
+
+# time, device id, pin id, kind, attempts (-1 if the edge device didn't confirm), value, latency (sec)
+RECORD = struct.Struct("<dBBBbff")
+FIELDS = ("time", "deviceId", "pinId", "kind", "attempts", "value", "latency")
+if numpy:
+    DTYPE = numpy.dtype([("time", "<f8"), ("deviceId", "u1"), ("pinId", "u1"), ("kind", "u1"), ("attempts", "i1"),
+                         ("value", "<f4"), ("latency", "<f4")])
+
+# Most buckets an aggregate query may ask for
+MAX_BUCKETS = 10000
+
+# Rollups are kept per ROLLUP_STEP sec, in an array of ROLLUP_SLOTS (a UTC day) per channel and day.
+# Channels of samples take count, sum, min and max per slot, pins seconds on
+ROLLUP_STEP = 3600
+ROLLUP_SLOTS = 24
+SAMPLE_FIELDS = 4
+
+
+class Archive:
+    # Longest time a record waits in memory before it's written
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, path):
+        self.path = path
+        self.queue = []
+        self.unwritten = 0
+        self.lastTime = 0.0
+        self.views = {}         # file path -> (size, view) of the file as last mapped
+        self.rollups = {}       # (device id, pin id, kind) -> {day: array of ROLLUP_SLOTS slots}
+        self.pinStates = {}     # (device id, pin id) -> (last confirmed state, its time)
+        self.rolledUpTo = 0.0   # time of the last record rolled up
+        self.rolledUp = False   # rollups hold all files, they're built by the writer thread
+        self.rollupLock = threading.Lock()
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="Archive")
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Queue a record. Times never go back, so files stay ordered even if the clock is set back
+    def append(self, deviceId, pinId, kind, value, attempts=1, latency=0.0, at=None):
+        with self.condition:
+            self.lastTime = max(self.lastTime, time.time() if at is None else at)
+            self.queue.append((self.lastTime, deviceId, pinId, kind, attempts, value, latency))
+            self.unwritten += 1
+            if len(self.queue) == 1:
+                self.condition.notify()
+
+    def run(self):
+        self.loadRollups()
+        while True:
+            with self.condition:
+                while self.running and not self.queue:
+                    self.condition.wait()
+                if not self.queue and not self.running:
+                    return
+            # Collect what arrives meanwhile into the same write
+            if self.running:
+                time.sleep(self.FLUSH_INTERVAL)
+            with self.condition:
+                batch, self.queue = self.queue, []
+            try:
+                self.write(batch)
+            except (IOError, OSError) as e:
+                print("Can't write %d records to archive %s: %s" % (len(batch), self.path, e))
+            with self.condition:
+                self.unwritten -= len(batch)
+                self.condition.notifyAll()
+
+    def filePath(self, at):
+        return "%s-%s.bin" % (self.path, time.strftime("%Y%m", time.gmtime(at)))
+
+    # Write records (tuples of FIELDS ordered by time) with one write per file
+    def write(self, records):
+        files = {}
+        for record in records:
+            files.setdefault(self.filePath(record[0]), []).append(RECORD.pack(*record))
+        with self.rollupLock:
+            for path in sorted(files):
+                with open(path, "ab") as archiveFile:
+                    archiveFile.write(b"".join(files[path]))
+            self.rollUp(records)
+
+    # Roll up the records already in the files, once on startup. Queries read the records
+    # until it's done, which takes about as long as reading all of them once
+    def loadRollups(self):
+        with self.rollupLock:
+            for (monthStart, path) in self.files():
+                view = self.view(path)
+                if view is None:
+                    continue
+                if numpy:
+                    self.rollUp(view.tolist())
+                else:
+                    self.rollUp(RECORD.unpack_from(view, offset) for offset in range(0, len(view), RECORD.size))
+            self.rolledUp = True
+
+    # Add records (tuples of FIELDS ordered by time) to the rollups, called with rollupLock held
+    def rollUp(self, records):
+        for (at, deviceId, pinId, kind, attempts, value, latency) in records:
+            self.rolledUpTo = at
+            if kind == KIND_STATE:
+                if attempts <= 0:
+                    continue
+                (state, since) = self.pinStates.get((deviceId, pinId), (0, at))
+                if state:
+                    self.rollUpOnTime(deviceId, pinId, since, at)
+                self.pinStates[(deviceId, pinId)] = (value, at)
+                continue
+            (day, slot) = divmod(int(at // ROLLUP_STEP), ROLLUP_SLOTS)
+            slots = self.rollupSlots((deviceId, pinId, kind), day, SAMPLE_FIELDS)
+            index = slot * SAMPLE_FIELDS
+            if slots[index]:
+                slots[index + 2] = min(slots[index + 2], value)
+                slots[index + 3] = max(slots[index + 3], value)
+            else:
+                (slots[index + 2], slots[index + 3]) = (value, value)
+            slots[index] += 1
+            slots[index + 1] += value
+
+    # Add interval [since, until) the pin was on to the rollups of the hours it spans
+    def rollUpOnTime(self, deviceId, pinId, since, until):
+        while since < until:
+            hour = int(since // ROLLUP_STEP)
+            hourEnd = min(until, (hour + 1) * ROLLUP_STEP)
+            (day, slot) = divmod(hour, ROLLUP_SLOTS)
+            self.rollupSlots((deviceId, pinId, KIND_STATE), day, 1)[slot] += hourEnd - since
+            since = hourEnd
+
+    def rollupSlots(self, channel, day, fields):
+        days = self.rollups.setdefault(channel, {})
+        slots = days.get(day)
+        if slots is None:
+            slots = days[day] = array.array("d", [0.0]) * (ROLLUP_SLOTS * fields)
+        return slots
+
+    # Whether buckets of 'step' sec from start to end are made of whole rollup slots. end may
+    # also be past the last record, the rollups hold nothing after it
+    def rollupsCover(self, start, end, step):
+        return self.rolledUp and start % ROLLUP_STEP == 0 and step % ROLLUP_STEP == 0 and \
+               (end % ROLLUP_STEP == 0 or end > self.rolledUpTo)
+
+    # (bucket index, slot values) of the rollup slots of a channel from start to end,
+    # called with rollupLock held
+    def rolledUpSlots(self, start, end, step, channel, fields):
+        days = self.rollups.get(channel, {})
+        first = int(start // ROLLUP_STEP)
+        last = int(math.ceil(end / ROLLUP_STEP))
+        perBucket = int(step // ROLLUP_STEP)
+        for day in range(first // ROLLUP_SLOTS, (last - 1) // ROLLUP_SLOTS + 1):
+            slots = days.get(day)
+            if slots is None:
+                continue
+            for slot in range(max(first - day * ROLLUP_SLOTS, 0), min(last - day * ROLLUP_SLOTS, ROLLUP_SLOTS)):
+                if slots[slot * fields]:
+                    yield ((day * ROLLUP_SLOTS + slot - first) // perBucket, slots[slot * fields:(slot + 1) * fields])
+
+    # Wait until all records queued so far are written
+    def flush(self):
+        with self.condition:
+            while self.unwritten and self.thread.is_alive():
+                self.condition.wait(1)
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+
+    # Files overlapping [start, end) as (month start, path), oldest first
+    def files(self, start=0, end=float("inf")):
+        months = []
+        for path in glob.glob(self.path + "-[0-9][0-9][0-9][0-9][0-9][0-9].bin"):
+            month = path[-10:-4]
+            months.append((calendar.timegm((int(month[:4]), int(month[4:]), 1, 0, 0, 0)), path))
+        months.sort()
+        selected = []
+        for index, (monthStart, path) in enumerate(months):
+            monthEnd = months[index + 1][0] if index + 1 < len(months) else float("inf")
+            if monthStart < end and monthEnd > start:
+                selected.append((monthStart, path))
+        return selected
+
+    # Records of a file through mmap: a numpy structured array, or the mmap itself without
+    # numpy. Mapped again only when the file grew
+    def view(self, path):
+        size = os.path.getsize(path)
+        size -= size % RECORD.size
+        cached = self.views.get(path)
+        if cached and cached[0] == size:
+            return cached[1]
+        if size == 0:
+            return None
+        with open(path, "rb") as archiveFile:
+            mapped = mmap.mmap(archiveFile.fileno(), size, access=mmap.ACCESS_READ)
+        view = numpy.frombuffer(mapped, dtype=DTYPE, count=size // RECORD.size) if numpy else mapped
+        self.views[path] = (size, view)
+        return view
+
+    # Index of the first record at 'at' or later
+    @staticmethod
+    def search(view, at):
+        if numpy:
+            return int(numpy.searchsorted(view["time"], at))
+        (low, high) = (0, len(view) // RECORD.size)
+        while low < high:
+            middle = (low + high) // 2
+            if RECORD.unpack_from(view, middle * RECORD.size)[0] < at:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # Records with start <= time < end matching the given device, pin and kind (None matches
+    # any), oldest first. A numpy structured array with numpy, a list of tuples without
+    def select(self, start, end, deviceId=None, pinId=None, kind=None):
+        chunks = []
+        for (monthStart, path) in self.files(start, end):
+            view = self.view(path)
+            if view is None:
+                continue
+            (first, last) = (self.search(view, start), self.search(view, end))
+            if numpy:
+                records = view[first:last]
+                mask = numpy.ones(len(records), dtype=bool)
+                for (field, wanted) in (("deviceId", deviceId), ("pinId", pinId), ("kind", kind)):
+                    if wanted is not None:
+                        mask &= records[field] == wanted
+                chunks.append(records[mask])
+            else:
+                for offset in range(first * RECORD.size, last * RECORD.size, RECORD.size):
+                    record = RECORD.unpack_from(view, offset)
+                    if (deviceId is None or record[1] == deviceId) and (pinId is None or record[2] == pinId) and \
+                       (kind is None or record[3] == kind):
+                        chunks.append(record)
+        if numpy:
+            return numpy.concatenate(chunks) if chunks else numpy.zeros(0, dtype=DTYPE)
+        return chunks
+
+    # Records as a list of dictionaries, at most 'limit' of the newest ones
+    def records(self, start, end, deviceId=None, pinId=None, kind=None, limit=None):
+        selected = self.select(start, end, deviceId, pinId, kind)
+        if limit is not None:
+            selected = selected[max(0, len(selected) - limit):]
+        return [dict(zip(FIELDS, record)) for record in asTuples(selected)]
+
+    # Value of the last confirmed state record of a pin before 'at', None if there is none
+    def stateBefore(self, at, deviceId, pinId):
+        for (monthStart, path) in reversed(self.files(0, at)):
+            records = self.select(monthStart, at, deviceId, pinId, KIND_STATE)
+            if numpy:
+                confirmed = records["value"][records["attempts"] > 0]
+                if len(confirmed):
+                    return float(confirmed[-1])
+            else:
+                for record in reversed(records):
+                    if record[4] > 0:
+                        return record[5]
+        return None
+
+    # Seconds a pin was on in every bucket of 'step' seconds from start to end, counting
+    # transitions confirmed by the edge device. Returns a list of (bucket start, seconds on)
+    def onTime(self, start, end, step, deviceId, pinId):
+        buckets = bucketCount(start, end, step)
+        totals = [0.0] * buckets
+        if self.rollupsCover(start, end, step):
+            with self.rollupLock:
+                for (index, slots) in self.rolledUpSlots(start, end, step, (deviceId, pinId, KIND_STATE), 1):
+                    totals[index] += slots[0]
+                (state, since) = self.pinStates.get((deviceId, pinId), (0, end))
+            # The pin is still on since its last transition
+            if state:
+                addInterval(totals, start, step, since, min(end, time.time()))
+            return [(start + index * step, totals[index]) for index in range(buckets)]
+        state = self.stateBefore(start, deviceId, pinId) or 0
+        since = start
+        transitions = self.select(start, end, deviceId, pinId, KIND_STATE)
+        stop = min(end, time.time())
+        for record in asTuples(transitions) + [None]:
+            if record is None:
+                (at, value) = (stop, state)
+            elif record[4] <= 0:
+                continue
+            else:
+                (at, value) = (float(record[0]), record[5])
+            if state:
+                addInterval(totals, start, step, since, at)
+            (state, since) = (value, at)
+        return [(start + index * step, totals[index]) for index in range(buckets)]
+
+    # Count, min, max and mean of samples of a pin (or VCC_PIN) in every bucket of 'step' seconds
+    # from start to end. Returns a list of (bucket start, count, min, max, mean), None for empty buckets
+    def downsample(self, start, end, step, deviceId, pinId, kind):
+        buckets = bucketCount(start, end, step)
+        if self.rollupsCover(start, end, step):
+            (counts, sums) = ([0] * buckets, [0.0] * buckets)
+            (minimums, maximums) = ([float("inf")] * buckets, [float("-inf")] * buckets)
+            with self.rollupLock:
+                for (index, (count, total, minimum, maximum)) in \
+                        self.rolledUpSlots(start, end, step, (deviceId, pinId, kind), SAMPLE_FIELDS):
+                    counts[index] += int(count)
+                    sums[index] += total
+                    minimums[index] = min(minimums[index], minimum)
+                    maximums[index] = max(maximums[index], maximum)
+        elif numpy:
+            samples = self.select(start, end, deviceId, pinId, kind)
+            # Rounding may put a sample just before end past the last bucket
+            index = numpy.minimum((samples["time"] - start) // step, buckets - 1).astype(numpy.int64)
+            values = samples["value"].astype(numpy.float64)
+            counts = numpy.bincount(index, minlength=buckets)
+            sums = numpy.bincount(index, weights=values, minlength=buckets)
+            minimums = numpy.full(buckets, numpy.inf)
+            maximums = numpy.full(buckets, -numpy.inf)
+            numpy.minimum.at(minimums, index, values)
+            numpy.maximum.at(maximums, index, values)
+            counts, sums, minimums, maximums = counts.tolist(), sums.tolist(), minimums.tolist(), maximums.tolist()
+        else:
+            samples = self.select(start, end, deviceId, pinId, kind)
+            (counts, sums) = ([0] * buckets, [0.0] * buckets)
+            (minimums, maximums) = ([float("inf")] * buckets, [float("-inf")] * buckets)
+            for record in samples:
+                index = min(int((record[0] - start) // step), buckets - 1)
+                counts[index] += 1
+                sums[index] += record[5]
+                minimums[index] = min(minimums[index], record[5])
+                maximums[index] = max(maximums[index], record[5])
+        result = []
+        for index in range(buckets):
+            if counts[index]:
+                result.append((start + index * step, counts[index], minimums[index], maximums[index],
+                               sums[index] / counts[index]))
+            else:
+                result.append((start + index * step, 0, None, None, None))
+        return result
+
+
+# Records returned by Archive.select as a list of tuples
+def asTuples(records):
+    return records.tolist() if numpy else list(records)
+
+
+def bucketCount(start, end, step):
+    if not (step > 0 and end > start):
+        raise ValueError("Empty range or step")
+    buckets = int(math.ceil((end - start) / float(step)))
+    if buckets > MAX_BUCKETS:
+        raise ValueError("More than %d buckets" % MAX_BUCKETS)
+    return buckets
+
+
+# Add interval [since, until) to totals of buckets of 'step' seconds from start
+def addInterval(totals, start, step, since, until):
+    since = max(since, start)
+    while since < until:
+        index = int((since - start) // step)
+        if index >= len(totals):
+            return
+        bucketEnd = min(until, start + (index + 1) * step)
+        totals[index] += bucketEnd - since
+        since = bucketEnd
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# Benchmark of archive.Archive: writes a year of pin transitions and samples of many boards
+# and times typical queries (daily on-time of a pin, daily/hourly Vcc aggregates, latest
+# records) and rebuilding the hourly rollups when the archive is opened again.
+# Uses numpy if it's installed, run it with and without to compare.
+# Usage: python archiveBench.py [boards] [days] [sample_interval_sec]
+import os
+import shutil
+import sys
+import tempfile
+import time
+import archive
+from archive import Archive, KIND_STATE, KIND_ANALOG, KIND_VCC, VCC_PIN
+
+DAY = 86400
+PINS = [2, 3, 4]
+ANALOG_PIN = 14
+
+
+# Records of one day in time order: every pin on for an hour twice a day, Vcc and one
+# analog pin of every board sampled every interval seconds
+def dayRecords(dayStart, boards, interval):
+    records = []
+    for deviceId in range(1, boards + 1):
+        for pinId in PINS:
+            for hour in (7, 19):
+                on = dayStart + hour * 3600 + deviceId * 60 + pinId
+                records.append((on, deviceId, pinId, KIND_STATE, 1, 1, 0.1))
+                records.append((on + 3600, deviceId, pinId, KIND_STATE, 1, 0, 0.1))
+        for at in range(0, DAY, interval):
+            records.append((dayStart + at + deviceId, deviceId, VCC_PIN, KIND_VCC, 1, 5000 - at // 3600, 0.08))
+            records.append((dayStart + at + deviceId + 0.5, deviceId, ANALOG_PIN, KIND_ANALOG, 1, at % 1024, 0.08))
+    records.sort()
+    return records
+
+
+def timeQuery(name, repeat, query):
+    result = query()
+    start = time.time()
+    for i in range(repeat):
+        query()
+    elapsed = (time.time() - start) / repeat
+    print("%-40s %10.2f ms" % (name, 1000 * elapsed))
+    return result
+
+
+if __name__ == '__main__':
+    boards = 20
+    days = 365
+    interval = 600
+    if len(sys.argv) > 1:
+        boards = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        days = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        interval = int(sys.argv[3])
+
+    directory = tempfile.mkdtemp(prefix="archiveBench")
+    store = Archive(os.path.join(directory, "hub"))
+    try:
+        first = 1700000000 - 1700000000 % DAY
+        start = time.time()
+        records = 0
+        for day in range(days):
+            batch = dayRecords(first + day * DAY, boards, interval)
+            store.write(batch)
+            records += len(batch)
+        elapsed = time.time() - start
+        size = sum(os.path.getsize(path) for (month, path) in store.files())
+        print("%d boards, %d days: %d records, %d files, %.1f MB, written in %.1f sec (numpy %s)" % (boards, days,
+              records, len(store.files()), size / 1e6, elapsed, "yes" if archive.numpy else "no"))
+
+        last = first + days * DAY
+        onTime = timeQuery("daily on-time of a pin, whole range", 5,
+                           lambda: store.onTime(first, last, DAY, boards // 2 + 1, 3))
+        if any(abs(on - 7200) > 1 for (bucket, on) in onTime):
+            print("  unexpected on-time: %s" % onTime[:3])
+        timeQuery("daily on-time of a pin, last week", 20, lambda: store.onTime(last - 7 * DAY, last, DAY, 1, 3))
+        timeQuery("daily Vcc of a board, whole range", 5,
+                  lambda: store.downsample(first, last, DAY, 1, VCC_PIN, KIND_VCC))
+        timeQuery("hourly analog pin of a board, last day", 20,
+                  lambda: store.downsample(last - DAY, last, 3600, 1, ANALOG_PIN, KIND_ANALOG))
+        timeQuery("latest 100 records of a pin, last day", 20,
+                  lambda: store.records(last - DAY, last, 1, 3, KIND_STATE, 100))
+
+        # A restart rolls up all records again, aggregates scan the records until it's done
+        start = time.time()
+        reopened = Archive(os.path.join(directory, "hub"))
+        reopened.flush()
+        while not reopened.rolledUp:
+            time.sleep(0.01)
+        print("%-40s %10.2f ms" % ("rollups rebuilt on opening", 1000 * (time.time() - start)))
+        reopened.close()
+    finally:
+        store.close()
+        shutil.rmtree(directory)
@@ -4,13 +4,49 @@
 
 // This ID must be unique for each Arduino edge device
 #define BOARD_ID 0x04
+// BOARD_ID is added to the last byte of the radio addresses, the gateway's pipes 2-5 share
+// the other bytes, so it must not carry
+#if BOARD_ID < 1 || BOARD_ID > 0x1F
+#error BOARD_ID must be in range 1-31
+#endif
 
 // Size of payload received from and send to raspberry 
 #define PACKET_SIZE 5
+// Largest payload, frames with several commands take up to this many bytes
+#define MAX_PAYLOAD_SIZE 32
+
+// Frame of several commands: <sender> <receiver> 0xB0 <version> <count> followed by 
+// <command> <MSB> <LSB> for each command, and its sequence number in version 2. The reply
+// has the same layout, every command replaced by the last bytes of its own reply
+#define FRAME_COMMAND 0xB0
+#define FRAME_VERSION 2
+#define FRAME_HEADER 5
+
+// A command may carry a sequence number (1-255) as the 6th byte, the reply echoes it.
+// The last DEDUP_WINDOW numbered commands are remembered with their replies, a retry of
+// one of them gets the saved reply and is not executed again. Command 0xA0 clears them
+#define FEATURE_SEQUENCE 0x01
+#define DEDUP_WINDOW 16
+
+// Command 0xA8 sets a pin to 1 for LSB * PULSE_UNIT_MS milliseconds and back to 0
+#define FEATURE_PULSE 0x02
+#define PULSE_UNIT_MS 10
+
+// Features bit mask returned by command 0xA0 along with FRAME_VERSION
+#define FEATURES (FEATURE_SEQUENCE | FEATURE_PULSE)
 
 /* Start radio on CE, CSN pins*/
 RF24 radio (9,10);
 
+// Numbered commands executed last, sequence 0 marks an empty entry
+struct ExecutedCommand {
+  byte sequence;
+  byte command[3];
+  byte reply[3];
+};
+ExecutedCommand executed[DEDUP_WINDOW];
+byte nextExecuted = 0;
+
 // This proc is for debugging  only to indicate that operation succeeded or failed
 void myBlink(int pin, int upTime, int downTime, int repetitions) { 
   for (int i=0;i<repetitions;i++) {
@@ -26,10 +62,24 @@ void myBlink(int pin, int upTime, int downTime, int repetitions) {
   }
 }
 
+// Measure Vcc in mV: read the internal 1.1V reference against AVcc (ATmega328)
+int readVcc() {
+  long result;
+  ADMUX = _BV(REFS0) | _BV(MUX3) | _BV(MUX2) | _BV(MUX1);
+  // Wait for the reference to settle
+  delay(2);
+  ADCSRA |= _BV(ADSC);
+  while (bit_is_set(ADCSRA, ADSC));
+  result = ADCL;
+  result |= ADCH << 8;
+  // 1.1V * 1023 * 1000
+  return 1125300L / result;
+}
+
 // Print received message byte by byte
-void printMsg(String prefix, byte msg[]) {
+void printMsg(String prefix, byte msg[], int length) {
   Serial.print(prefix);
-  for (int i=0; i< PACKET_SIZE; i++) {
+  for (int i=0; i< length; i++) {
       Serial.print(msg[i],HEX);
       Serial.print(" ");
     }
@@ -65,6 +115,10 @@ void setup() {
   
   radio.openWritingPipe(0xABCDABCD71LL + BOARD_ID);
   radio.openReadingPipe(1,0xE8E8F0F0E0LL + BOARD_ID);
+  // Pipe 2 listens to broadcasts (receiver id 0). Broadcasts are not acked, 
+  // otherwise all boards would send their acks at the same time
+  radio.openReadingPipe(2,0xE8E8F0F0E0LL);
+  radio.setAutoAck(2,false);
   radio.powerUp();
   radio.startListening();
 
@@ -73,15 +127,116 @@ void setup() {
   //Serial.print("Listening to pipe: ",);
 }
 
+// Execute one command, MSB and LSB are its arguments. result holds command code, MSB and LSB
+// of the reply, they are sent back as they are unless the command returns something in them
+void execute(byte commandCode, byte MSB, byte LSB, byte result[]) {
+  byte pinId, pinValue;
+  int i, value;
+  unsigned int bits;
+
+  result[0] = commandCode;
+  result[1] = MSB;
+  result[2] = LSB;
+  switch(commandCode) {
+    case 0xA0 :
+      // Command 0xA0 - return supported frame version in MSB and features in LSB.
+      // The gateway numbers commands from 1 again after it
+      memset(executed, 0, sizeof(executed));
+      result[1] = FRAME_VERSION;
+      result[2] = FEATURES;
+      break;
+    case 0xA1 :
+      // Command 0xA1 - retransmitting commandCode, msb and lsb back do nothing else  
+      break;       
+    case 0xA2 :
+      // Command 0xA2 - MSB holds a number of pin, LSB its mode (0 - input, 1 - output)
+      pinMode(MSB, LSB ? OUTPUT : INPUT);
+      break;
+    case 0xA3 :
+      // Command 0xA3 - MSB holds a number of pin, its value is returned in LSB.
+      // Pin 0xFF reads pins 0-15 at once and returns them as a bit mask, pins 0-7 in MSB
+      if (MSB == 0xFF) {
+        bits = 0;
+        for (i = 0; i < 16; i++) {
+          bits |= (unsigned int) digitalRead(i) << i;
+        }
+        result[1] = bits & 0xFF;
+        result[2] = bits >> 8;
+      } else {
+        result[2] = digitalRead(MSB);
+      }
+      break;
+    case 0xA4 :
+      // Command 0xA4 - MSB holds a number of output pin, LSB its value (0 or 1)   
+      pinId = MSB;
+      pinValue = LSB;
+      digitalWrite(pinId,pinValue);
+      break; 
+    case 0xA6 :
+      // Command 0xA6 - MSB holds a number of pwm pin, LSB its duty cycle (0-255)
+      analogWrite(MSB, LSB);
+      break;
+    case 0xA8 :
+      // Command 0xA8 - MSB holds a number of output pin, LSB the pulse width in PULSE_UNIT_MS.
+      // The pulse is timed here, the reply is sent after it
+      digitalWrite(MSB, 1);
+      delay((unsigned long) LSB * PULSE_UNIT_MS);
+      digitalWrite(MSB, 0);
+      break;
+    case 0xA5 :
+    case 0xA7 :
+      // Command 0xA5 - MSB holds a number of analog pin (A0 is 14), 0xA7 - measure Vcc in mV.
+      // The value is returned in MSB (low byte) and LSB (high byte)
+      if (commandCode == 0xA5) {
+        value = analogRead(MSB);
+      } else {
+        value = readVcc();
+      }
+      result[1] = value & 0xFF;
+      result[2] = value >> 8;
+      break;
+    default :
+      Serial.println("Invalid command"); 
+      for (i = 0; i < 3; i++) {     
+        result[i] = 0xFF;
+      } 
+  }
+}
+
+// Execute a command with a sequence number (not 0) only once, a retry gets the saved reply.
+// result is filled like by execute(), the sequence number is not added to it
+void executeOnce(byte sequence, byte commandCode, byte MSB, byte LSB, byte result[]) {
+  int i;
+  
+  if (sequence == 0) {
+    execute(commandCode, MSB, LSB, result);
+    return;
+  }
+  for (i = 0; i < DEDUP_WINDOW; i++) {
+    if ((executed[i].sequence == sequence) && (executed[i].command[0] == commandCode) &&
+        (executed[i].command[1] == MSB) && (executed[i].command[2] == LSB)) {
+      Serial.println("Repeated command, sending saved reply");
+      memcpy(result, executed[i].reply, 3);
+      return;
+    }
+  }
+  execute(commandCode, MSB, LSB, result);
+  executed[nextExecuted].sequence = sequence;
+  executed[nextExecuted].command[0] = commandCode;
+  executed[nextExecuted].command[1] = MSB;
+  executed[nextExecuted].command[2] = LSB;
+  memcpy(executed[nextExecuted].reply, result, 3);
+  nextExecuted = (nextExecuted + 1) % DEDUP_WINDOW;
+}
+
 void loop() {  
   bool ok; 
-  byte receivedMsg[PACKET_SIZE];
-  byte sentMsg[PACKET_SIZE];
+  byte receivedMsg[MAX_PAYLOAD_SIZE];
+  byte sentMsg[MAX_PAYLOAD_SIZE];
   byte gatewayID, edgeDeviceID, commandCode, MSB, LSB;
+  byte receivedSize, sentSize, count, itemSize, sequence;
   
-  byte pinId = 0;
-  byte pinValue = 0;
-  int i, value;
+  int i;
   
 
   // If no radio signal detected simply wait 50ms until testing again
@@ -90,9 +245,15 @@ void loop() {
     return;
   }
 
-  // OK radio signal available
-  radio.read(receivedMsg, PACKET_SIZE);
-  printMsg("Received msg: ",receivedMsg);
+  // OK radio signal available. Payloads are dynamic, older gateways send 5 bytes
+  receivedSize = radio.getDynamicPayloadSize();
+  if ((receivedSize < PACKET_SIZE) || (receivedSize > MAX_PAYLOAD_SIZE)) {
+    // Corrupted or too short packet
+    radio.flush_rx();
+    return;
+  }
+  radio.read(receivedMsg, receivedSize);
+  printMsg("Received msg: ",receivedMsg, receivedSize);
   radio.stopListening();
 
   /* Unpack received payload to 5 individual bytes
@@ -121,37 +282,53 @@ void loop() {
    * In our messaging first byte identifies source device and second - destination
    * For unicast message exchange if message received from rapsberry is say 0x00 0x03 ... ,
    * then reply will be 0x03 0x00 ...    
-   * remaining 3 bytes in the reply message are copied from received message
+   * remaining 3 bytes in the reply message are copied from received message,
+   * unless the command returns something in them
    */
   sentMsg[0] = BOARD_ID;
   sentMsg[1] = gatewayID;
-  for (i = 2; i<=4; i++) {     
+  sentSize = PACKET_SIZE;
+  count = LSB;
+  // Frame version 1 has 3 byte items, version 2 adds a sequence number to every item
+  itemSize = MSB + 2;
+  if ((commandCode == FRAME_COMMAND) && (MSB >= 1) && (MSB <= FRAME_VERSION) &&
+      (FRAME_HEADER + itemSize * count <= receivedSize)) {
+    // Frame: execute its commands in order, the reply keeps the header
+    for (i = 2; i<=4; i++) {     
       sentMsg[i] = receivedMsg[i];
-   }
-    
-  // Process command code
-  switch(commandCode) {
-    case 0xA1 :
-      // Command 0xA1 - retransmitting commandCode, msb and lsb back do nothing else  
-      break;       
-    case 0xA4 :
-      // Command 0xA4 - MSB holds a number of output pin, LSB its value (0 or 1)   
-      pinId = MSB;
-      pinValue = LSB;
-      digitalWrite(pinId,pinValue);
-      break; 
-    default :
-      Serial.println("Invalid command"); 
-      for (i = 2; i<=4; i++) {     
-        sentMsg[i] = 0xFF;
-      } 
+    }
+    for (i = 0; i < count; i++) {
+      byte *item = &receivedMsg[FRAME_HEADER + itemSize * i];
+      sequence = (itemSize == 4) ? item[3] : 0;
+      executeOnce(sequence, item[0], item[1], item[2], &sentMsg[FRAME_HEADER + itemSize * i]);
+      if (itemSize == 4) {
+        sentMsg[FRAME_HEADER + itemSize * i + 3] = sequence;
+      }
+    }
+    sentSize = FRAME_HEADER + itemSize * count;
+  } else {
+    // Padding of older gateways is 0, i.e. not numbered
+    sequence = (receivedSize > PACKET_SIZE) ? receivedMsg[PACKET_SIZE] : 0;
+    executeOnce(sequence, commandCode, MSB, LSB, &sentMsg[2]);
+    if (sequence != 0) {
+      sentMsg[PACKET_SIZE] = sequence;
+      sentSize = PACKET_SIZE + 1;
+    }
   }
-
+    
   /* Different delay for different Arduino boards to set their
    replies - 20ms apart */
   delay(BOARD_ID*20);
-  printMsg("Sending back msg: ", sentMsg);
-  ok = radio.write(&sentMsg,PACKET_SIZE);  
+  printMsg("Sending back msg: ", sentMsg, sentSize);
+  // Replies to broadcasts go to the common address of board id 0, 
+  // the gateway tells the boards apart by the first byte of the reply
+  if (edgeDeviceID == 0) {
+    radio.openWritingPipe(0xABCDABCD71LL);
+  }
+  ok = radio.write(&sentMsg,sentSize);  
+  if (edgeDeviceID == 0) {
+    radio.openWritingPipe(0xABCDABCD71LL + BOARD_ID);
+  }
   if (ok)
     Serial.println("ok...");
   else
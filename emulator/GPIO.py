@@ -0,0 +1,95 @@
+# Stand-in for the RPi.GPIO module. Output pins can be watched by the emulator
+# (e.g. CE of the virtual radio) and input pins can be driven by it (e.g. IRQ),
+# firing edge callbacks registered with add_event_detect the way RPi.GPIO does:
+# from a separate thread
+from __future__ import absolute_import
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+BCM = 11
+BOARD = 10
+OUT = 0
+IN = 1
+LOW = 0
+HIGH = 1
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
+RISING = 31
+FALLING = 32
+BOTH = 33
+RPI_REVISION = 3
+VERSION = "emulator"
+
+levels = {}           # pin -> current level
+outputListeners = {}  # pin -> functions called with the new level when the pin is written
+edgeCallbacks = {}    # pin -> (edge, [callbacks])
+events = queue.Queue()
+dispatcher = None
+
+def setmode(mode):
+    pass
+
+def setwarnings(flag):
+    pass
+
+def setup(pin, mode, pull_up_down=PUD_OFF, initial=None):
+    if pin not in levels:
+        levels[pin] = HIGH if pull_up_down == PUD_UP else LOW
+    if mode == OUT and initial is not None:
+        output(pin, initial)
+
+def output(pin, value):
+    value = HIGH if value else LOW
+    levels[pin] = value
+    for listener in list(outputListeners.get(pin, [])):
+        listener(value)
+
+def input(pin):
+    return levels.get(pin, LOW)
+
+def add_event_detect(pin, edge, callback=None, bouncetime=None):
+    if pin in edgeCallbacks:
+        raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+    edgeCallbacks[pin] = (edge, [])
+    if callback:
+        add_event_callback(pin, callback)
+
+def add_event_callback(pin, callback):
+    edgeCallbacks[pin][1].append(callback)
+
+def remove_event_detect(pin):
+    edgeCallbacks.pop(pin, None)
+
+def cleanup(pins=None):
+    for pin in list(edgeCallbacks.keys()):
+        if pins is None or pin in pins:
+            remove_event_detect(pin)
+
+# Emulator side: call listener(level) whenever the hub writes pin
+def addOutputListener(pin, listener):
+    outputListeners.setdefault(pin, []).append(listener)
+
+# Emulator side: set level of an input pin, firing edge callbacks on a change
+def drive(pin, level):
+    global dispatcher
+    old = levels.get(pin, LOW)
+    levels[pin] = level
+    if old == level or pin not in edgeCallbacks:
+        return
+    (edge, callbacks) = edgeCallbacks[pin]
+    if edge == BOTH or (edge == FALLING and level == LOW) or (edge == RISING and level == HIGH):
+        if dispatcher is None:
+            dispatcher = threading.Thread(target=dispatch, name="EmulatorGPIO")
+            dispatcher.daemon = True
+            dispatcher.start()
+        for callback in callbacks:
+            events.put((callback, pin))
+
+def dispatch():
+    while True:
+        (callback, pin) = events.get()
+        callback(pin)
@@ -0,0 +1,60 @@
+# Software emulator of the radio network: a virtual nRF24L01+ attached to the hub through
+# stand-ins for the spidev and RPi.GPIO modules, and virtual Arduino edge devices
+# sharing a virtual air with it. Lets radioComm.py and SwitchController.py run unmodified
+# on a machine without the radio hardware:
+#
+#   import emulator
+#   emulator.install(devices=[3,4], loss=0.1)
+#   import radioComm
+#
+# or from the command line: python -m emulator --devices 3,4 --loss 0.1 SwitchController.py test
+from __future__ import absolute_import
+import os, sys
+from emulator.air import Air
+
+air = None
+radios = {}     # (bus, device) -> VirtualNRF24 of the hub
+devices = {}    # board id -> VirtualEdgeDevice
+cePin = 17
+irqPin = None
+
+# Make 'import spidev' and 'import RPi.GPIO' load the emulator versions
+# and create the air with one virtual edge device per board id in devices.
+# If irq is set, the virtual radio drives that fake GPIO pin and radioComm waits on it
+def install(devices=(), loss=0.0, latency=0.0, collisions=True, seed=None, ce=17, irq=None):
+    global air, cePin, irqPin
+    from emulator import GPIO, spidev
+    air = Air(loss, latency, collisions, seed)
+    cePin = ce
+    irqPin = irq
+    if irq is not None:
+        os.environ["RADIO_IRQ_PIN"] = str(irq)
+    rpi = type(sys)("RPi")
+    rpi.GPIO = GPIO
+    sys.modules["spidev"] = spidev
+    sys.modules["RPi"] = rpi
+    sys.modules["RPi.GPIO"] = GPIO
+    for boardId in devices:
+        addEdgeDevice(boardId)
+    return air
+
+def addEdgeDevice(boardId, loopPhase=None):
+    from emulator.edgeDevice import VirtualEdgeDevice
+    with air.lock:
+        device = VirtualEdgeDevice(air, boardId, loopPhase)
+        devices[boardId] = device
+    return device
+
+def removeEdgeDevice(boardId):
+    with air.lock:
+        devices.pop(boardId).stopListening()
+
+# Virtual radio behind SPI bus/device, created when the hub opens it
+def hubRadio(bus, device):
+    from emulator.nrf24 import VirtualNRF24
+    if air is None:
+        raise Exception("emulator.install() must be called first")
+    with air.lock:
+        if (bus, device) not in radios:
+            radios[(bus, device)] = VirtualNRF24(air, cePin, irqPin)
+        return radios[(bus, device)]
@@ -0,0 +1,21 @@
+# Run a hub script against the emulator: python -m emulator [options] script.py [args]
+from __future__ import absolute_import
+import argparse, os, runpy, sys
+import emulator
+
+parser = argparse.ArgumentParser(prog="python -m emulator", description="Run a hub script with emulated radio hardware")
+parser.add_argument("--devices", default="3,4", help="comma separated board ids of virtual edge devices")
+parser.add_argument("--loss", type=float, default=0.0, help="probability of losing a packet or an ack")
+parser.add_argument("--latency", type=float, default=0.0, help="extra delay of every packet, sec")
+parser.add_argument("--no-collisions", action="store_true", help="don't corrupt overlapping packets")
+parser.add_argument("--seed", type=int, default=None, help="seed of the loss generator")
+parser.add_argument("--irq", type=int, default=None, help="BCM pin to emulate the IRQ line on")
+parser.add_argument("script")
+parser.add_argument("args", nargs=argparse.REMAINDER)
+options = parser.parse_args()
+
+devices = [int(boardId, 0) for boardId in options.devices.split(",") if boardId]
+emulator.install(devices, options.loss, options.latency, not options.no_collisions, options.seed, irq=options.irq)
+sys.argv = [options.script] + options.args
+sys.path.insert(0, os.path.dirname(os.path.abspath(options.script)))
+runpy.run_path(options.script, run_name="__main__")
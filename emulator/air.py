@@ -0,0 +1,169 @@
+# Shared virtual air channel of the emulator.
+# Carries Enhanced ShockBurst packets between endpoints (virtual nRF24 chips and
+# virtual edge devices) with auto-ack and auto-retransmit, configurable packet loss,
+# extra latency and collisions of overlapping transmissions.
+# All emulator state is guarded by Air.lock, timed events run in one scheduler thread.
+from __future__ import absolute_import
+import heapq, os, random, select, threading, time
+
+DATA_RATE_BPS = {"1MBPS": 1000000, "2MBPS": 2000000, "250KBPS": 250000}
+SETTLING_TIME = 130 / 1000000.0
+
+# Addresses are kept as tuples of bytes in the order the chip stores them (LSB first),
+# addressKey converts an address given MSB first as in radioComm and the Arduino sketch
+def addressKey(msbFirst):
+    return tuple(reversed(list(msbFirst)))
+
+# Time on air of one packet: preamble, 5 byte address, 9 bit packet control field, payload and CRC
+def packetAirtime(payloadLen, dataRate, crcBytes):
+    return (8 * (1 + 5 + payloadLen + crcBytes) + 9) / float(DATA_RATE_BPS[dataRate])
+
+# One packet on its way, including all of its retransmissions
+class Transmission:
+    def __init__(self, sender, channel, address, payload, autoAck, ard, arc, dataRate, crcBytes, onDone, packetId):
+        self.sender = sender
+        self.channel = channel
+        self.address = address
+        self.payload = list(payload)
+        self.autoAck = autoAck
+        self.ard = ard
+        self.arc = arc
+        self.dataRate = dataRate
+        self.crcBytes = crcBytes
+        self.onDone = onDone
+        self.packetId = packetId
+        self.retransmits = 0
+
+    def airtime(self):
+        return packetAirtime(len(self.payload), self.dataRate, self.crcBytes)
+
+    def ackAirtime(self):
+        return packetAirtime(0, self.dataRate, self.crcBytes)
+
+class Air:
+    def __init__(self, loss=0.0, latency=0.0, collisions=True, seed=None):
+        self.loss = loss
+        self.latency = latency
+        self.collisions = collisions
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.events = []
+        self.sequence = 0
+        self.listeners = {}      # (channel, address) -> {endpoint: pipe}
+        self.registrations = {}  # endpoint -> list of (channel, address) keys it listens on
+        self.onAir = []          # (channel, start, end) of recent transmissions
+        self.nextPacketId = 0
+        self.stats = {"packets": 0, "delivered": 0, "lost": 0, "collisions": 0, "unheard": 0, "acks_lost": 0}
+        self.wakeRead, self.wakeWrite = os.pipe()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="EmulatorAir")
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Run fn(*args) delay sec from now in the scheduler thread, with the air lock held
+    def schedule(self, delay, fn, *args):
+        with self.lock:
+            self.sequence += 1
+            at = time.time() + delay
+            wake = not self.events or at < self.events[0][0]
+            heapq.heappush(self.events, (at, self.sequence, fn, args))
+        if wake:
+            os.write(self.wakeWrite, b"x")
+
+    def run(self):
+        while self.running:
+            self.runDue()
+            with self.lock:
+                timeout = None
+                if self.events:
+                    timeout = max(0, self.events[0][0] - time.time())
+            if select.select([self.wakeRead], [], [], timeout)[0]:
+                os.read(self.wakeRead, 4096)
+
+    # Run all events which are due. Also called on every SPI transfer, so the hub sees
+    # the state of the air as of the moment it looks
+    def runDue(self):
+        with self.lock:
+            while self.events and self.events[0][0] <= time.time():
+                (at, sequence, fn, args) = heapq.heappop(self.events)
+                fn(*args)
+
+    def stop(self):
+        self.running = False
+        os.write(self.wakeWrite, b"x")
+        self.thread.join()
+
+    # Replace the addresses endpoint listens on, addresses is {address: pipe}.
+    # An endpoint which is not listening passes an empty dictionary
+    def listen(self, endpoint, channel, addresses):
+        with self.lock:
+            for key in self.registrations.pop(endpoint, []):
+                receivers = self.listeners[key]
+                del receivers[endpoint]
+                if not receivers:
+                    del self.listeners[key]
+            keys = []
+            for address, pipe in addresses.items():
+                key = (channel, tuple(address))
+                self.listeners.setdefault(key, {})[endpoint] = pipe
+                keys.append(key)
+            if keys:
+                self.registrations[endpoint] = keys
+
+    # Send payload to address. ard/arc are the auto retransmit delay/count codes of SETUP_RETR.
+    # onDone(acked, retransmits) is called once the packet is acked or all retransmits failed
+    # (right after the packet is on the air if autoAck is off)
+    def transmit(self, sender, channel, address, payload, autoAck, ard, arc, dataRate, crcBytes, onDone):
+        with self.lock:
+            self.nextPacketId += 1
+            transmission = Transmission(sender, channel, tuple(address), payload, autoAck, ard, arc, \
+                                        dataRate, crcBytes, onDone, self.nextPacketId)
+            self.startAttempt(transmission, SETTLING_TIME)
+
+    def startAttempt(self, transmission, delay):
+        start = time.time() + delay
+        end = start + transmission.airtime()
+        self.onAir = [entry for entry in self.onAir if entry[2] > start - 0.01]
+        entry = (transmission.channel, start, end)
+        self.onAir.append(entry)
+        self.stats["packets"] += 1
+        self.schedule(end - time.time() + self.latency, self.deliver, transmission, entry)
+
+    def collided(self, entry):
+        if not self.collisions:
+            return False
+        for other in self.onAir:
+            if other is not entry and other[0] == entry[0] and other[1] < entry[2] and entry[1] < other[2]:
+                return True
+        return False
+
+    def deliver(self, transmission, entry):
+        acked = False
+        if self.collided(entry):
+            self.stats["collisions"] += 1
+        elif self.random.random() < self.loss:
+            self.stats["lost"] += 1
+        else:
+            receivers = self.listeners.get((transmission.channel, transmission.address), {})
+            if not receivers:
+                self.stats["unheard"] += 1
+            for endpoint, pipe in list(receivers.items()):
+                if endpoint is transmission.sender:
+                    continue
+                (accepted, ack) = endpoint.receive(pipe, transmission.payload, transmission.packetId)
+                if accepted:
+                    self.stats["delivered"] += 1
+                acked = acked or ack
+            if acked and transmission.autoAck and self.random.random() < self.loss:
+                self.stats["acks_lost"] += 1
+                acked = False
+
+        if not transmission.autoAck:
+            transmission.onDone(True, 0)
+        elif acked:
+            self.schedule(SETTLING_TIME + transmission.ackAirtime(), transmission.onDone, True, transmission.retransmits)
+        elif transmission.retransmits < transmission.arc:
+            transmission.retransmits += 1
+            self.startAttempt(transmission, 250 * (transmission.ard + 1) / 1000000.0)
+        else:
+            self.schedule(250 * (transmission.ard + 1) / 1000000.0, transmission.onDone, False, transmission.retransmits)
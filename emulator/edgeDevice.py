@@ -0,0 +1,180 @@
+# Virtual Arduino edge device, behaves like arduinoEdgeDevice.ino on the air:
+# listens on its own address (acked) and the broadcast address (not acked), polls
+# the radio every 50ms, executes the command, waits BOARD_ID*20ms and writes the reply
+# with 15 retries every 4ms. While busy it doesn't listen, like the sketch after stopListening()
+from __future__ import absolute_import
+import collections, time
+from emulator.air import addressKey
+
+CHANNEL = 0x78
+LOOP_DELAY = 0.05
+REPLY_SLOT = 0.02
+FIFO_DEPTH = 3
+READ_ALL_PINS = 0xFF
+FRAME_COMMAND = 0xB0
+FRAME_HEADER = 5
+FRAME_ITEM_SIZE = {1: 3, 2: 4}
+FEATURE_SEQUENCE = 0x01
+FEATURE_PULSE = 0x02
+DEDUP_WINDOW = 16
+PULSE_COMMAND = 0xA8
+PULSE_UNIT = 0.01
+
+# Board ids are added to the last address byte, see radioComm.MAX_DEVICE_ID
+MAX_BOARD_ID = 0xFF - 0xE0
+
+def intAddress(value):
+    return [(value >> (8 * i)) & 0xFF for i in range(4, -1, -1)]
+
+class VirtualEdgeDevice:
+    def __init__(self, air, boardId, loopPhase=None):
+        if not 0 < boardId <= MAX_BOARD_ID:
+            raise ValueError("Board id %s is out of range 1-%d" % (boardId, MAX_BOARD_ID))
+        self.air = air
+        self.boardId = boardId
+        self.readingAddress = addressKey(intAddress(0xE8E8F0F0E0 + boardId))
+        self.broadcastAddress = addressKey(intAddress(0xE8E8F0F0E0))
+        self.writingAddress = intAddress(0xABCDABCD71 + boardId)
+        self.broadcastReplyAddress = intAddress(0xABCDABCD71)
+        # The sketch checks the radio at the end of every delay(50), boards run with arbitrary phase
+        self.loopPhase = air.random.random() * LOOP_DELAY if loopPhase is None else loopPhase
+        self.rxFifo = []
+        self.lastPacketId = None
+        self.busy = False
+        self.dataRate = "250KBPS"
+        self.pins = {2: 0, 3: 0, 4: 0}
+        self.modes = {2: 1, 3: 1, 4: 1}  # pin -> 0 input, 1 output, as set up by setup()
+        self.pwm = {}          # pin -> last analog (pwm) write, 0-255
+        self.analog = {}       # analog pin -> value (0-1023) returned by analog reads
+        self.vcc = 5000        # mV
+        self.frameVersion = 2  # 0 - firmware without frames, the capabilities command and features
+        self.features = FEATURE_SEQUENCE | FEATURE_PULSE
+        # (sequence number, command, reply) of the last numbered commands executed
+        self.executed = collections.deque(maxlen=DEDUP_WINDOW)
+        self.replayed = 0      # numbered commands answered from executed
+        self.executionTime = 0 # time the commands of the packet being processed take (pulses)
+        self.actuations = []   # (time, pin, value) of every digital write
+        self.log = []          # (time, received packet, reply, reply acked)
+        self.startListening()
+
+    def startListening(self):
+        self.air.listen(self, CHANNEL, {self.readingAddress: 1, self.broadcastAddress: 2})
+
+    def stopListening(self):
+        self.air.listen(self, CHANNEL, {})
+
+    def receive(self, pipe, payload, packetId):
+        ack = pipe == 1
+        if len(self.rxFifo) >= FIFO_DEPTH:
+            return (False, False)
+        if ack and packetId == self.lastPacketId:
+            return (False, True)
+        self.lastPacketId = packetId
+        self.rxFifo.append(list(payload) + [0] * (5 - len(payload)))
+        if not self.busy:
+            self.busy = True
+            self.air.schedule(self.nextLoop(), self.process)
+        return (True, ack)
+
+    # Seconds until the sketch next calls radio.available()
+    def nextLoop(self):
+        elapsed = (time.time() - self.loopPhase) % LOOP_DELAY
+        return LOOP_DELAY - elapsed
+
+    def process(self):
+        received = self.rxFifo.pop(0)
+        self.stopListening()
+        (gatewayId, edgeDeviceId, commandCode) = received[:3]
+        if edgeDeviceId != self.boardId and edgeDeviceId != 0:
+            self.log.append((time.time(), received, None, None))
+            self.air.schedule(LOOP_DELAY, self.finish)
+            return
+
+        reply = [self.boardId, gatewayId]
+        self.executionTime = 0
+        (version, count) = received[3:5]
+        size = FRAME_ITEM_SIZE.get(version)
+        if (commandCode == FRAME_COMMAND and size and version <= self.frameVersion and
+                len(received) >= FRAME_HEADER + size * count):
+            reply += received[2:5]
+            for index in range(FRAME_HEADER, FRAME_HEADER + size * count, size):
+                item = received[index:index + size]
+                reply += self.executeOnce(item[3] if size == 4 else 0, *item[:3])
+        else:
+            sequence = received[5] if self.supports(FEATURE_SEQUENCE) and len(received) > 5 else 0
+            reply += self.executeOnce(sequence, *received[2:5])
+        address = self.broadcastReplyAddress if edgeDeviceId == 0 else self.writingAddress
+        self.air.schedule(self.executionTime + self.boardId * REPLY_SLOT, self.sendReply, received, reply, address)
+
+    # Whether the firmware has given FEATURE_* bit, old firmware has none
+    def supports(self, feature):
+        return bool(self.frameVersion and self.features & feature)
+
+    # Execute a command with a sequence number (not 0) only once, a retry gets the saved reply.
+    # Returns the last bytes of the reply, the sequence number is echoed after them
+    def executeOnce(self, sequence, commandCode, msb, lsb):
+        if not sequence:
+            return self.execute(commandCode, msb, lsb)
+        command = [commandCode, msb, lsb]
+        for (executedSequence, executedCommand, reply) in self.executed:
+            if executedSequence == sequence and executedCommand == command:
+                self.replayed += 1
+                return reply + [sequence]
+        reply = self.execute(commandCode, msb, lsb)
+        self.executed.append((sequence, command, reply))
+        return reply + [sequence]
+
+    # Execute one command, return the last three bytes of its reply
+    def execute(self, commandCode, msb, lsb):
+        if commandCode == 0xA0 and self.frameVersion:
+            self.executed.clear()
+            return [commandCode, self.frameVersion, self.features]
+        elif commandCode == 0xA1:
+            pass
+        elif commandCode == 0xA2:
+            self.modes[msb] = lsb
+        elif commandCode == 0xA3:
+            if msb == READ_ALL_PINS:
+                bits = sum(self.digitalRead(pin) << pin for pin in range(16))
+                return [commandCode, bits & 0xFF, bits >> 8]
+            return [commandCode, msb, self.digitalRead(msb)]
+        elif commandCode == 0xA4:
+            self.digitalWrite(msb, lsb)
+        elif commandCode == PULSE_COMMAND and self.supports(FEATURE_PULSE):
+            # The sketch delays between the writes, the reply goes out after the pulse
+            self.digitalWrite(msb, 1)
+            self.executionTime += lsb * PULSE_UNIT
+            self.digitalWrite(msb, 0)
+        elif commandCode == 0xA6:
+            self.pwm[msb] = lsb
+        elif commandCode in (0xA5, 0xA7):
+            value = self.analog.get(msb, 0) if commandCode == 0xA5 else self.vcc
+            return [commandCode, value & 0xFF, value >> 8]
+        else:
+            return [0xFF, 0xFF, 0xFF]
+        return [commandCode, msb, lsb]
+
+    def digitalWrite(self, pin, value):
+        self.pins[pin] = value
+        self.actuations.append((time.time() + self.executionTime, pin, value))
+
+    def digitalRead(self, pin):
+        return self.pins.get(pin, 0)
+
+    # Power cycle: all pins go back to 0, like after setup() of the sketch
+    def reboot(self):
+        for pin in self.pins:
+            self.pins[pin] = 0
+
+    def sendReply(self, received, reply, address):
+        def done(acked, retransmits):
+            self.log.append((time.time(), received, reply, acked))
+            self.finish()
+        self.air.transmit(self, CHANNEL, addressKey(address), reply, True, 15, 15, self.dataRate, 1, done)
+
+    def finish(self):
+        self.startListening()
+        if self.rxFifo:
+            self.air.schedule(0, self.process)
+        else:
+            self.busy = False
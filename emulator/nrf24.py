@@ -0,0 +1,226 @@
+# Virtual nRF24L01+ chip attached to the hub through the emulated spidev and GPIO.
+# Models the register map, 3 level TX and RX FIFOs, STATUS/IRQ flags, CE driven
+# PTX/PRX operation, dynamic payloads and auto-ack with auto-retransmit over the air
+from __future__ import absolute_import
+from emulator import GPIO
+
+CONFIG, EN_AA, EN_RXADDR, SETUP_AW, SETUP_RETR, RF_CH, RF_SETUP, STATUS, OBSERVE_TX, RPD = range(10)
+RX_ADDR_P0, RX_ADDR_P1, RX_ADDR_P2, RX_ADDR_P3, RX_ADDR_P4, RX_ADDR_P5, TX_ADDR = range(0x0A, 0x11)
+RX_PW_P0 = 0x11
+FIFO_STATUS = 0x17
+DYNPD = 0x1C
+FEATURE = 0x1D
+
+# Interrupt flags in STATUS, CONFIG has mask bits in the same positions
+RX_DR = 0x40
+TX_DS = 0x20
+MAX_RT = 0x10
+PWR_UP = 0x02
+PRIM_RX = 0x01
+
+FIFO_DEPTH = 3
+ADDRESS_REGISTERS = (RX_ADDR_P0, RX_ADDR_P1, TX_ADDR)
+
+def resetRegisters():
+    registers = dict((reg, [0]) for reg in range(0x1E))
+    registers.update({CONFIG: [0x08], EN_AA: [0x3F], EN_RXADDR: [0x03], SETUP_AW: [0x03], SETUP_RETR: [0x03],
+                      RF_CH: [0x02], RF_SETUP: [0x0E], STATUS: [0x0E], FIFO_STATUS: [0x11],
+                      RX_ADDR_P0: [0xE7] * 5, RX_ADDR_P1: [0xC2] * 5, RX_ADDR_P2: [0xC3], RX_ADDR_P3: [0xC4],
+                      RX_ADDR_P4: [0xC5], RX_ADDR_P5: [0xC6], TX_ADDR: [0xE7] * 5})
+    return registers
+
+class VirtualNRF24:
+    def __init__(self, air, cePin, irqPin=None):
+        self.air = air
+        self.cePin = cePin
+        self.irqPin = irqPin
+        self.registers = resetRegisters()
+        self.ce = False
+        self.txFifo = []
+        self.rxFifo = []          # (pipe, payload)
+        self.lastPacketIds = {}   # pipe -> id of the last packet received, to drop retransmitted duplicates
+        self.transmitting = False
+        self.irqLevel = GPIO.HIGH
+        if cePin:
+            GPIO.addOutputListener(cePin, self.setCE)
+        else:
+            self.ce = True
+        if irqPin:
+            GPIO.levels[irqPin] = GPIO.HIGH
+
+    def reg(self, reg):
+        return self.registers[reg][0]
+
+    def dataRate(self):
+        setup = self.reg(RF_SETUP)
+        if setup & 0x20:
+            return "250KBPS"
+        if setup & 0x08:
+            return "2MBPS"
+        return "1MBPS"
+
+    def crcBytes(self):
+        config = self.reg(CONFIG)
+        if not config & 0x08:
+            return 0
+        return 2 if config & 0x04 else 1
+
+    def status(self):
+        status = self.reg(STATUS) & (RX_DR | TX_DS | MAX_RT)
+        status |= (self.rxFifo[0][0] if self.rxFifo else 7) << 1
+        if len(self.txFifo) >= FIFO_DEPTH:
+            status |= 0x01
+        return status
+
+    def fifoStatus(self):
+        value = 0
+        if not self.rxFifo:
+            value |= 0x01
+        if len(self.rxFifo) >= FIFO_DEPTH:
+            value |= 0x02
+        if not self.txFifo:
+            value |= 0x10
+        if len(self.txFifo) >= FIFO_DEPTH:
+            value |= 0x20
+        return value
+
+    def setFlags(self, flags):
+        self.registers[STATUS] = [self.reg(STATUS) | flags]
+        self.updateIrq()
+
+    # IRQ is active low while any unmasked interrupt flag is set
+    def updateIrq(self):
+        if not self.irqPin:
+            return
+        active = self.reg(STATUS) & ~self.reg(CONFIG) & (RX_DR | TX_DS | MAX_RT)
+        level = GPIO.LOW if active else GPIO.HIGH
+        if level != self.irqLevel:
+            self.irqLevel = level
+            GPIO.drive(self.irqPin, level)
+
+    # One SPI transaction, returns the bytes clocked out by the chip
+    def transfer(self, values):
+        values = list(values)
+        with self.air.lock:
+            self.air.runDue()
+            cmd = values[0]
+            response = [self.status()] + [0] * (len(values) - 1)
+            if cmd < 0x20:
+                reg = cmd & 0x1F
+                if reg == STATUS:
+                    value = [self.status()]
+                elif reg == FIFO_STATUS:
+                    value = [self.fifoStatus()]
+                else:
+                    value = self.registers.get(reg, [0])
+                for i in range(1, len(values)):
+                    response[i] = value[i - 1] if i - 1 < len(value) else 0
+            elif cmd < 0x40:
+                self.writeRegister(cmd & 0x1F, values[1:])
+            elif cmd == 0x60:
+                # R_RX_PL_WID
+                if len(values) > 1:
+                    response[1] = len(self.rxFifo[0][1]) if self.rxFifo else 0
+            elif cmd == 0x61:
+                # R_RX_PAYLOAD
+                if self.rxFifo:
+                    (pipe, payload) = self.rxFifo.pop(0)
+                    for i in range(1, len(values)):
+                        response[i] = payload[i - 1] if i - 1 < len(payload) else 0
+            elif cmd == 0xA0 or cmd == 0xB0:
+                # W_TX_PAYLOAD, W_TX_PAYLOAD_NOACK
+                if len(self.txFifo) < FIFO_DEPTH:
+                    self.txFifo.append((values[1:], cmd == 0xB0))
+            elif cmd == 0xE1:
+                self.txFifo = []
+            elif cmd == 0xE2:
+                self.rxFifo = []
+            # ACTIVATE (0x50), W_ACK_PAYLOAD and NOP need no action on a nRF24L01+
+            return response
+
+    def writeRegister(self, reg, data):
+        if reg == STATUS:
+            # Writing 1 clears an interrupt flag
+            self.registers[STATUS] = [self.reg(STATUS) & ~(data[0] & (RX_DR | TX_DS | MAX_RT))]
+            self.updateIrq()
+            return
+        if reg in (OBSERVE_TX, RPD, FIFO_STATUS):
+            return
+        old = self.registers.get(reg, [0])
+        self.registers[reg] = list(data) + old[len(data):]
+        if reg in (CONFIG, EN_RXADDR, RF_CH) or RX_ADDR_P0 <= reg <= RX_ADDR_P5:
+            self.updateListening()
+        if reg == CONFIG:
+            self.updateIrq()
+
+    def setCE(self, level):
+        with self.air.lock:
+            rising = level and not self.ce
+            self.ce = bool(level)
+            if rising and self.reg(CONFIG) & PWR_UP and not self.reg(CONFIG) & PRIM_RX:
+                self.startTransmit()
+            self.updateListening()
+
+    def listening(self):
+        config = self.reg(CONFIG)
+        return self.ce and config & PWR_UP and config & PRIM_RX
+
+    # Pipe addresses as the air sees them, pipes 2-5 share the upper bytes of pipe 1
+    def pipeAddresses(self):
+        addresses = {}
+        enabled = self.reg(EN_RXADDR)
+        pipe1 = self.registers[RX_ADDR_P1]
+        for pipe in range(6):
+            if not enabled & (1 << pipe):
+                continue
+            if pipe < 2:
+                address = self.registers[RX_ADDR_P0 + pipe]
+            else:
+                address = [self.reg(RX_ADDR_P0 + pipe)] + pipe1[1:]
+            addresses[tuple(address)] = pipe
+        return addresses
+
+    def updateListening(self):
+        self.air.listen(self, self.reg(RF_CH), self.pipeAddresses() if self.listening() else {})
+
+    def startTransmit(self):
+        if self.transmitting or not self.txFifo:
+            return
+        (payload, noAck) = self.txFifo[0]
+        retr = self.reg(SETUP_RETR)
+        autoAck = bool(self.reg(EN_AA) & 0x01) and not noAck and (retr & 0x0F) > 0
+        self.transmitting = True
+        self.air.transmit(self, self.reg(RF_CH), self.registers[TX_ADDR], payload, autoAck, retr >> 4, retr & 0x0F, \
+                          self.dataRate(), self.crcBytes(), self.transmitDone)
+
+    def transmitDone(self, acked, retransmits):
+        self.transmitting = False
+        observe = self.reg(OBSERVE_TX)
+        lost = observe >> 4
+        if acked:
+            # The hub may have flushed the FIFO while the payload was on the air
+            if self.txFifo:
+                self.txFifo.pop(0)
+            self.setFlags(TX_DS)
+        else:
+            # Payload stays in the TX FIFO until flushed, like on the real chip
+            lost = min(15, lost + 1)
+            self.setFlags(MAX_RT)
+        self.registers[OBSERVE_TX] = [(lost << 4) | retransmits]
+
+    # Called by the air with a packet addressed to one of our pipes, returns (accepted, acked)
+    def receive(self, pipe, payload, packetId):
+        if len(self.rxFifo) >= FIFO_DEPTH:
+            return (False, False)
+        ack = bool(self.reg(EN_AA) & (1 << pipe))
+        if ack and self.lastPacketIds.get(pipe) == packetId:
+            # Retransmission of a packet whose ack got lost
+            return (False, True)
+        self.lastPacketIds[pipe] = packetId
+        if not self.reg(DYNPD) & (1 << pipe):
+            width = self.reg(RX_PW_P0 + pipe)
+            payload = (list(payload) + [0] * width)[:width]
+        self.rxFifo.append((pipe, list(payload)))
+        self.registers[RPD] = [1]
+        self.setFlags(RX_DR)
+        return (True, ack)
@@ -0,0 +1,33 @@
+# Stand-in for the spidev module: SpiDev talks to the virtual nRF24 chip of the emulator
+# attached to the opened bus/device and counts SPI transactions and bytes
+from __future__ import absolute_import
+import emulator
+
+class SpiDev:
+    def __init__(self, bus=None, device=None):
+        self.chip = None
+        self.transactions = 0
+        self.bytes = 0
+        self.max_speed_hz = 500000
+        self.mode = 0
+        if bus is not None:
+            self.open(bus, device)
+
+    def open(self, bus, device):
+        self.chip = emulator.hubRadio(bus, device)
+
+    def close(self):
+        self.chip = None
+
+    def xfer2(self, values):
+        self.transactions += 1
+        self.bytes += len(values)
+        return self.chip.transfer(values)
+
+    xfer = xfer2
+
+    def writebytes(self, values):
+        self.xfer2(values)
+
+    def readbytes(self, length):
+        return self.xfer2([0] * length)
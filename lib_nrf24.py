@@ -24,7 +24,10 @@
 #
 
 
+import os
+import select
 import sys
+import threading
 import time
 
 if __name__ == '__main__':
@@ -38,6 +41,36 @@ def _BV(x):
     return 1 << x
 
 
+# Event set from the GPIO edge callback thread and waited on by the radio user.
+# threading.Event.wait(timeout) polls in steps of up to 50ms on python 2, waiting
+# on a pipe with select() wakes the waiting thread as soon as the event is set.
+class IrqEvent:
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        self.lock = threading.Lock()
+        self.is_set = False
+
+    def set(self):
+        with self.lock:
+            if not self.is_set:
+                self.is_set = True
+                os.write(self.write_fd, b"x")
+
+    def clear(self):
+        with self.lock:
+            if self.is_set:
+                self.is_set = False
+                os.read(self.read_fd, 1)
+
+    # Returns True if the event was set before the timeout (seconds) expired
+    def wait(self, timeout):
+        return bool(select.select([self.read_fd], [], [], max(0, timeout))[0])
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+
 class NRF24:
     MAX_CHANNEL = 127
     MAX_PAYLOAD_SIZE = 32
@@ -176,6 +209,15 @@ class NRF24:
 
     child_payload_size = [RX_PW_P0, RX_PW_P1, RX_PW_P2, RX_PW_P3, RX_PW_P4, RX_PW_P5]
     child_pipe_enable = [ERX_P0, ERX_P1, ERX_P2, ERX_P3, ERX_P4, ERX_P5]
+    data_rate_bps = {BR_1MBPS: 1000000, BR_2MBPS: 2000000, BR_250KBPS: 250000}
+
+    # Registers which only change when we write them ourselves, with their width in bytes.
+    # Their values can be served from the shadow copy instead of a SPI read.
+    # STATUS, OBSERVE_TX, RPD and FIFO_STATUS are updated by the chip and are never shadowed.
+    shadow_registers = {CONFIG: 1, EN_AA: 1, EN_RXADDR: 1, SETUP_AW: 1, SETUP_RETR: 1, RF_CH: 1, RF_SETUP: 1,
+                        RX_ADDR_P0: 5, RX_ADDR_P1: 5, RX_ADDR_P2: 1, RX_ADDR_P3: 1, RX_ADDR_P4: 1, RX_ADDR_P5: 1,
+                        TX_ADDR: 5, RX_PW_P0: 1, RX_PW_P1: 1, RX_PW_P2: 1, RX_PW_P3: 1, RX_PW_P4: 1, RX_PW_P5: 1,
+                        DYNPD: 1, FEATURE: 1}
 
     GPIO = None
     spidev = None
@@ -195,6 +237,20 @@ class NRF24:
         self.dynamic_payloads_enabled = False #*< Whether dynamic payloads are enabled.
         self.ack_payload_length = 5 #*< Dynamic size of pending ack payload.
         self.pipe0_reading_address = None #*< Last address set on pipe 0 for reading.
+        self.shadow = None #*< Write-through copy of the configuration registers, None if disabled
+        self.shadow_debug = False #*< Cross-check every shadow read against the chip
+        self.irq_pin = 0 #*< GPIO pin wired to the IRQ line of the radio, 0 if not used
+        self.irq_event = None #*< Set on every falling edge of the IRQ line
+        self.irq_count = 0 #*< Number of interrupts seen
+        self.crc_length = NRF24.CRC_8 #*< Last CRC length set
+        self.retries = 0x03 #*< Last SETUP_RETR value set
+        self.last_write = None #*< Timing of the last write: elapsed and expected time (s), number of STATUS polls
+        self.write_stats = {"writes": 0, "failed": 0, "polls": 0, "time": 0.0} #*< Totals over all writes
+        # Preallocated SPI transfer buffers, indexed by transfer length (command byte included)
+        # so no list has to be built for every transaction. nop_buffers are filled with NOPs
+        # for reads and only their first (command) byte changes.
+        self.tx_buffers = [bytearray(n) for n in range(NRF24.MAX_PAYLOAD_SIZE + 2)]
+        self.nop_buffers = [bytearray([NRF24.NOP] * n) for n in range(NRF24.MAX_PAYLOAD_SIZE + 2)]
 
     def ce(self, level):
         if self.ce_pin == 0:
@@ -211,59 +267,98 @@ class NRF24:
 
 
     def read_register(self, reg, blen=1):
-        buf = [NRF24.R_REGISTER | ( NRF24.REGISTER_MASK & reg )]
-        for col in range(blen):
-            buf.append(NRF24.NOP)
+        # Serve configuration registers from the shadow copy when it's enabled
+        if self.shadow is not None:
+            value = self.shadow.get(reg)
+            if value is not None and blen <= len(value):
+                if self.shadow_debug:
+                    self.checkShadowRegister(reg)
+                if blen == 1:
+                    return value[0]
+                return value[0:blen]
+
+        return self.read_register_uncached(reg, blen)
+
+    # Always read the register over SPI. Reading a shadowed register this way
+    # also refreshes its shadow copy.
+    def read_register_uncached(self, reg, blen=1):
+        buf = self.nop_buffers[blen + 1]
+        buf[0] = NRF24.R_REGISTER | ( NRF24.REGISTER_MASK & reg )
 
         resp = self.spidev.xfer2(buf)
+        if self.shadow is not None and blen == NRF24.shadow_registers.get(reg):
+            self.shadow[reg] = list(resp[1:blen + 1])
+
         if blen == 1:
             return resp[1]
 
         return resp[1:blen + 1]
 
+    # value is either an int (written MSB first, up to 4 bytes) or a list/bytes/bytearray
+    # given MSB first, which is written LSB first as the chip expects it
     def write_register(self, reg, value, length=-1):
-        buf = [NRF24.W_REGISTER | ( NRF24.REGISTER_MASK & reg )]
-        ###if isinstance(value, (int, long)):   # ng for python3. but value should never be long anyway
         if isinstance(value, int):
             if length < 0:
                 length = 1
 
             length = min(4, length)
-            for i in range(length):
-                buf.insert(1, int(value & 0xff))
+            buf = self.tx_buffers[length + 1]
+            for i in range(length, 0, -1):
+                buf[i] = value & 0xff
                 value >>= 8
 
-        elif isinstance(value, list):
+        elif isinstance(value, (list, bytes, bytearray)):
             if length < 0:
                 length = len(value)
 
-            for i in range(min(len(value), length)):
-                buf.append(int(value[len(value) - i - 1] & 0xff))
+            length = min(len(value), length)
+            buf = self.tx_buffers[length + 1]
+            last = len(value) - 1
+            for i in range(length):
+                buf[i + 1] = value[last - i] & 0xff
         else:
             raise Exception("Value must be int or list")
 
+        buf[0] = NRF24.W_REGISTER | ( NRF24.REGISTER_MASK & reg )
+
+        # Write-through: keep the shadow copy in step with what the chip now holds.
+        # A short write of a multi-byte register only updates its first (LSB) bytes.
+        if self.shadow is not None and reg in NRF24.shadow_registers:
+            value = self.shadow.get(reg)
+            if value is None or len(value) < length:
+                value = list(buf[1:])
+            else:
+                value = list(buf[1:]) + value[length:]
+            self.shadow[reg] = value
+
         return self.spidev.xfer2(buf)[0]
 
 
+    # buf can be bytes, bytearray or a list of ints or chars
     def write_payload(self, buf):
         data_len = min(self.payload_size, len(buf))
         blank_len = 0
         if not self.dynamic_payloads_enabled:
             blank_len = self.payload_size - data_len
 
-        txbuffer = [NRF24.W_TX_PAYLOAD]
-        for n in buf:
-            t = type(n)
-            if t is str:
-                txbuffer.append(ord(n))
-            elif t is int:
-                txbuffer.append(n)
-            else:
-                raise Exception("Only ints and chars are supported: Found " + str(t))
-
-        if blank_len != 0:
-            blank = [0x00 for i in range(blank_len)]
-            txbuffer.extend(blank)
+        txbuffer = self.tx_buffers[1 + data_len + blank_len]
+        txbuffer[0] = NRF24.W_TX_PAYLOAD
+        if isinstance(buf, (bytes, bytearray)):
+            # Raw bytes are copied as is, no per element conversion
+            txbuffer[1:1 + data_len] = buf if data_len == len(buf) else buf[:data_len]
+        else:
+            for i in range(data_len):
+                n = buf[i]
+                t = type(n)
+                if t is int:
+                    txbuffer[1 + i] = n
+                elif t is str:
+                    txbuffer[1 + i] = ord(n)
+                else:
+                    raise Exception("Only ints and chars are supported: Found " + str(t))
+
+        for i in range(1 + data_len, 1 + data_len + blank_len):
+            txbuffer[i] = 0x00
 
         return self.spidev.xfer2(txbuffer)
 
@@ -275,7 +370,7 @@ class NRF24:
         if not self.dynamic_payloads_enabled:
             blank_len = self.payload_size - data_len
 
-        txbuffer = [NRF24.NOP for i in range(0, blank_len + data_len + 1)]
+        txbuffer = self.nop_buffers[blank_len + data_len + 1]
         txbuffer[0] = NRF24.R_RX_PAYLOAD
 
         payload = self.spidev.xfer2(txbuffer)
@@ -283,14 +378,20 @@ class NRF24:
         buf.extend(payload[1:data_len + 1])
         return data_len
 
+    # Send one byte command, return STATUS
+    def command(self, cmd):
+        buf = self.tx_buffers[1]
+        buf[0] = cmd
+        return self.spidev.xfer2(buf)[0]
+
     def flush_rx(self):
-        return self.spidev.xfer2([NRF24.FLUSH_RX])[0]
+        return self.command(NRF24.FLUSH_RX)
 
     def flush_tx(self):
-        return self.spidev.xfer2([NRF24.FLUSH_TX])[0]
+        return self.command(NRF24.FLUSH_TX)
 
     def get_status(self):
-        return self.spidev.xfer2([NRF24.NOP])[0]
+        return self.command(NRF24.NOP)
 
     def print_status(self, status):
         status_str = "STATUS\t = 0x{0:02x} RX_DR={1:x} TX_DS={2:x} MAX_RT={3:x} RX_P_NO={4:x} TX_FULL={5:x}".format(
@@ -332,6 +433,52 @@ class NRF24:
         print ("")
 
 
+    # Keep a write-through copy of the configuration registers so that read-modify-write
+    # mutators don't need a SPI read. Call after begin(). With debug=True every shadow read
+    # is cross-checked against the chip and a mismatch raises an exception.
+    def enableShadow(self, debug=False):
+        self.shadow = {}
+        self.shadow_debug = debug
+        self.resyncShadow()
+
+    def disableShadow(self):
+        self.shadow = None
+        self.shadow_debug = False
+
+    # Reload the shadow copy from the chip, e.g. after the radio may have been reset
+    def resyncShadow(self):
+        if self.shadow is None:
+            return
+        for reg, blen in NRF24.shadow_registers.items():
+            self.read_register_uncached(reg, blen)
+
+    # Compare the shadow copy with the chip. Returns a list of (register, shadow, chip) tuples
+    # for all registers which differ, the list is empty if the shadow is consistent.
+    def verifyShadow(self):
+        mismatches = []
+        if self.shadow is None:
+            return mismatches
+        for reg, blen in sorted(NRF24.shadow_registers.items()):
+            mismatch = self.compareShadowRegister(reg)
+            if mismatch:
+                mismatches.append(mismatch)
+        return mismatches
+
+    def compareShadowRegister(self, reg):
+        blen = NRF24.shadow_registers[reg]
+        expected = self.shadow.get(reg)
+        buf = self.nop_buffers[blen + 1]
+        buf[0] = NRF24.R_REGISTER | ( NRF24.REGISTER_MASK & reg )
+        actual = list(self.spidev.xfer2(buf)[1:blen + 1])
+        if expected is not None and list(expected) != actual:
+            return (reg, list(expected), actual)
+        return None
+
+    def checkShadowRegister(self, reg):
+        mismatch = self.compareShadowRegister(reg)
+        if mismatch:
+            raise Exception("Shadow register 0x%02x is out of sync: shadow=%s chip=%s" % mismatch)
+
     def setChannel(self, channel):
         self.channel = min(max(0, channel), NRF24.MAX_CHANNEL)
         self.write_register(NRF24.RF_CH, self.channel)
@@ -381,7 +528,7 @@ class NRF24:
         # Set 1500uS (minimum for 32B payload in ESB@250KBPS) timeouts, to make testing a little easier
         # WARNING: If this is ever lowered, either 250KBS mode with AA is broken or maximum packet
         # sizes must never be used. See documentation for a more complete explanation.
-        self.write_register(NRF24.SETUP_RETR, (0b0100 << NRF24.ARD) | 0b1111)
+        self.setRetries(0b0100, 0b1111)
 
         # Restore our default PA level
         self.setPALevel(NRF24.PA_MAX)
@@ -417,10 +564,47 @@ class NRF24:
         self.flush_tx()
 
     def end(self):
+        self.disableIrq()
         if self.spidev:
             self.spidev.close()
             self.spidev = None
 
+    # The radio pulls its (active low) IRQ line down when RX_DR, TX_DS or MAX_RT gets set.
+    # If the line is wired to a GPIO pin, callers can sleep in waitForIrq() instead of
+    # polling the STATUS register over SPI.
+    def enableIrq(self, irq_pin):
+        self.irq_pin = irq_pin
+        self.irq_event = IrqEvent()
+        self.GPIO.setup(irq_pin, self.GPIO.IN, pull_up_down=self.GPIO.PUD_UP)
+        self.GPIO.add_event_detect(irq_pin, self.GPIO.FALLING, callback=self.irqCallback)
+
+    def disableIrq(self):
+        if not self.irq_pin:
+            return
+        self.GPIO.remove_event_detect(self.irq_pin)
+        self.irq_event.close()
+        self.irq_pin = 0
+        self.irq_event = None
+
+    # Called by GPIO from its own thread on a falling edge of the IRQ line
+    def irqCallback(self, channel):
+        self.irq_count += 1
+        self.irq_event.set()
+
+    # Forget interrupts seen so far. Call before checking the STATUS register,
+    # so an event which happens after the check is not missed by waitForIrq()
+    def clearIrq(self):
+        if self.irq_pin:
+            self.irq_event.clear()
+
+    # Sleep until the IRQ line fires or timeout (seconds) expires.
+    # Returns True if an interrupt happened
+    def waitForIrq(self, timeout):
+        if not self.irq_pin:
+            time.sleep(timeout)
+            return False
+        return self.irq_event.wait(timeout)
+
     def startListening(self):
         self.write_register(NRF24.CONFIG, self.read_register(NRF24.CONFIG) | _BV(NRF24.PWR_UP) | _BV(NRF24.PRIM_RX))
         self.write_register(NRF24.STATUS, _BV(NRF24.RX_DR) | _BV(NRF24.TX_DS) | _BV(NRF24.MAX_RT))
@@ -435,10 +619,13 @@ class NRF24:
         # wait for the radio to come up (130us actually only needed)
         time.sleep(130 / 1000000.0)
 
-    def stopListening(self):
+    # Keep flush_rx False to hold on to packets already received, e.g. while sending
+    # to several devices before collecting their replies
+    def stopListening(self, flush_rx=True):
         self.ce(NRF24.LOW)
         self.flush_tx()
-        self.flush_rx()
+        if flush_rx:
+            self.flush_rx()
 
     def powerDown(self):
         self.write_register(NRF24.CONFIG, self.read_register(NRF24.CONFIG) & ~_BV(NRF24.PWR_UP))
@@ -450,16 +637,35 @@ class NRF24:
     def write(self, buf):
         # Begin the write
         self.startWrite(buf)
-
-        timeout = self.getMaxTimeout() #s to wait for timeout
         sent_at = time.time()
 
+        timeout = self.getMaxTimeout() #s to wait for timeout
+        payload_len = self.payload_size
+        if self.dynamic_payloads_enabled:
+            payload_len = min(self.payload_size, len(buf))
+
+        # Nothing can happen before the packet and its ack have been on the air, so sleep until then
+        min_time = self.getMinWriteTime(payload_len)
+        time.sleep(min_time)
+
+        # Then wait for the interrupt or poll with growing intervals, but no less often than
+        # once per retransmission
+        interval = 50 / 1000000.0
+        max_interval = self.getRetransmitPeriod(payload_len)
+        polls = 0
         while True:
             #status = self.read_register(NRF24.OBSERVE_TX, 1)
+            self.clearIrq()
             status = self.get_status()
-            if (status & (_BV(NRF24.TX_DS) | _BV(NRF24.MAX_RT))) or (time.time() - sent_at > timeout ):
+            polls += 1
+            elapsed = time.time() - sent_at
+            if (status & (_BV(NRF24.TX_DS) | _BV(NRF24.MAX_RT))) or (elapsed > timeout ):
                 break
-            time.sleep(10 / 1000000.0)
+            if self.irq_pin:
+                self.waitForIrq(timeout - elapsed)
+            else:
+                time.sleep(interval)
+                interval = min(interval * 2, max_interval)
         #obs = self.read_register(NRF24.OBSERVE_TX)
         #self.print_observe_tx(obs)
         #self.print_status(status)
@@ -470,6 +676,14 @@ class NRF24:
         result = what['tx_ok']
         if what['tx_fail']:
             self.flush_tx();    # bl  - dont jam up the fifo
+
+        elapsed = time.time() - sent_at
+        self.last_write = {"elapsed": elapsed, "min_time": min_time, "polls": polls}
+        self.write_stats["writes"] += 1
+        self.write_stats["polls"] += polls
+        self.write_stats["time"] += elapsed
+        if not result:
+            self.write_stats["failed"] += 1
         # Handle the ack packet
         if what['rx_ready']:
             self.ack_payload_length = self.getDynamicPayloadSize()
@@ -497,7 +711,9 @@ class NRF24:
 
 
     def getDynamicPayloadSize(self):
-        return self.spidev.xfer2([NRF24.R_RX_PL_WID, NRF24.NOP])[1]
+        buf = self.nop_buffers[2]
+        buf[0] = NRF24.R_RX_PL_WID
+        return self.spidev.xfer2(buf)[1]
 
     def available(self, pipe_num=None):
         if not pipe_num:
@@ -520,7 +736,9 @@ class NRF24:
 
                 # ??? Should this REALLY be cleared now?  Or wait until we
                 # actually READ the payload?
-        self.write_register(NRF24.STATUS, _BV(NRF24.RX_DR))
+        # Only spend a SPI transaction on clearing the flag if it's actually set
+        if status & _BV(NRF24.RX_DR):
+            self.write_register(NRF24.STATUS, _BV(NRF24.RX_DR))
 
         # Handle ack payload receipt
         if status & _BV(NRF24.TX_DS):
@@ -581,19 +799,24 @@ class NRF24:
 
     def closeReadingPipe(self, pipe):
         self.write_register(NRF24.EN_RXADDR,
-            self.read_register(EN_RXADDR) & ~_BV(NRF24.child_pipe_enable[pipe]))
+            self.read_register(NRF24.EN_RXADDR) & ~_BV(NRF24.child_pipe_enable[pipe]))
 
 
     def toggle_features(self):
         buf = [NRF24.ACTIVATE, 0x73]
         self.spidev.xfer2(buf)
 
+        # Feature registers have just become (in)accessible, don't trust their shadow copies
+        if self.shadow is not None:
+            self.shadow.pop(NRF24.FEATURE, None)
+            self.shadow.pop(NRF24.DYNPD, None)
+
     def enableDynamicPayloads(self):
         # Enable dynamic payload throughout the system
         self.write_register(NRF24.FEATURE, self.read_register(NRF24.FEATURE) | _BV(NRF24.EN_DPL))
 
         # If it didn't work, the features are not enabled
-        if not self.read_register(NRF24.FEATURE):
+        if not self.read_register_uncached(NRF24.FEATURE):
             # So enable them and try again
             self.toggle_features()
             self.write_register(NRF24.FEATURE, self.read_register(NRF24.FEATURE) | _BV(NRF24.EN_DPL))
@@ -614,7 +837,7 @@ class NRF24:
                             self.read_register(NRF24.FEATURE) | _BV(NRF24.EN_ACK_PAY) | _BV(NRF24.EN_DPL))
 
         # If it didn't work, the features are not enabled
-        if not self.read_register(NRF24.FEATURE):
+        if not self.read_register_uncached(NRF24.FEATURE):
             # So enable them and try again
             self.toggle_features()
             self.write_register(NRF24.FEATURE,
@@ -719,10 +942,12 @@ class NRF24:
         self.write_register(NRF24.RF_SETUP, setup)
 
         # Verify our result
-        if self.read_register(NRF24.RF_SETUP) == setup:
+        if self.read_register_uncached(NRF24.RF_SETUP) == setup:
             result = True
         else:
             self.wide_band = False
+        if result:
+            self.data_rate = speed
         return result
 
     def getDataRate(self):
@@ -740,6 +965,7 @@ class NRF24:
 
 
     def setCRCLength(self, length):
+        self.crc_length = length
         config = self.read_register(NRF24.CONFIG) & ~( _BV(NRF24.CRC_16) | _BV(NRF24.CRC_ENABLED))
 
         if length == NRF24.CRC_DISABLED:
@@ -768,20 +994,131 @@ class NRF24:
         return result
 
     def disableCRC(self):
+        self.crc_length = NRF24.CRC_DISABLED
         disable = self.read_register(NRF24.CONFIG) & ~_BV(NRF24.EN_CRC)
         self.write_register(NRF24.CONFIG, disable)
 
     def setRetries(self, delay, count):
         # see specs. Delay code below 5 can conflict with some ACK lengths
         # and count should be set = 0 for non-ACK modes
-        self.write_register(NRF24.SETUP_RETR, (delay & 0xf) << NRF24.ARD | (count & 0xf))
+        self.retries = (delay & 0xf) << NRF24.ARD | (count & 0xf)
+        self.write_register(NRF24.SETUP_RETR, self.retries)
 
     def getRetries(self):
         return self.read_register(NRF24.SETUP_RETR)
 
     def getMaxTimeout(self):        # seconds
-        retries = self.getRetries()
+        retries = self.retries
         tout = (((250+(250*((retries& 0xf0)>>4 ))) * (retries & 0x0f)) / 1000000.0 * 2) + 0.008
         # Fudged up to about double Barraca's calculation
         # Was too short & was timeing out wrongly.    BL
         return tout
+
+    # Time on air (seconds) of one Enhanced ShockBurst packet with payload_len bytes:
+    # preamble, 5 byte address, 9 bit packet control field, payload and CRC
+    def getPacketAirtime(self, payload_len):
+        crc_bytes = 2
+        if self.crc_length == NRF24.CRC_DISABLED:
+            crc_bytes = 0
+        elif self.crc_length == NRF24.CRC_8:
+            crc_bytes = 1
+        bits = 8 * (1 + 5 + payload_len + crc_bytes) + 9
+        return bits / float(NRF24.data_rate_bps[self.data_rate])
+
+    # Earliest time a write can complete: TX settling, the packet itself,
+    # RX turnaround and the empty auto-ack packet
+    def getMinWriteTime(self, payload_len):
+        return 2 * 130 / 1000000.0 + self.getPacketAirtime(payload_len) + self.getPacketAirtime(0)
+
+    # Time between two retransmissions of the same packet
+    def getRetransmitPeriod(self, payload_len):
+        auto_retransmit_delay = 250 * (((self.retries >> NRF24.ARD) & 0xf) + 1) / 1000000.0
+        return auto_retransmit_delay + 130 / 1000000.0 + self.getPacketAirtime(payload_len)
+
+    # Program a whole set of configuration registers at once. config is a dictionary with any of
+    #   channel, data_rate, pa_level, crc_length, retries (delay, count), auto_ack (bool),
+    #   reading_pipes ({pipe: address}), writing_address
+    # Settings sharing a register (data rate and PA level, CRC and power) are merged into one
+    # write and registers which already hold the wanted value are skipped, so this costs at
+    # most one SPI transaction per changed register. Returns the number of registers written.
+    def applyConfig(self, config):
+        # Current value of every register we may touch: from the shadow copy if enabled
+        current = {}
+        def get(reg):
+            if reg not in current:
+                value = self.read_register(reg, NRF24.shadow_registers[reg])
+                current[reg] = list(value) if isinstance(value, list) else [value]
+            return current[reg]
+        wanted = {}
+        def set_bits(reg, mask, bits):
+            value = wanted.get(reg, get(reg))[0]
+            wanted[reg] = [(value & ~mask) | bits]
+
+        if "channel" in config:
+            self.channel = min(max(0, config["channel"]), NRF24.MAX_CHANNEL)
+            wanted[NRF24.RF_CH] = [self.channel]
+
+        if "data_rate" in config:
+            speed = config["data_rate"]
+            bits = 0
+            if speed == NRF24.BR_250KBPS:
+                bits = _BV(NRF24.RF_DR_LOW)
+            elif speed == NRF24.BR_2MBPS:
+                bits = _BV(NRF24.RF_DR_HIGH)
+            set_bits(NRF24.RF_SETUP, _BV(NRF24.RF_DR_LOW) | _BV(NRF24.RF_DR_HIGH), bits)
+            self.data_rate = speed
+            self.wide_band = speed == NRF24.BR_2MBPS
+
+        if "pa_level" in config:
+            level = config["pa_level"]
+            bits = _BV(NRF24.RF_PWR_LOW) | _BV(NRF24.RF_PWR_HIGH)
+            if level == NRF24.PA_HIGH:
+                bits = _BV(NRF24.RF_PWR_HIGH)
+            elif level == NRF24.PA_LOW:
+                bits = _BV(NRF24.RF_PWR_LOW)
+            elif level == NRF24.PA_MIN:
+                bits = 0
+            set_bits(NRF24.RF_SETUP, _BV(NRF24.RF_PWR_LOW) | _BV(NRF24.RF_PWR_HIGH), bits)
+
+        if "crc_length" in config:
+            self.crc_length = config["crc_length"]
+            bits = 0
+            if self.crc_length == NRF24.CRC_8:
+                bits = _BV(NRF24.EN_CRC)
+            elif self.crc_length != NRF24.CRC_DISABLED:
+                bits = _BV(NRF24.EN_CRC) | _BV(NRF24.CRCO)
+            set_bits(NRF24.CONFIG, _BV(NRF24.EN_CRC) | _BV(NRF24.CRCO), bits)
+
+        if "retries" in config:
+            (delay, count) = config["retries"]
+            self.retries = (delay & 0xf) << NRF24.ARD | (count & 0xf)
+            wanted[NRF24.SETUP_RETR] = [self.retries]
+
+        if "auto_ack" in config:
+            wanted[NRF24.EN_AA] = [0b111111 if config["auto_ack"] else 0]
+
+        for pipe, address in sorted(config.get("reading_pipes", {}).items()):
+            if pipe == 0:
+                self.pipe0_reading_address = address
+            # Addresses are given MSB first, the chip holds them LSB first.
+            # For pipes 2-5 only the LSB is stored.
+            address = list(reversed(address))
+            if pipe >= 2:
+                address = address[0:1]
+            wanted[NRF24.child_pipe[pipe]] = address
+            wanted[NRF24.child_payload_size[pipe]] = [self.payload_size]
+            set_bits(NRF24.EN_RXADDR, 0, _BV(NRF24.child_pipe_enable[pipe]))
+
+        if "writing_address" in config:
+            address = list(reversed(config["writing_address"]))
+            wanted[NRF24.RX_ADDR_P0] = address
+            wanted[NRF24.TX_ADDR] = address
+            wanted[NRF24.RX_PW_P0] = [min(self.payload_size, NRF24.MAX_PAYLOAD_SIZE)]
+
+        written = 0
+        for reg, value in sorted(wanted.items()):
+            if value != get(reg)[0:len(value)]:
+                # write_register takes MSB first values
+                self.write_register(reg, list(reversed(value)))
+                written += 1
+        return written
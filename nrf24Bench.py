@@ -0,0 +1,213 @@
+#!/usr/bin/python
+# Microbenchmark of SPI traffic generated by lib_nrf24.NRF24
+# Runs the radio against a fake spidev which models the nRF24 register file and counts
+# SPI transactions and bytes, so it doesn't need any hardware. Also checks that the register
+# shadow copy stays consistent with the register file.
+# Usage: python nrf24Bench.py [number_of_packets]
+import sys
+import time
+import timeit
+from lib_nrf24 import NRF24
+
+
+# Fake spidev.SpiDev: register file, STATUS flags and feature activation of the nRF24.
+# Every payload written is immediately reported as sent (TX_DS)
+class CountingSpiDev:
+    def __init__(self):
+        self.registers = dict((reg, [0]) for reg in range(0x1E))
+        # Pipe addresses reset to E7E7E7E7E7, other registers to 0
+        for reg, width in NRF24.shadow_registers.items():
+            self.registers[reg] = [0xE7] * width if width > 1 else [0]
+        self.registers[NRF24.CONFIG] = [0x08]
+        self.registers[NRF24.EN_RXADDR] = [0x03]
+        self.registers[NRF24.STATUS] = [0x0E]
+        self.features_active = False
+        self.transactions = 0
+        self.bytes = 0
+
+    def open(self, bus, device):
+        pass
+
+    def close(self):
+        pass
+
+    def xfer2(self, buf):
+        self.transactions += 1
+        self.bytes += len(buf)
+        cmd = buf[0]
+        status = self.registers[NRF24.STATUS][0]
+        if cmd & 0xE0 == NRF24.R_REGISTER:
+            value = self.registers[cmd & NRF24.REGISTER_MASK]
+            return [status] + [value[i] if i < len(value) else 0 for i in range(len(buf) - 1)]
+        if cmd & 0xE0 == NRF24.W_REGISTER:
+            reg = cmd & NRF24.REGISTER_MASK
+            data = list(buf[1:])
+            if reg == NRF24.STATUS:
+                # Writing 1 clears the interrupt flags
+                self.registers[reg] = [status & ~(data[0] & 0x70)]
+            elif reg in (NRF24.DYNPD, NRF24.FEATURE) and not self.features_active:
+                pass
+            else:
+                self.registers[reg] = data + self.registers[reg][len(data):]
+            return [status] + [0] * len(data)
+        if cmd == NRF24.ACTIVATE:
+            self.features_active = not self.features_active
+        elif cmd == NRF24.W_TX_PAYLOAD:
+            self.registers[NRF24.STATUS] = [status | (1 << NRF24.TX_DS)]
+        return [status] + [0] * (len(buf) - 1)
+
+
+class FakeGPIO:
+    OUT = 0
+    LOW = 0
+    HIGH = 1
+    RPI_REVISION = 3
+
+    @staticmethod
+    def setup(pin, mode):
+        pass
+
+    @staticmethod
+    def output(pin, value):
+        pass
+
+
+READING_ADDRESS = [0xAB, 0xCD, 0xAB, 0xCD, 0x74]
+WRITING_ADDRESS = [0xE8, 0xE8, 0xF0, 0xF0, 0xE3]
+
+
+def configureOneByOne(radio):
+    radio.setChannel(0x78)
+    radio.setDataRate(NRF24.BR_250KBPS)
+    radio.setPALevel(NRF24.PA_MAX)
+    radio.setCRCLength(NRF24.CRC_8)
+    radio.setRetries(15, 15)
+    radio.setAutoAck(True)
+
+
+def configureBatched(radio):
+    radio.applyConfig({"channel": 0x78, "data_rate": NRF24.BR_250KBPS, "pa_level": NRF24.PA_MAX,
+                       "crc_length": NRF24.CRC_8, "retries": (15, 15), "auto_ack": True})
+
+
+# What radioComm.sendMessage does for every packet
+def sendOneByOne(radio, packet):
+    radio.stopListening()
+    radio.openReadingPipe(1, READING_ADDRESS)
+    radio.openWritingPipe(WRITING_ADDRESS)
+    radio.write(packet)
+    radio.startListening()
+
+
+def sendBatched(radio, packet):
+    radio.stopListening()
+    radio.applyConfig({"reading_pipes": {1: READING_ADDRESS}, "writing_address": WRITING_ADDRESS})
+    radio.write(packet)
+    radio.startListening()
+
+
+# Run one scenario, return SPI transactions and bytes spent on configuration and per packet
+def runScenario(name, shadow, configure, send, packets, payload):
+    spi = CountingSpiDev()
+    radio = NRF24(FakeGPIO, spi)
+    radio.begin(0, 0)
+    if shadow:
+        radio.enableShadow()
+
+    spi.transactions = spi.bytes = 0
+    configure(radio)
+    radio.enableDynamicPayloads()
+    radio.powerUp()
+    setup = (spi.transactions, spi.bytes)
+
+    spi.transactions = spi.bytes = 0
+    for i in range(packets):
+        send(radio, payload)
+    return {"name": name, "setup_transactions": setup[0], "setup_bytes": setup[1],
+            "packet_transactions": float(spi.transactions) / packets, "packet_bytes": float(spi.bytes) / packets}
+
+
+# Run every mutator which updates a shadowed register with the shadow in debug mode (a shadow
+# read which differs from the chip raises), then verify the whole copy. Also checks that a
+# register changed behind the driver's back is reported and fixed by resyncShadow().
+# Returns a list of problems, empty if the shadow is consistent
+def checkShadow(packets):
+    spi = CountingSpiDev()
+    radio = NRF24(FakeGPIO, spi)
+    radio.begin(0, 0)
+    radio.enableShadow(debug=True)
+    problems = []
+    try:
+        configureOneByOne(radio)
+        radio.enableDynamicPayloads()
+        radio.enableAckPayload()
+        radio.setPayloadSize(32)
+        radio.powerUp()
+        for i in range(packets):
+            sendOneByOne(radio, bytearray([1, 3, 0xA4, 3, i % 2]))
+            sendBatched(radio, bytearray([1, 3, 0xA4, 3, i % 2]))
+        radio.setAutoAckPipe(0, False)
+        radio.setAutoAckPipe(0, True)
+        radio.closeReadingPipe(1)
+        radio.powerDown()
+    except Exception as e:
+        problems.append("shadow read differs from the chip: %s" % e)
+    problems.extend("register 0x%02X: shadow %s, chip %s" % mismatch for mismatch in radio.verifyShadow())
+
+    # A chip reset behind the driver's back
+    spi.registers[NRF24.CONFIG] = [0x08]
+    if not radio.verifyShadow():
+        problems.append("changed CONFIG not reported by verifyShadow")
+    radio.resyncShadow()
+    if radio.verifyShadow():
+        problems.append("resyncShadow didn't fix the shadow")
+    return problems
+
+
+# Python time spent building SPI buffers, with SPI itself reduced to a no-op
+def timeBufferHandling(repeat=20000):
+    class NullSpiDev:
+        result = [0] * 34
+
+        def xfer2(self, buf):
+            return self.result
+
+    radio = NRF24(FakeGPIO, NullSpiDev())
+    radio.dynamic_payloads_enabled = True
+    radio.payload_size = 32
+    results = {}
+    for name, stmt in [("write_register(int)", lambda: radio.write_register(NRF24.RF_CH, 0x78)),
+                       ("write_register(address)", lambda: radio.write_register(NRF24.TX_ADDR, WRITING_ADDRESS)),
+                       ("read_register", lambda: radio.read_register(NRF24.CONFIG)),
+                       ("write_payload(list)", lambda: radio.write_payload([1, 3, 0xA4, 3, 1])),
+                       ("write_payload(bytearray)", lambda: radio.write_payload(bytearray([1, 3, 0xA4, 3, 1]))),
+                       ("write_payload(32 bytes)", lambda: radio.write_payload(bytearray(32)))]:
+        results[name] = 1000000.0 * min(timeit.repeat(stmt, number=repeat, repeat=3)) / repeat
+    return results
+
+
+if __name__ == '__main__':
+    packets = 100
+    if len(sys.argv) > 1:
+        packets = int(sys.argv[1])
+    payload = bytearray([1, 3, 0xA4, 3, 1])
+
+    print("SPI traffic, %d packets of %d bytes" % (packets, len(payload)))
+    print("%-30s %12s %12s %14s %14s" % ("scenario", "setup xfers", "setup bytes", "xfers/packet", "bytes/packet"))
+    for args in [("no shadow, one by one", False, configureOneByOne, sendOneByOne),
+                 ("shadow, one by one", True, configureOneByOne, sendOneByOne),
+                 ("shadow, applyConfig", True, configureBatched, sendBatched)]:
+        result = runScenario(args[0], args[1], args[2], args[3], packets, payload)
+        print("%-30s %12d %12d %14.1f %14.1f" % (result["name"], result["setup_transactions"], result["setup_bytes"],
+                                                 result["packet_transactions"], result["packet_bytes"]))
+
+    print("\nPython time per call, SPI excluded")
+    for name, usec in sorted(timeBufferHandling().items()):
+        print("%-30s %8.2f us" % (name, usec))
+
+    problems = checkShadow(packets)
+    print("\nShadow consistent with the register file: %s" % ("ok" if not problems else "FAILED"))
+    for problem in problems:
+        print("  " + problem)
+    if problems:
+        sys.exit(1)
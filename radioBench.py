@@ -0,0 +1,338 @@
+#!/usr/bin/python
+# Throughput and latency benchmark of the radio stack (radioComm transceiver, lib_nrf24)
+# Sweeps data rate, payload size, auto-retransmit settings and number of boards and reports
+# commands/sec, latency percentiles, attempts per command and SPI transactions per command.
+# Runs against the emulator by default, so it needs no hardware and can run unattended in CI.
+# Results can be saved as JSON/CSV and compared with a saved run to catch regressions.
+# With the emulator it also counts digital writes done by the boards per command: with
+# --loss and a short --timeout commands are retried before their reply arrives, a numbered
+# retry must not write twice:
+#   python radioBench.py --loss 0.2 --timeout 0.08 --batches 1
+# Usage: python radioBench.py [--backend emulator|radio] [--json out.json] [--compare base.json] ...
+import argparse
+import csv
+import json
+import math
+import os
+import subprocess
+import sys
+import threading
+import time
+
+DATA_RATES = {"250KBPS": 2, "1MBPS": 0, "2MBPS": 1}   # values of NRF24.BR_*
+METRICS = ["commands_per_sec", "p50_ms", "p95_ms", "p99_ms", "mean_attempts", "failed", "spi_per_command",
+           "writes_per_command"]
+# Regressions are checked for these metrics, True - higher is better
+COMPARED = {"commands_per_sec": True, "p95_ms": False, "mean_attempts": False, "spi_per_command": False,
+            "writes_per_command": False}
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description="Radio throughput/latency benchmark")
+    parser.add_argument("--backend", choices=["emulator", "radio"], default="emulator")
+    parser.add_argument("--devices", default="3,4,5,6,7", help="board ids, the first N are used for N boards")
+    parser.add_argument("--commands", type=int, default=40, help="commands per scenario")
+    parser.add_argument("--rates", default="250KBPS", help="data rates to sweep, e.g. 250KBPS,1MBPS,2MBPS")
+    parser.add_argument("--payloads", default="5,32", help="payload sizes to sweep (5-32 bytes)")
+    parser.add_argument("--retries", default="15/15,4/15", help="auto-retransmit delay/count codes to sweep")
+    parser.add_argument("--boards", default="1,3", help="numbers of boards to sweep")
+    parser.add_argument("--batches", default="1,4",
+                        help="commands submitted to a board at once to sweep, boards which support frames get them in one")
+    parser.add_argument("--loss", type=float, default=0.0, help="emulator only: packet loss probability")
+    parser.add_argument("--seed", type=int, default=1, help="emulator only: seed of the loss generator")
+    parser.add_argument("--timeout", type=float,
+                        help="fixed reply timeout of a try (sec) instead of the learned one, short ones retry early")
+    parser.add_argument("--no-sequences", action="store_true",
+                        help="don't number commands, retries of commands whose reply got lost are executed again")
+    parser.add_argument("--json", help="save results to this JSON file")
+    parser.add_argument("--csv", help="save results to this CSV file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="relative change of a compared metric counted as a regression")
+    parser.add_argument("--verbose", action="store_true", help="keep the radio debug output")
+    return parser.parse_args(argv)
+
+
+def parseList(text, convert=str):
+    return [convert(item) for item in text.split(",") if item]
+
+
+def parseRetries(text):
+    (delay, count) = text.split("/")
+    return (int(delay), int(count))
+
+
+# Value at percentile p (0-100) of sorted values, nearest rank
+def percentile(values, p):
+    if not values:
+        return None
+    rank = max(1, int(math.ceil(p / 100.0 * len(values))))
+    return values[rank - 1]
+
+
+def gitRevision():
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=devnull,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Swallows the per-packet debug output of radioComm while a scenario runs
+class Quiet:
+    def __init__(self, enabled):
+        self.enabled = enabled
+
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+    def __enter__(self):
+        if self.enabled:
+            self.stdout, sys.stdout = sys.stdout, self
+
+    def __exit__(self, *args):
+        if self.enabled:
+            sys.stdout = self.stdout
+
+
+class Bench:
+    def __init__(self, options):
+        self.options = options
+        self.devices = parseList(options.devices, lambda value: int(value, 0))
+        if options.backend == "emulator":
+            import emulator
+            self.emulator = emulator
+            emulator.install(self.devices, loss=options.loss, seed=options.seed)
+        else:
+            self.emulator = None
+        with Quiet(not options.verbose):
+            import radioComm
+        self.radioComm = radioComm
+        radioComm.SEQUENCE_NUMBERS = not options.no_sequences
+
+        # Commands whose packet is padded to a given payload size. Edge devices only look
+        # at the first 5 bytes, so they confirm them like ordinary commands
+        class PaddedCommand(radioComm.RadioCommand):
+            def __init__(self, payloadSize, *args):
+                radioComm.RadioCommand.__init__(self, *args)
+                self.payloadSize = payloadSize
+
+            def packet(self):
+                packet = radioComm.RadioCommand.packet(self)
+                return packet + [0] * (self.payloadSize - len(packet))
+        self.PaddedCommand = PaddedCommand
+
+    def spiTransactions(self):
+        return getattr(self.radioComm.radio.spidev, "transactions", None)
+
+    # Digital writes done by the emulated boards so far
+    def actuations(self):
+        if not self.emulator:
+            return None
+        return sum(len(device.actuations) for device in self.emulator.devices.values())
+
+    def configure(self, rate, retries, boards):
+        radioComm = self.radioComm
+        radioComm.radio.applyConfig({"data_rate": DATA_RATES[rate], "retries": retries})
+        if self.emulator:
+            for device in self.emulator.devices.values():
+                device.dataRate = rate
+        # Every scenario starts without learned round trip times and with fresh pipes
+        with radioComm.linksLock:
+            radioComm.links.clear()
+        if self.options.timeout:
+            timeout = self.options.timeout
+            for board in boards:
+                radioComm.configureLink(board, initialTimeout=timeout, minTimeout=timeout, maxTimeout=timeout)
+        radioComm.resetPipeCache()
+        radioComm.preassignReadingPipes(boards)
+
+    # Learn frame and sequence number support of the boards, as the hub does after the first
+    # reply. The probe is tried once, so ping again until it got through
+    def probe(self, boards):
+        deadline = time.time() + 5
+        for board in boards:
+            link = self.radioComm.getLink(board)
+            while link.frameVersion is None and time.time() < deadline:
+                self.radioComm.transceiver.send(board, 0xA1, attempts=3).result()
+                self.radioComm.transceiver.waitIdle(0, deadline - time.time())
+
+    # Send commands round robin to boards, keeping 'batch' commands (for different pins) in
+    # flight per board, so several boards are pipelined by the transceiver and commands to
+    # one board can share a frame
+    def runScenario(self, rate, payloadSize, retries, boardCount, batch):
+        radioComm = self.radioComm
+        boards = self.devices[:boardCount]
+        self.configure(rate, retries, boards)
+        with Quiet(not self.options.verbose):
+            self.probe(boards)
+        commands = self.options.commands
+        latencies = []
+        attempts = {}
+        lock = threading.Condition()
+        state = {"sent": 0, "done": 0}
+        inFlight = dict((board, 0) for board in boards)
+
+        def submit(board):
+            submittedAt = time.time()
+            for pin in range(2, 2 + batch):
+                if state["sent"] >= commands:
+                    break
+                value = state["sent"] // batch % 2
+                state["sent"] += 1
+                inFlight[board] += 1
+                command = self.PaddedCommand(payloadSize, 1, board, 0xA4, pin, value)
+                command.future.addDoneCallback(lambda future: complete(future, board, submittedAt))
+                radioComm.transceiver.schedule(command, submittedAt)
+
+        def complete(future, board, submittedAt):
+            with lock:
+                if future.response is not None:
+                    latencies.append(time.time() - submittedAt)
+                attempts[future.attempts] = attempts.get(future.attempts, 0) + 1
+                state["done"] += 1
+                inFlight[board] -= 1
+                if inFlight[board] == 0 and state["sent"] < commands:
+                    submit(board)
+                lock.notify()
+
+        spiBefore = self.spiTransactions()
+        actuationsBefore = self.actuations()
+        with Quiet(not self.options.verbose):
+            start = time.time()
+            with lock:
+                for board in boards[:commands]:
+                    submit(board)
+                while state["done"] < commands:
+                    lock.wait(1)
+            elapsed = time.time() - start
+        spiAfter = self.spiTransactions()
+        actuationsAfter = self.actuations()
+
+        latencies.sort()
+        succeeded = [count for count in attempts if count > 0]
+        return {"rate": rate, "payload": payloadSize, "retries": "%d/%d" % retries, "boards": boardCount, "batch": batch,
+                "commands": commands, "elapsed": elapsed,
+                "commands_per_sec": commands / elapsed,
+                "p50_ms": self.toMs(percentile(latencies, 50)),
+                "p95_ms": self.toMs(percentile(latencies, 95)),
+                "p99_ms": self.toMs(percentile(latencies, 99)),
+                "mean_attempts": float(sum(count * attempts[count] for count in succeeded)) /
+                                 max(1, sum(attempts[count] for count in succeeded)),
+                "failed": attempts.get(-1, 0),
+                "attempts": dict((str(count), number) for count, number in sorted(attempts.items())),
+                "spi_per_command": None if spiBefore is None else float(spiAfter - spiBefore) / commands,
+                "writes_per_command": None if actuationsBefore is None else
+                                      float(actuationsAfter - actuationsBefore) / commands}
+
+    @staticmethod
+    def toMs(value):
+        return None if value is None else 1000 * value
+
+    def run(self):
+        options = self.options
+        results = []
+        for rate in parseList(options.rates):
+            for payloadSize in parseList(options.payloads, int):
+                for retries in parseList(options.retries, parseRetries):
+                    for boardCount in parseList(options.boards, int):
+                        for batch in parseList(options.batches, int):
+                            result = self.runScenario(rate, max(5, min(32, payloadSize)), retries, boardCount, batch)
+                            printResult(result)
+                            results.append(result)
+        return results
+
+    def stop(self):
+        self.radioComm.transceiver.stop()
+        if self.emulator:
+            self.emulator.air.stop()
+        else:
+            self.radioComm.radio.end()
+            self.radioComm.GPIO.cleanup()
+
+
+def scenarioKey(result):
+    return (result["rate"], result["payload"], result["retries"], result["boards"], result.get("batch", 1))
+
+
+def formatValue(value):
+    return "-" if value is None else "%.1f" % value
+
+
+def printHeader():
+    print("%-8s %7s %7s %6s %5s %9s %8s %8s %8s %8s %6s %8s %10s" % ("rate", "payload", "retries", "boards", "batch",
+          "cmds/sec", "p50 ms", "p95 ms", "p99 ms", "attempts", "failed", "spi/cmd", "writes/cmd"))
+
+
+def printResult(result):
+    writes = result["writes_per_command"]
+    print("%-8s %7d %7s %6d %5d %9.2f %8s %8s %8s %8.2f %6d %8s %10s" % (result["rate"], result["payload"],
+          result["retries"], result["boards"], result["batch"], result["commands_per_sec"], formatValue(result["p50_ms"]), formatValue(result["p95_ms"]),
+          formatValue(result["p99_ms"]), result["mean_attempts"], result["failed"],
+          formatValue(result["spi_per_command"]), "-" if writes is None else "%.2f" % writes))
+
+
+def saveCsv(path, results):
+    with open(path, "w") as output:
+        writer = csv.writer(output)
+        writer.writerow(["rate", "payload", "retries", "boards", "batch", "commands"] + METRICS)
+        for result in results:
+            writer.writerow([result[key] for key in ["rate", "payload", "retries", "boards", "batch", "commands"] + METRICS])
+
+
+# Print changes against baseline results, return the number of regressions beyond tolerance
+def compare(results, baseline, tolerance):
+    previous = dict((scenarioKey(result), result) for result in baseline["results"])
+    regressions = 0
+    print("\nCompared with %s (%s)" % (baseline.get("revision"), baseline.get("backend")))
+    for result in results:
+        old = previous.get(scenarioKey(result))
+        if old is None:
+            continue
+        for metric, higherIsBetter in sorted(COMPARED.items()):
+            if result[metric] is None or not old.get(metric):
+                continue
+            change = (result[metric] - old[metric]) / float(old[metric])
+            worse = -change if higherIsBetter else change
+            flag = ""
+            if worse > tolerance:
+                flag = "  REGRESSION"
+                regressions += 1
+            print("%-8s %3d B %5s %d boards x%d  %-17s %10.2f -> %10.2f (%+.0f%%)%s" % (result["rate"], result["payload"],
+                  result["retries"], result["boards"], result["batch"], metric, old[metric], result[metric], 100 * change,
+                  flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    options = parseArgs(sys.argv[1:])
+    bench = Bench(options)
+    printHeader()
+    try:
+        results = bench.run()
+    finally:
+        bench.stop()
+
+    report = {"revision": gitRevision(), "backend": options.backend, "time": time.time(),
+              "loss": options.loss if options.backend == "emulator" else None, "sequences": not options.no_sequences,
+              "results": results}
+    if options.json:
+        with open(options.json, "w") as output:
+            json.dump(report, output, indent=1, sort_keys=True)
+    if options.csv:
+        saveCsv(options.csv, results)
+    # Every command writes once, or not at all if it failed
+    duplicated = [result for result in results if (result["writes_per_command"] or 0) > 1]
+    if duplicated and not options.no_sequences:
+        print("\nRetried commands were executed twice in %d scenarios" % len(duplicated))
+    if options.compare:
+        with open(options.compare) as baselineFile:
+            baseline = json.load(baselineFile)
+        if compare(results, baseline, options.tolerance):
+            sys.exit(1)
+    if duplicated and not options.no_sequences:
+        sys.exit(1)
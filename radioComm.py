@@ -1,25 +1,38 @@
 # This file contains low-level functions required for communication with Arduino edge 
 # devices through NRF24 board plus some general purpose procs
 print "sourcing radioComm.py"
-import spidev,time, sys
+import spidev,time, sys, os, threading, heapq, random
 import RPi.GPIO as GPIO
 from lib_nrf24 import NRF24
+from radioTelemetry import telemetry
 
 def dbgPrint(msg):
     currTime = time.strftime("%d %b %Y %H:%M:%S", time.localtime())
     print "[" + currTime + "] " + msg
 
+# Read OBSERVE_TX after every packet sent and RPD after every reply to a single command for telemetry,
+# this costs one SPI transaction each
+READ_RADIO_TELEMETRY = True
+
+# BCM pin wired to the IRQ pin of NRF24 board. If set, receiveMessage sleeps until 
+# the radio signals an event instead of polling it. None - IRQ is not wired, poll.
+# Set through RADIO_IRQ_PIN environment variable
+IRQ_PIN = int(os.environ["RADIO_IRQ_PIN"]) if os.environ.get("RADIO_IRQ_PIN") else None
+
 # Initialize NRF24 radio - we use global instance 'radio'
 GPIO.setmode(GPIO.BCM)
 radio = NRF24(GPIO,spidev.SpiDev())
 radio.begin(0,17)
-radio.setChannel(0x78)
-radio.setDataRate(NRF24.BR_250KBPS)
-radio.setPALevel(NRF24.PA_MAX)
-radio.setCRCLength(NRF24.CRC_8);
-radio.setRetries(15,15);
-radio.setAutoAck(True)
+if IRQ_PIN:
+    radio.enableIrq(IRQ_PIN)
+# Serve configuration register reads from a write-through shadow copy instead of SPI
+radio.enableShadow()
+# Program channel, rate, power, CRC, retries and auto-ack in one batch
+radio.applyConfig({"channel": 0x78, "data_rate": NRF24.BR_250KBPS, "pa_level": NRF24.PA_MAX,
+                   "crc_length": NRF24.CRC_8, "retries": (15,15), "auto_ack": True})
 radio.enableDynamicPayloads()
+# Frames (see FrameCommand) take the whole payload
+radio.setPayloadSize(32)
 radio.enableAckPayload()
 radio.powerUp()
 radio.printDetails()
@@ -34,39 +47,353 @@ def dbgPrintPacket(msg,prefix="dbg"):
 def packetToString(msg):
     return(" ".join(hex(n) for n in msg))
         
+# Addresses used to talk to an edge device: the hub writes to the device's reading address
+# and listens for replies on the device's writing address (see arduinoEdgeDevice.ino).
+# Device ids are added to the last address byte, which must not overflow since reading
+# pipes 2-5 share the upper 4 bytes, so the highest id is MAX_DEVICE_ID
+MAX_DEVICE_ID = 0xFF - 0xE0
+
+def checkDeviceId(receiver_id):
+    if not 0 <= receiver_id <= MAX_DEVICE_ID:
+        raise ValueError("Device id %s is out of range 0-%d" % (receiver_id, MAX_DEVICE_ID))
+
+def readingAddress(receiver_id):
+    checkDeviceId(receiver_id)
+    return [0xAB,0xCD,0xAB,0xCD,0x71 + receiver_id]
+
+def writingAddress(receiver_id):
+    checkDeviceId(receiver_id)
+    return [0xE8,0xE8,0xF0,0xF0,0xE0 + receiver_id]
+
+# Reading pipes 1-5 are assigned to edge devices, pipe 0 is used for the auto-ack of the 
+# writing pipe. Pipe 1 holds a full 5 byte address, pipes 2-5 share its upper 4 bytes, 
+# which is fine since all device reading addresses differ only in the last byte.
+# We remember which device every pipe and the writing pipe point at, so the addresses
+# only need to be reprogrammed when we talk to a device which doesn't have a pipe yet.
+READING_PIPES = [1,2,3,4,5]
+pipeReceivers = {}      # pipe number -> receiver id
+receiverPipes = {}      # receiver id -> pipe number
+receiverActivity = {}   # receiver id -> number of packets sent, most active devices keep their pipes
+writingReceiver = None  # receiver id the writing pipe currently points at
+pipeStats = {"readingPipeHits": 0, "readingPipeReprogrammed": 0, "writingPipeHits": 0, "writingPipeReprogrammed": 0}
+
+# Make sure one of the reading pipes listens to replies from given device, return its number.
+# Pipes of devices in keep (e.g. awaiting replies to a pipelined exchange) are never evicted
+def assignReadingPipe(receiver_id, keep=()):
+    pipe = receiverPipes.get(receiver_id)
+    if pipe is not None:
+        pipeStats["readingPipeHits"] += 1
+        return pipe
+
+    # Take a free pipe or evict the least active device
+    freePipes = [p for p in READING_PIPES if p not in pipeReceivers]
+    if freePipes:
+        pipe = freePipes[0]
+    else:
+        candidates = [p for p in READING_PIPES if pipeReceivers[p] not in keep]
+        pipe = min(candidates, key=lambda p: receiverActivity.get(pipeReceivers[p], 0))
+        del receiverPipes[pipeReceivers[pipe]]
+
+    radio.openReadingPipe(pipe, readingAddress(receiver_id))
+    pipeReceivers[pipe] = receiver_id
+    receiverPipes[receiver_id] = pipe
+    pipeStats["readingPipeReprogrammed"] += 1
+    return pipe
+
+# Point the writing pipe to a given device unless it already points there
+def assignWritingPipe(receiver_id):
+    global writingReceiver
+    if writingReceiver == receiver_id:
+        pipeStats["writingPipeHits"] += 1
+        return
+    radio.openWritingPipe(writingAddress(receiver_id))
+    writingReceiver = receiver_id
+    pipeStats["writingPipeReprogrammed"] += 1
+
+# Give reading pipes to the most active devices upfront, e.g. all devices known to the
+# control hub, so switching between them doesn't reprogram addresses
+def preassignReadingPipes(receiver_ids):
+    for receiver_id in receiver_ids[:len(READING_PIPES)]:
+        receiverActivity.setdefault(receiver_id, 0)
+        assignReadingPipe(receiver_id)
+
+# Forget pipe assignments, must be called if the radio was reinitialized
+def resetPipeCache():
+    global writingReceiver
+    pipeReceivers.clear()
+    receiverPipes.clear()
+    writingReceiver = None
+
+# Return counters of pipe (re)programming, hits are reconfigurations which were avoided
+def getPipeStats():
+    return dict(pipeStats)
+
 # Send wireless message(4 byte packet) to one of the Arduino boards 
 # By default send the same message 3 time for reliability
 def sendMessage(sender_id,receiver_id, command_code, lsb_byte=0, msb_byte=0):
     sentMsg = [sender_id,receiver_id, command_code, lsb_byte, msb_byte]
-    radio.stopListening()
+    transmitPacket(sentMsg)
 
-    # Open reading writing pipes to a given device
-    radio.openReadingPipe(receiver_id,[0xAB,0xCD,0xAB,0xCD,0x71 + receiver_id])
-    radio.openWritingPipe([0xE8,0xE8,0xF0,0xF0,0xE0 + receiver_id])
+# Send packet to the device given by its second byte and return the reading pipe its 
+# reply will arrive on. Keep flush_rx False to hold on to replies already received,
+# keep are devices whose reading pipes must stay as they are
+def transmitPacket(packet, flush_rx=True, keep=()):
+    receiver_id = packet[1]
+    radio.stopListening(flush_rx)
+
+    # Open reading writing pipes to a given device, unless they're already open
+    receiverActivity[receiver_id] = receiverActivity.get(receiver_id, 0) + 1
+    pipe = assignReadingPipe(receiver_id, keep)
+    assignWritingPipe(receiver_id)
     
-    radio.write(sentMsg)
+    acked = radio.write(packet)
+    if READ_RADIO_TELEMETRY:
+        telemetry.recordTransmit(receiver_id, radio.read_register(NRF24.OBSERVE_TX) & 0x0F, acked)
     radio.startListening()  
+    return pipe
+
+# Send packets to several edge devices one after another without waiting for replies,
+# then collect all replies. Every device listens on its own reading pipe, so replies 
+# are told apart by the pipe number the radio reports for them.
+# At most len(READING_PIPES) different devices can be addressed at once.
+# Returns {receiver_id: reply packet} for devices which replied within time_limit sec
+# after the last packet was sent
+# If given, rtts is filled with {receiver_id: round trip time} of all replies
+def exchangePipelined(packets, time_limit=0.2, time_interval=0.005, rtts=None):
+    pipes = {}
+    responses = {}
+    sentAt = {}
+    receivedAt = {}
+    for packet in packets:
+        sentAt[packet[1]] = time.time()
+        # Replies of devices already sent to arrive on their pipes, don't take them away
+        pipes[transmitPacket(packet, flush_rx=False, keep=pipes.values())] = packet[1]
+        # Empty RX FIFO (3 packets deep) while we're at it, fast devices may have replied already
+        collectResponses(pipes, responses, receivedAt)
+
+    deadline = time.time() + time_limit
+    while len(responses) < len(pipes):
+        radio.clearIrq()
+        collectResponses(pipes, responses, receivedAt)
+        remaining = deadline - time.time()
+        if len(responses) == len(pipes) or remaining < 0:
+            break
+        if radio.irq_pin:
+            radio.waitForIrq(remaining)
+        else:
+            time.sleep(time_interval)
+
+    if rtts is not None:
+        for receiver_id in receivedAt:
+            rtts[receiver_id] = receivedAt[receiver_id] - sentAt[receiver_id]
+    return responses
+
+# Read the next packet waiting in the radio, as long as its sender made it
+def readPayload():
+    receivedMsg = []
+    width = radio.getDynamicPayloadSize()
+    if 0 < width <= 32:
+        radio.read(receivedMsg, width)
+    else:
+        # Corrupted packet, the datasheet says to drop it this way
+        radio.flush_rx()
+    return receivedMsg
+
+# Read all packets waiting in the radio and store them in responses by the device
+# their reading pipe belongs to, and their arrival time in receivedAt
+def collectResponses(pipes, responses, receivedAt):
+    pipe = [None]
+    while radio.available(pipe):
+        receivedMsg = readPayload()
+        receiver_id = pipes.get(pipe[0])
+        if receiver_id is not None:
+            responses[receiver_id] = receivedMsg
+            receivedAt[receiver_id] = time.time()
+
+# Priority classes of radio commands, among commands due for a try the transceiver 
+# serves the lowest number first
+PRIORITY_INTERACTIVE = 0  # requested by a user of the web interface
+PRIORITY_SCHEDULED = 1    # automatic actions, e.g. switching pins at their scheduled time
+PRIORITY_BACKGROUND = 2   # pings and other diagnostic traffic
+
+# Receiver id 0 addresses all edge devices at once. Edge devices don't auto-ack broadcasts
+# (that would collide), instead each replies to the common address readingAddress(0) 
+# BROADCAST_SLOT sec * BOARD_ID after receiving it, see arduinoEdgeDevice.ino
+BROADCAST_ID = 0
+BROADCAST_SLOT = 0.02
+BROADCAST_MARGIN = 0.1
+
+# Time to wait for broadcast replies from all of given devices
+def broadcastWindow(device_ids):
+    return (max(device_ids) + 1) * BROADCAST_SLOT + BROADCAST_MARGIN
+
+# Send one packet to all edge devices, then collect replies for time_limit sec or until
+# all devices from device_ids replied. Returns {device_id: reply packet}
+def broadcastMessage(sender_id, command_code, lsb_byte, msb_byte, device_ids, time_limit=None, time_interval=0.005):
+    global writingReceiver
+    if time_limit is None:
+        time_limit = broadcastWindow(device_ids)
+
+    radio.stopListening()
+    radio.openWritingPipe(writingAddress(BROADCAST_ID))
+    # Nobody acks a broadcast, so don't wait for the ack
+    radio.setAutoAckPipe(0, False)
+    radio.write([sender_id, BROADCAST_ID, command_code, lsb_byte, msb_byte])
+    radio.setAutoAckPipe(0, True)
+    # Listen for replies on pipe 0, the writing pipe has to be set up again for the next unicast
+    radio.write_register(NRF24.RX_ADDR_P0, readingAddress(BROADCAST_ID), 5)
+    writingReceiver = None
+    radio.startListening()
+
+    responses = {}
+    deadline = time.time() + time_limit
+    while len(responses) < len(device_ids):
+        radio.clearIrq()
+        pipe = [None]
+        while radio.available(pipe):
+            receivedMsg = readPayload()
+            if pipe[0] == 0 and len(receivedMsg) >= 5 and receivedMsg[0] in device_ids:
+                responses[receivedMsg[0]] = receivedMsg
+        remaining = deadline - time.time()
+        if remaining < 0:
+            break
+        if radio.irq_pin:
+            radio.waitForIrq(remaining)
+        else:
+            time.sleep(time_interval)
+    return responses
+
+# Send a command to all given devices with one broadcast, then unicast it (with retries) 
+# to devices which didn't confirm the broadcast. Returns (acked, followedUp, failed) lists of device ids
+def broadcastWithFollowUp(sender_id, command_code, lsb_byte, msb_byte, device_ids, attempts=None, pauseBtwTries=None, \
+                          priority=PRIORITY_BACKGROUND):
+    if not device_ids:
+        return ([], [], [])
+    result = transceiver.broadcast(command_code, lsb_byte, msb_byte, device_ids, sender_id=sender_id, \
+                                   priority=priority).result()
+    # The broadcast exchange failed altogether, every device gets a unicast
+    (acked, missing) = ([], list(device_ids)) if result is None else (sorted(result.acked), result.missing)
+    futures = [transceiver.send(device_id, command_code, lsb_byte, msb_byte, sender_id=sender_id, attempts=attempts, \
+                                pauseBtwTries=pauseBtwTries, priority=priority) for device_id in missing]
+    followedUp = [future.command.receiver_id for future in futures if future.result() is not None]
+    failed = [future.command.receiver_id for future in futures if future.response is None]
+    return (acked, followedUp, failed)
+
+# Round trip time statistics and retry policy of the radio link to one edge device.
+# Smoothed RTT and its variance are tracked the way TCP does it (RFC 6298). The receive 
+# timeout is srtt + 4*rttvar and doubles with every unsuccessful try of a command. 
+# The pause between tries grows the same way and gets random jitter, so retries of 
+# commands to different devices don't line up.
+# Numbered commands (see FEATURE_SEQUENCE) are safe to retry, they pause at most maxSequencedPause
+class RadioLink:
+    # Retry policy parameter -> default
+    POLICY = {"attempts": 15, "initialTimeout": 0.2, "minTimeout": 0.05, "maxTimeout": 0.5, "maxPause": 0.5, \
+              "maxSequencedPause": 0.05}
+
+    def __init__(self, device_id, **policy):
+        self.device_id = device_id
+        self.configure(**policy)
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+        # Frame version and features the edge device supports (see CapabilitiesCommand),
+        # None until it told us
+        self.frameVersion = None
+        self.features = 0
+        self.probing = False
+        self.sequence = 0       # sequence number of the last numbered command
+
+    # Set the retry policy, parameters not given get their defaults. What was learned about
+    # the link (round trip times, capabilities, sequence number) is kept
+    def configure(self, **policy):
+        unknown = set(policy) - set(RadioLink.POLICY)
+        if unknown:
+            raise TypeError("Unknown radio policy parameters %s" % ", ".join(sorted(unknown)))
+        for name, default in RadioLink.POLICY.items():
+            setattr(self, name, policy.get(name, default))
+
+    def policy(self):
+        return dict((name, getattr(self, name)) for name in RadioLink.POLICY)
+
+    def addSample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.samples += 1
+
+    # How long to wait for a reply on given try of a command
+    def timeout(self, attempt=1):
+        if self.srtt is None:
+            base = self.initialTimeout
+        else:
+            base = self.srtt + 4 * self.rttvar
+        return min(self.maxTimeout, max(self.minTimeout, base) * 2 ** (attempt - 1))
+
+    # How long to wait after given (unsuccessful) try of a command before the next one
+    def pause(self, attempt, sequenced=False):
+        maxPause = self.maxSequencedPause if sequenced else self.maxPause
+        return random.uniform(0.5, 1.0) * min(maxPause, self.timeout(attempt))
+
+    # Whether the edge device reported given FEATURE_* bit
+    def supports(self, feature):
+        return bool(self.features & feature)
+
+    # Sequence number for the next numbered command, 1-255 (0 means not numbered)
+    def nextSequence(self):
+        self.sequence = self.sequence % 255 + 1
+        return self.sequence
+
+    def getInfo(self):
+        return {"srtt": self.srtt, "rttvar": self.rttvar, "timeout": self.timeout(), "samples": self.samples, \
+                "attempts": self.attempts, "maxPause": self.maxPause, "frameVersion": self.frameVersion, \
+                "features": self.features, "sequence": self.sequence}
+
+# Radio links by device id, created with the default policy on first use. Commands are
+# created in the callers' threads, so links are created under linksLock: all commands
+# for a device share one link, its sequence counter and what was learned about it
+links = {}
+linksLock = threading.Lock()
+
+def getLink(device_id):
+    with linksLock:
+        link = links.get(device_id)
+        if link is None:
+            link = links[device_id] = RadioLink(device_id)
+        return link
+
+# Set retry policy for an edge device, see RadioLink.POLICY for parameters. The link is
+# updated in place, so commands already queued for the device keep using it, and only if
+# the policy differs. Returns whether it did.
+# Once the transceiver runs, call it in the transceiver thread (see RadioTransceiver.call)
+def configureLink(device_id, **policy):
+    link = getLink(device_id)
+    if link.policy() == dict(RadioLink.POLICY, **policy):
+        return False
+    link.configure(**policy)
+    return True
+
+# Return learned round trip times and timeouts by device id
+def getLinkStats():
+    with linksLock:
+        devices = list(links.items())
+    return dict((device_id, link.getInfo()) for device_id, link in devices)
 
 # Send message and check response. If response is invalid, try few more times  
 # If succesful ,return how many attempts it took. If failed - return -1
-def sendMessageWithConfirm(sender_id,receiver_id, command_code, lsb_byte=0, msb_byte=0, attempts=15, pauseBtwTries=0.5):
-    sentMsg = [sender_id, receiver_id, command_code, lsb_byte, msb_byte]
-    for attempt in range(1,attempts+1):
-        currTime = time.strftime("%d %b %Y %H:%M:%S", time.localtime())
-        print " sending msg  %s, attempt %d/%s" % (packetToString(sentMsg), attempt, attempts )
-        sendMessage(sender_id, receiver_id, command_code, lsb_byte, msb_byte)
-        response = receiveMessage()
-        if (response == [receiver_id, sender_id, command_code, lsb_byte, msb_byte]):
-            print " message sent successfully"
-            return attempt
-        
-        # Wait a little, then try again
-        time.sleep(pauseBtwTries)
-
-    print " All attempts to send message failed"
-    return -1
+# The exchange itself runs in the transceiver thread, this call just waits for it to complete
+# attempts and pauseBtwTries default to the retry policy of the device's link, pauses
+# given explicitly are fixed
+def sendMessageWithConfirm(sender_id,receiver_id, command_code, lsb_byte=0, msb_byte=0, attempts=None, pauseBtwTries=None):
+    future = transceiver.send(receiver_id, command_code, lsb_byte, msb_byte, sender_id=sender_id, \
+                              attempts=attempts, pauseBtwTries=pauseBtwTries)
+    future.result()
+    return future.attempts
 
 # Receive 4 byte wireless message
+# If IRQ line of the radio is wired, sleep until it fires, otherwise poll every time_interval sec
 def receiveMessage(time_limit=0.2,time_interval=0.02):
     # Need to declare list first before filling it up
     receivedMsg = [0,0,0,0,0]
@@ -74,21 +401,692 @@ def receiveMessage(time_limit=0.2,time_interval=0.02):
     delay = 0
     #print "Started receiveMessage at %s " % start
     # Wait until radio is available or time limit is reached
-    while not radio.available(0):
-        time.sleep(time_interval)
+    while True:
+        # Clear interrupt before checking the radio, so a packet arriving right 
+        # after the check still wakes us up
+        radio.clearIrq()
+        if radio.available(0):
+            break
         #print " current time= %s" % time.time()
         delay = time.time() - start
         if delay > time_limit:
             #radio.stopListening()
             print(" receiveMessage timed out, delay= %.2f" % delay)         
             return -1
+        if radio.irq_pin:
+            radio.waitForIrq(time_limit - delay)
+        else:
+            time.sleep(time_interval)
 
     # OK, radio data is available within the time limit
-    radio.read(receivedMsg, 5)
+    delay = time.time() - start
+    receivedMsg = readPayload()
     print(" got response %s in %.2f sec" % ( packetToString(receivedMsg), delay))
     
     return receivedMsg
 
+# Edge devices which report this feature bit (see CapabilitiesCommand) take a sequence number
+# as the 6th byte of a command and echo it in the reply. They remember the last commands they
+# executed with their replies and answer a retry of one of them with the saved reply instead
+# of executing it again, so a command whose reply was lost is never executed twice.
+# Sequence numbers count per device from the capabilities command, which clears that memory
+FEATURE_SEQUENCE = 0x01
+
+# Number commands to devices which support it
+SEQUENCE_NUMBERS = True
+
+# One command sent to an edge device with confirmation. Tries are spread out by the
+# transceiver thread, which can serve other commands while this one pauses between tries
+# Commands with the same key (e.g. (device id, pin id)) set the same thing on the device:
+# a command still waiting in the transceiver is dropped when a newer one with its key 
+# is queued, and completes with the newer one's result
+class RadioCommand:
+    # Whether the command gets a sequence number when the device supports them
+    SEQUENCED = True
+
+    def __init__(self, sender_id, receiver_id, command_code, lsb_byte=0, msb_byte=0, attempts=None, pauseBtwTries=None, \
+                 priority=PRIORITY_SCHEDULED, key=None):
+        self.sender_id = sender_id
+        self.receiver_id = receiver_id
+        self.command_code = command_code
+        self.lsb_byte = lsb_byte
+        self.msb_byte = msb_byte
+        # Broadcasts aren't sent over a link of their own
+        self.link = None if receiver_id == BROADCAST_ID else getLink(receiver_id)
+        self.attempts = attempts
+        if attempts is None:
+            self.attempts = self.link.attempts
+        self.pauseBtwTries = pauseBtwTries
+        self.priority = priority
+        self.key = key
+        self.superseded = False
+        self.attempt = 0
+        self.sequence = None    # given by the transceiver on the first try, see FEATURE_SEQUENCE
+        self.future = RadioFuture(self)
+
+    # How long to wait for a reply to the current try
+    def timeout(self):
+        return self.link.timeout(self.attempt) + self.busyTime()
+
+    # Time the edge device takes to execute the command, it's not part of the round trip
+    def busyTime(self):
+        return 0
+
+    # Whether the reply can only be to the current try. A reply to a retry may answer an
+    # earlier try, so its round trip time is ambiguous (Karn's algorithm)
+    def firstTry(self):
+        return self.attempt == 1
+
+    # How long to wait before the next try
+    def pause(self):
+        if self.pauseBtwTries is not None:
+            return self.pauseBtwTries
+        return self.link.pause(self.attempt, self.sequence is not None)
+
+    # Called by the transceiver thread when the command is due, before it's tried
+    def prepare(self):
+        pass
+
+    # Move on to the next exchange of a command which takes several (each one confirmed),
+    # returns False if the command is complete
+    def advance(self):
+        return False
+
+    # Whether the command is to be numbered
+    def sequenced(self):
+        return SEQUENCE_NUMBERS and self.SEQUENCED and self.link.supports(FEATURE_SEQUENCE)
+
+    def sequenceBytes(self):
+        return [] if self.sequence is None else [self.sequence]
+
+    # A reply to a numbered command has to echo its sequence number
+    def sequenceMatches(self, response):
+        return self.sequence is None or response[5:6] == [self.sequence]
+
+    def packet(self):
+        return [self.sender_id, self.receiver_id, self.command_code, self.lsb_byte, self.msb_byte] + self.sequenceBytes()
+
+    # Edge device confirms a command by sending it back with sender and receiver swapped
+    def isValidResponse(self, response):
+        return response == [self.receiver_id, self.sender_id, self.command_code, self.lsb_byte, self.msb_byte] + \
+                           self.sequenceBytes()
+
+# Command sent to all edge devices at once. It is not retried, its result tells which 
+# devices confirmed it and which need a unicast follow-up
+class BroadcastCommand(RadioCommand):
+    SEQUENCED = False
+
+    def __init__(self, sender_id, command_code, lsb_byte, msb_byte, device_ids, priority=PRIORITY_BACKGROUND):
+        RadioCommand.__init__(self, sender_id, BROADCAST_ID, command_code, lsb_byte, msb_byte, attempts=1, \
+                              priority=priority)
+        self.device_ids = list(device_ids)
+
+    def isValidResponse(self, response):
+        return response[1:] == [self.sender_id, self.command_code, self.lsb_byte, self.msb_byte]
+
+# Pin id of a digital read (0xA3) which reads pins 0-15 at once
+READ_ALL_PINS = 0xFF
+
+# Digital read of a pin, or of pins 0-15 with READ_ALL_PINS. The edge device replies with
+# the pin's value as the last byte, or with a bit mask of the pins in the last two bytes
+# (pins 0-7 first)
+class DigitalReadCommand(RadioCommand):
+    def __init__(self, sender_id, receiver_id, pin_id=READ_ALL_PINS, attempts=None, priority=PRIORITY_BACKGROUND):
+        RadioCommand.__init__(self, sender_id, receiver_id, 0xA3, pin_id, 0, attempts, priority=priority)
+
+    def isValidResponse(self, response):
+        if not isinstance(response, list) or len(response) < 5:
+            return False
+        return response[:3] == [self.receiver_id, self.sender_id, self.command_code] and \
+               (self.lsb_byte == READ_ALL_PINS or response[3] == self.lsb_byte) and self.sequenceMatches(response)
+
+    # Values of the pins read from a valid response, {pin id: 0|1}
+    def values(self, response):
+        if self.lsb_byte == READ_ALL_PINS:
+            bits = response[3] | (response[4] << 8)
+            return dict((pin_id, (bits >> pin_id) & 1) for pin_id in range(16))
+        return {self.lsb_byte: response[4]}
+
+# Analog read (0xA5) of a pin or Vcc measurement (0xA7, in mV). The edge device replies
+# with the value in the last two bytes, low byte first
+class MeasureCommand(RadioCommand):
+    def __init__(self, sender_id, receiver_id, command_code, pin_id=0, attempts=None, priority=PRIORITY_BACKGROUND):
+        RadioCommand.__init__(self, sender_id, receiver_id, command_code, pin_id, 0, attempts, priority=priority)
+
+    def isValidResponse(self, response):
+        if not isinstance(response, list) or len(response) < 5:
+            return False
+        return response[:3] == [self.receiver_id, self.sender_id, self.command_code] and self.sequenceMatches(response)
+
+    def value(self, response):
+        return response[3] | (response[4] << 8)
+
+# Pulse of a digital pin timed by the edge device: the pin goes to 1 for the given width and
+# back to 0 before the device replies, so a momentary switch takes one exchange instead of
+# three writes spaced by radio latency. Edge devices which report FEATURE_PULSE support it.
+# The width is sent in units of PULSE_UNIT sec, 1-255 of them.
+# Other devices get the pulse as digital writes of FALLBACK_VALUES instead, each one sent
+# after the previous one was confirmed. The transceiver thread decides which when it takes
+# the command for its first try (see prepare), the future completes after the last write
+PULSE_COMMAND = 0xA8
+FEATURE_PULSE = 0x02
+PULSE_UNIT = 0.01
+
+class PulseCommand(RadioCommand):
+    FALLBACK_VALUES = [0, 1, 0]
+
+    def __init__(self, sender_id, receiver_id, pin_id, width, attempts=None, priority=PRIORITY_SCHEDULED, key=None):
+        units = max(1, min(255, int(round(width / PULSE_UNIT))))
+        RadioCommand.__init__(self, sender_id, receiver_id, PULSE_COMMAND, pin_id, units, attempts, priority=priority, \
+                              key=key)
+        self.units = units
+        self.step = None    # index of the current write of FALLBACK_VALUES, None - not decided yet
+
+    def prepare(self):
+        if self.step is None:
+            self.step = 0
+            if not self.link.supports(FEATURE_PULSE):
+                self.command_code = 0xA4
+                self.msb_byte = PulseCommand.FALLBACK_VALUES[0]
+
+    def advance(self):
+        if self.command_code == PULSE_COMMAND or self.step + 1 >= len(PulseCommand.FALLBACK_VALUES):
+            return False
+        self.step += 1
+        self.msb_byte = PulseCommand.FALLBACK_VALUES[self.step]
+        self.attempt = 0
+        self.sequence = None
+        return True
+
+    # Values the pin was set to so far
+    def values(self):
+        if self.command_code == PULSE_COMMAND:
+            return [1, 0]
+        return PulseCommand.FALLBACK_VALUES[:(self.step or 0) + 1]
+
+    # Width of the pulse in sec
+    def width(self):
+        return self.units * PULSE_UNIT
+
+    def busyTime(self):
+        return self.width() if self.command_code == PULSE_COMMAND else 0
+
+# Asks the edge device for the frame version and features it supports. The reply carries
+# them in place of the last two bytes. Boards which don't know this command reply with 0xFF,
+# they get frame version 0, i.e. every command is sent on its own. The edge device forgets
+# the numbered commands it executed, so it's not numbered itself
+CAPABILITIES_COMMAND = 0xA0
+
+class CapabilitiesCommand(RadioCommand):
+    SEQUENCED = False
+
+    def __init__(self, sender_id, receiver_id):
+        RadioCommand.__init__(self, sender_id, receiver_id, CAPABILITIES_COMMAND, 0, 0, attempts=1, \
+                              priority=PRIORITY_BACKGROUND)
+
+    # It's tried once, so wait as long as the device's reply can take whatever timeout was learned
+    def timeout(self):
+        return max(self.link.timeout(self.attempt), broadcastWindow([self.receiver_id]))
+
+    def isValidResponse(self, response):
+        if not isinstance(response, list) or len(response) < 5:
+            return False
+        return response[:2] == [self.receiver_id, self.sender_id] and response[2] in (self.command_code, 0xFF)
+
+    # (frame version, features) from a valid response
+    def capabilities(self, response):
+        if (response[2] == self.command_code):
+            return (response[3], response[4])
+        return (0, 0)
+
+# Several commands for one edge device packed into one payload, so they take one exchange:
+#  <sender> <receiver> 0xB0 <version> <count>, then <command> <lsb> <msb> for every command,
+#  followed by its sequence number in version 2
+# The edge device executes them in order and replies with the same layout, every command
+# replaced by the last bytes of its own reply. A frame is built by the transceiver out
+# of commands due at the same time and is tried once, its commands are retried on their own
+FRAME_COMMAND = 0xB0
+FRAME_VERSION = 2
+FRAME_HEADER = 5
+FRAME_ITEM_SIZE = {1: 3, 2: 4}
+FRAME_ITEMS = dict((version, (32 - FRAME_HEADER) // size) for version, size in FRAME_ITEM_SIZE.items())
+
+def encodeFrame(sender_id, receiver_id, items, version=FRAME_VERSION):
+    packet = [sender_id, receiver_id, FRAME_COMMAND, version, len(items)]
+    for item in items:
+        packet.extend(item)
+    return packet
+
+# Items of a frame as a list of (command, lsb, msb[, sequence]), None if packet is not a frame
+def decodeFrame(packet):
+    if not isinstance(packet, list) or len(packet) < FRAME_HEADER or packet[2] != FRAME_COMMAND or \
+       packet[3] not in FRAME_ITEM_SIZE:
+        return None
+    size = FRAME_ITEM_SIZE[packet[3]]
+    end = FRAME_HEADER + size * packet[4]
+    if len(packet) < end:
+        return None
+    return [tuple(packet[index:index + size]) for index in range(FRAME_HEADER, end, size)]
+
+class FrameCommand:
+    def __init__(self, commands):
+        self.commands = commands
+        self.sender_id = commands[0].sender_id
+        self.receiver_id = commands[0].receiver_id
+        self.link = commands[0].link
+        self.version = self.requiredVersion(commands[0])
+
+    # Frame version which carries command, numbered commands need version 2
+    @staticmethod
+    def requiredVersion(command):
+        return 2 if command.sequence is not None or command.sequenced() else 1
+
+    # Whether command can go into a frame with commands (all for the same device)
+    @staticmethod
+    def fits(commands, command):
+        version = FrameCommand.requiredVersion(command)
+        return command.receiver_id != BROADCAST_ID and len(commands) < FRAME_ITEMS[version] and \
+               (command.link.frameVersion or 0) >= version and FrameCommand.unpadded(command) and \
+               all(other.sender_id == command.sender_id and FrameCommand.requiredVersion(other) == version and \
+                   FrameCommand.unpadded(other) for other in commands)
+
+    # Commands with a longer packet don't fit into a frame item
+    @staticmethod
+    def unpadded(command):
+        return len(command.packet()) == 5 + len(command.sequenceBytes())
+
+    def packet(self):
+        return encodeFrame(self.sender_id, self.receiver_id, [command.packet()[2:] for command in self.commands], \
+                           self.version)
+
+    # The edge device executes the commands one after another before it replies
+    def timeout(self):
+        return max(command.link.timeout(command.attempt) for command in self.commands) + self.busyTime()
+
+    def busyTime(self):
+        return sum(command.busyTime() for command in self.commands)
+
+    def firstTry(self):
+        return all(command.firstTry() for command in self.commands)
+
+    def isValidResponse(self, response):
+        items = None
+        if isinstance(response, list) and response[:2] == [self.receiver_id, self.sender_id]:
+            items = decodeFrame(response)
+        return items is not None and response[3] == self.version and len(items) == len(self.commands)
+
+    # Reply to every command as if it had been sent on its own, -1 if the frame got no valid reply
+    def replies(self, response):
+        if not self.isValidResponse(response):
+            return [-1] * len(self.commands)
+        return [[self.receiver_id, self.sender_id] + list(item) for item in decodeFrame(response)]
+
+class BroadcastResult:
+    def __init__(self, command, responses):
+        self.responses = dict((device_id, response) for device_id, response in responses.items() \
+                              if command.isValidResponse(response))
+        self.acked = sorted(self.responses.keys())
+        self.missing = [device_id for device_id in command.device_ids if device_id not in self.responses]
+
+# Outcome of a RadioCommand, filled in by the transceiver thread.
+# attempts is the number of tries it took or -1 if all of them failed
+class RadioFuture:
+    def __init__(self, command):
+        self.command = command
+        self.response = None
+        self.attempts = None
+        self.sequence = None # order of submission
+        self.submittedAt = None
+        self.event = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def done(self):
+        return self.event.is_set()
+
+    # Wait for completion, return the response packet or None if the command failed or
+    # timeout (sec) expired first
+    def result(self, timeout=None):
+        self.event.wait(timeout)
+        return self.response
+
+    # Call fn(future) once the command completes, right away if it already has.
+    # Callbacks run in the transceiver thread and must not block
+    def addDoneCallback(self, fn):
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(fn)
+                return
+        fn(self)
+
+    def setResult(self, response, attempts):
+        with self.lock:
+            self.response = response
+            self.attempts = attempts
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                dbgPrint("Radio command callback failed: %s" % e)
+
+# Owns the radio: all radio exchanges run in one thread, so callers never touch the
+# radio concurrently. Callers get a RadioFuture back right away and may wait on it.
+# Commands are kept in a heap ordered by the time of their next try
+class RadioTransceiver:
+    def __init__(self):
+        self.commands = []
+        self.sequence = 0
+        self.pending = {}   # key -> the latest command with this key waiting in the heap
+        self.coalesced = 0  # number of commands dropped in favor of a newer one with the same key
+        self.busy = False   # an exchange is in progress
+        self.calls = []     # functions to run in the transceiver thread, see call
+        self.lastExchange = time.time()
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="RadioTransceiver")
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Queue a command for edge device device_id, return its RadioFuture
+    def send(self, device_id, command_code, lsb_byte=0, msb_byte=0, sender_id=1, attempts=None, pauseBtwTries=None, \
+             priority=PRIORITY_SCHEDULED, key=None):
+        command = RadioCommand(sender_id, device_id, command_code, lsb_byte, msb_byte, attempts, pauseBtwTries, \
+                               priority, key)
+        self.schedule(command, time.time())
+        return command.future
+
+    # Queue a broadcast to all devices in device_ids, the future's result is a BroadcastResult
+    def broadcast(self, command_code, lsb_byte, msb_byte, device_ids, sender_id=1, priority=PRIORITY_BACKGROUND):
+        command = BroadcastCommand(sender_id, command_code, lsb_byte, msb_byte, device_ids, priority)
+        self.schedule(command, time.time())
+        return command.future
+
+    # Queue a digital read (see DigitalReadCommand), the values are given by
+    # future.command.values(future.response)
+    def readPins(self, device_id, pin_id=READ_ALL_PINS, sender_id=1, attempts=None, priority=PRIORITY_BACKGROUND):
+        command = DigitalReadCommand(sender_id, device_id, pin_id, attempts, priority)
+        self.schedule(command, time.time())
+        return command.future
+
+    # Queue a pulse of a digital pin timed by the edge device (see PulseCommand), width in sec
+    def pulse(self, device_id, pin_id, width, sender_id=1, attempts=None, priority=PRIORITY_SCHEDULED, key=None):
+        command = PulseCommand(sender_id, device_id, pin_id, width, attempts, priority, key)
+        self.schedule(command, time.time())
+        return command.future
+
+    # Queue an analog read or Vcc measurement (see MeasureCommand), the value is given by
+    # future.command.value(future.response)
+    def measure(self, device_id, command_code, pin_id=0, sender_id=1, attempts=None, priority=PRIORITY_BACKGROUND):
+        command = MeasureCommand(sender_id, device_id, command_code, pin_id, attempts, priority)
+        self.schedule(command, time.time())
+        return command.future
+
+    # Run fn() in the transceiver thread before its next exchange, e.g. to reprogram reading
+    # pipes or change links without racing an exchange. Returns an Event set once fn ran
+    def call(self, fn):
+        done = threading.Event()
+        with self.condition:
+            self.calls.append((fn, done))
+            self.condition.notifyAll()
+        return done
+
+    def runCalls(self):
+        with self.condition:
+            calls, self.calls = self.calls, []
+        for fn, done in calls:
+            try:
+                fn()
+            except Exception as e:
+                dbgPrint("Radio call failed: %s" % e)
+            done.set()
+
+    # Wait until no command is queued or being tried and the last exchange ended at least
+    # 'quiet' seconds ago. Returns False if timeout (sec) expired first or the thread stopped.
+    # Background traffic waits for this, so it only takes airtime nobody else needs
+    def waitIdle(self, quiet=0, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.running:
+                now = time.time()
+                delay = None
+                if not (self.commands or self.busy):
+                    delay = self.lastExchange + quiet - now
+                    if delay <= 0:
+                        return True
+                if deadline is not None:
+                    if deadline <= now:
+                        return False
+                    delay = deadline - now if delay is None else min(delay, deadline - now)
+                self.condition.wait(delay)
+            return False
+
+    def schedule(self, command, readyAt):
+        with self.condition:
+            self.sequence += 1
+            if command.future.sequence is None:
+                command.future.sequence = self.sequence
+                command.future.submittedAt = time.time()
+            if command.key is not None and not self.coalesce(command):
+                return
+            heapq.heappush(self.commands, (readyAt, self.sequence, command))
+            # Callers of waitIdle wait on the condition too
+            self.condition.notifyAll()
+
+    # Keep only the newest of the commands with command's key which are waiting in the heap.
+    # Returns False if command itself is superseded, e.g. a retry of a command which got 
+    # a newer one queued while it was being tried. Called with condition held
+    def coalesce(self, command):
+        other = self.pending.get(command.key)
+        if other is not None and other is not command:
+            if other.future.sequence > command.future.sequence:
+                self.supersede(command, other)
+                return False
+            self.supersede(other, command)
+        self.pending[command.key] = command
+        return True
+
+    def supersede(self, old, new):
+        old.superseded = True
+        new.priority = min(new.priority, old.priority)
+        self.coalesced += 1
+        new.future.addDoneCallback(lambda future: old.future.setResult(future.response, future.attempts))
+
+    # Wait until some commands are due for their next try and return them, [] when stopped
+    # or functions were queued by call.
+    # Due commands for up to len(READING_PIPES) different devices are returned together,
+    # so they can be pipelined
+    def nextCommands(self):
+        with self.condition:
+            while self.running:
+                if self.calls:
+                    return []
+                if self.commands:
+                    delay = self.commands[0][0] - time.time()
+                    if delay <= 0:
+                        # All due commands may have been superseded
+                        commands = self.popDueCommands()
+                        if commands:
+                            self.busy = True
+                            return commands
+                        continue
+                    self.condition.wait(delay)
+                else:
+                    self.condition.wait()
+            return []
+
+    # Due commands are taken by priority, then in order of submission. Several due commands
+    # for a device which supports frames go out together in a FrameCommand
+    def popDueCommands(self):
+        now = time.time()
+        due = []
+        while self.commands and self.commands[0][0] <= now:
+            entry = heapq.heappop(self.commands)
+            if not entry[2].superseded:
+                entry[2].prepare()
+                due.append(entry)
+        due.sort(key=lambda entry: (entry[2].priority, entry[2].future.sequence))
+        commands = {}   # receiver id -> commands
+        postponed = []
+        for entry in due:
+            command = entry[2]
+            receiver_id = command.receiver_id
+            if receiver_id in commands and FrameCommand.fits(commands[receiver_id], command):
+                commands[receiver_id].append(command)
+            # Broadcasts take the radio on their own
+            elif len(commands) >= len(READING_PIPES) or receiver_id in commands or \
+               (commands and (receiver_id == BROADCAST_ID or BROADCAST_ID in commands)):
+                postponed.append(entry)
+                continue
+            else:
+                commands[receiver_id] = [command]
+            if command.key is not None and self.pending.get(command.key) is command:
+                del self.pending[command.key]
+        for entry in postponed:
+            heapq.heappush(self.commands, entry)
+        exchanges = [group[0] if len(group) == 1 else FrameCommand(group) for group in commands.values()]
+        return sorted(exchanges, key=lambda command: command.commands[0].future.sequence \
+                      if isinstance(command, FrameCommand) else command.future.sequence)
+
+    def run(self):
+        while True:
+            commands = self.nextCommands()
+            self.runCalls()
+            if not commands:
+                if not self.running:
+                    return
+                continue
+            try:
+                if commands[0].receiver_id == BROADCAST_ID:
+                    self.tryBroadcast(commands[0])
+                elif len(commands) == 1:
+                    self.tryCommand(commands[0])
+                else:
+                    self.tryCommandsPipelined(commands)
+            except Exception as e:
+                dbgPrint("Radio exchange failed: %s" % e)
+                for command in commands:
+                    for failed in (command.commands if isinstance(command, FrameCommand) else [command]):
+                        failed.future.setResult(None, -1)
+            with self.condition:
+                self.busy = False
+                self.lastExchange = time.time()
+                self.condition.notifyAll()
+
+    # One try of a command: send it, check the response and either complete it
+    # or schedule the next try
+    def tryCommand(self, command):
+        self.startTry(command)
+        sentAt = time.time()
+        transmitPacket(command.packet())
+        response = receiveMessage(command.timeout())
+        self.completeTry(command, response, time.time() - sentAt, readRpd=True)
+
+    # One try of several commands for different devices at once
+    def tryCommandsPipelined(self, commands):
+        for command in commands:
+            self.startTry(command)
+        rtts = {}
+        responses = exchangePipelined([command.packet() for command in commands], \
+                                      max(command.timeout() for command in commands), rtts=rtts)
+        for command in commands:
+            self.completeTry(command, responses.get(command.receiver_id, -1), rtts.get(command.receiver_id))
+
+    def tryBroadcast(self, command):
+        self.startTry(command)
+        responses = broadcastMessage(command.sender_id, command.command_code, command.lsb_byte, command.msb_byte, \
+                                     command.device_ids)
+        result = BroadcastResult(command, responses)
+        print " broadcast confirmed by %s, missing %s" % (result.acked, result.missing)
+        command.future.setResult(result, 1)
+
+    def startTry(self, command):
+        if isinstance(command, FrameCommand):
+            for item in command.commands:
+                self.numberCommand(item)
+                item.attempt += 1
+            print " sending frame %s" % packetToString(command.packet())
+            return
+        self.numberCommand(command)
+        command.attempt += 1
+        print " sending msg  %s, attempt %d/%s" % (packetToString(command.packet()), command.attempt, command.attempts)
+
+    # Give a command its sequence number before its first numbered try, its retries keep it
+    def numberCommand(self, command):
+        if command.sequence is None and command.sequenced():
+            command.sequence = command.link.nextSequence()
+
+    # rtt is the round trip time of the try. A frame is one try of each of its commands.
+    # RPD reflects only the last packet received, so it's read only if readRpd is set,
+    # i.e. the reply is the only packet of the exchange
+    def completeTry(self, command, response, rtt, readRpd=False):
+        valid = command.isValidResponse(response)
+        rpd = valid and readRpd and READ_RADIO_TELEMETRY and radio.testRPD()
+        telemetry.recordTry(command.receiver_id, None if response == -1 else response, valid, rtt, rpd)
+        if valid and command.firstTry():
+            command.link.addSample(rtt - command.busyTime())
+        if isinstance(command, FrameCommand):
+            for (item, reply) in zip(command.commands, command.replies(response)):
+                self.finishTry(item, reply, item.isValidResponse(reply))
+        else:
+            self.finishTry(command, response, valid)
+        # The probe clears the device's memory of numbered commands, a numbered command
+        # still to be retried would be executed again
+        if (valid and command.link.frameVersion is None and not command.link.probing and \
+            not self.numberedPending(command.receiver_id)):
+            self.probe(command)
+
+    # Whether numbered commands for given device wait for a retry
+    def numberedPending(self, receiver_id):
+        with self.condition:
+            return any(command.receiver_id == receiver_id and command.sequence is not None and \
+                       not command.superseded for (readyAt, sequence, command) in self.commands)
+
+    # Ask a device which answers for its capabilities, when they're not known yet.
+    # The device numbers commands from 1 again after it
+    def probe(self, command):
+        link = command.link
+        probe = CapabilitiesCommand(command.sender_id, command.receiver_id)
+        def probed(future):
+            link.probing = False
+            if future.response is not None:
+                (link.frameVersion, link.features) = probe.capabilities(future.response)
+                link.sequence = 0
+        link.probing = True
+        probe.future.addDoneCallback(probed)
+        self.schedule(probe, time.time())
+
+    # Complete the command or schedule its next try
+    def finishTry(self, command, response, valid):
+        if valid:
+            print " message sent successfully"
+            telemetry.recordCommand(command.receiver_id, command.attempt, True)
+            if command.advance():
+                self.schedule(command, time.time())
+            else:
+                command.future.setResult(response, command.attempt)
+        elif command.attempt >= command.attempts:
+            print " All attempts to send message failed"
+            telemetry.recordCommand(command.receiver_id, command.attempt, False)
+            command.future.setResult(None, -1)
+        else:
+            # Wait a little, then try again
+            self.schedule(command, time.time() + command.pause())
+
+    # Stop the thread, commands still queued are failed
+    def stop(self):
+        with self.condition:
+            self.running = False
+            commands, self.commands = self.commands, []
+            self.condition.notifyAll()
+        self.thread.join()
+        for readyAt, sequence, command in commands:
+            if not command.superseded:
+                command.future.setResult(None, -1)
+
+transceiver = RadioTransceiver()
+
 # This is a testing function which repeatedly sends 0/1 to Arduino     
 def runTest(boardId): 
     print "Testing board %s" % boardId
@@ -113,9 +1111,19 @@ def runTest(boardId):
             else:
                 badTransmissions += 1;       
         print("\n\n %d/%d good transmissions, average num of attempts = %.2f" % (goodTransmissions, totalTransmissions, float(attemptCnt)/float(goodTransmissions)))
+        print(" pipe reconfigurations: %s" % getPipeStats())
+        link = getLink(int(boardId)).getInfo()
+        if link["srtt"] is not None:
+            print(" learned round trip time %.1f ms (variance %.1f ms), receive timeout %.1f ms" % \
+                  (1000 * link["srtt"], 1000 * link["rttvar"], 1000 * link["timeout"]))
+        writeStats = radio.write_stats
+        print(" radio writes: %d, failed %d, average write time %.2f ms, %.1f status polls per write" % \
+              (writeStats["writes"], writeStats["failed"], 1000 * writeStats["time"] / max(1, writeStats["writes"]), \
+               float(writeStats["polls"]) / max(1, writeStats["writes"])))
                     
     except KeyboardInterrupt:
         print("Cleaning up")
+        transceiver.stop()
         radio.end()
         GPIO.cleanup()
         exit()
@@ -127,5 +1135,6 @@ if __name__ == '__main__':
     runTest(sys.argv[1]) 
     
     print("Cleaning up communication channel")
+    transceiver.stop()
     radio.end()
     GPIO.cleanup()
@@ -0,0 +1,138 @@
+# Per edge device telemetry of the radio links: counters and latency histograms kept in
+# fixed size structures, so memory doesn't grow with uptime. Updated by the radio 
+# transceiver thread, read by the web server
+import threading, bisect
+
+# Histogram with fixed bucket upper bounds, the last bucket counts everything above them
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # Return [(upper bound, cumulative count)], last bound is "+Inf"
+    def cumulative(self):
+        result = []
+        total = 0
+        for bound, count in zip(self.bounds + ["+Inf"], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def getInfo(self):
+        return {"buckets": self.cumulative(), "sum": self.sum, "count": self.count}
+
+# Counters and histograms of one edge device
+class LinkStats:
+    ATTEMPT_BUCKETS = [1, 2, 3, 5, 10, 15]
+    LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0]
+    RETRANSMIT_BUCKETS = [0, 1, 2, 5, 10, 15]
+
+    # Counter name -> help text for the metrics page
+    COUNTERS = [("commands", "Commands completed"),
+                ("failed_commands", "Commands which failed after all attempts"),
+                ("tries", "Tries of commands, i.e. packets waiting for a reply"),
+                ("timeouts", "Tries with no reply within the receive timeout"),
+                ("invalid_replies", "Tries answered with an unexpected reply"),
+                ("packets_sent", "Packets transmitted"),
+                ("hw_retransmits", "Hardware retransmissions reported by OBSERVE_TX"),
+                ("max_rt", "Packets never acked by the radio of the edge device (MAX_RT)"),
+                ("rpd", "Replies to single commands received with power above -64dBm (RPD)")]
+
+    def __init__(self, deviceId):
+        self.deviceId = deviceId
+        self.counters = dict((name, 0) for name, text in LinkStats.COUNTERS)
+        self.attempts = Histogram(LinkStats.ATTEMPT_BUCKETS)
+        self.latency = Histogram(LinkStats.LATENCY_BUCKETS)
+        self.retransmits = Histogram(LinkStats.RETRANSMIT_BUCKETS)
+
+    def getInfo(self):
+        info = dict(self.counters)
+        info["attempts"] = self.attempts.getInfo()
+        info["latency"] = self.latency.getInfo()
+        info["retransmits"] = self.retransmits.getInfo()
+        return info
+
+class RadioStats:
+    # Histogram name -> (LinkStats attribute, help text)
+    HISTOGRAMS = [("attempts_per_command", "attempts", "Tries it took to complete a command"),
+                  ("receive_latency_seconds", "latency", "Time from sending a packet to receiving its reply"),
+                  ("hw_retransmits_per_packet", "retransmits", "Hardware retransmissions per packet sent")]
+
+    def __init__(self):
+        self.links = {}
+        self.lock = threading.Lock()
+
+    def link(self, deviceId):
+        stats = self.links.get(deviceId)
+        if stats is None:
+            stats = self.links[deviceId] = LinkStats(deviceId)
+        return stats
+
+    # A packet was transmitted, retransmits is ARC_CNT from OBSERVE_TX
+    def recordTransmit(self, deviceId, retransmits, acked):
+        with self.lock:
+            stats = self.link(deviceId)
+            stats.counters["packets_sent"] += 1
+            stats.counters["hw_retransmits"] += retransmits
+            stats.retransmits.add(retransmits)
+            if not acked:
+                stats.counters["max_rt"] += 1
+
+    # A try of a command completed. reply is None on timeout, latency is the round trip
+    # time of valid replies, rpd tells whether the reply came with a strong signal
+    def recordTry(self, deviceId, reply, valid, latency=None, rpd=False):
+        with self.lock:
+            stats = self.link(deviceId)
+            stats.counters["tries"] += 1
+            if reply is None:
+                stats.counters["timeouts"] += 1
+            elif not valid:
+                stats.counters["invalid_replies"] += 1
+            else:
+                stats.latency.add(latency)
+                if rpd:
+                    stats.counters["rpd"] += 1
+
+    def recordCommand(self, deviceId, attempts, succeeded):
+        with self.lock:
+            stats = self.link(deviceId)
+            stats.counters["commands"] += 1
+            stats.attempts.add(attempts)
+            if not succeeded:
+                stats.counters["failed_commands"] += 1
+
+    # All stats as a dictionary by device id, for the JSON view
+    def getInfo(self):
+        with self.lock:
+            return dict((deviceId, stats.getInfo()) for deviceId, stats in self.links.items())
+
+    # All stats in Prometheus text exposition format
+    def showAsPrometheus(self):
+        lines = []
+        with self.lock:
+            links = sorted(self.links.items())
+            for name, text in LinkStats.COUNTERS:
+                lines.append("# HELP radio_%s_total %s" % (name, text))
+                lines.append("# TYPE radio_%s_total counter" % name)
+                for deviceId, stats in links:
+                    lines.append('radio_%s_total{device="%s"} %d' % (name, deviceId, stats.counters[name]))
+            for name, attribute, text in RadioStats.HISTOGRAMS:
+                lines.append("# HELP radio_%s %s" % (name, text))
+                lines.append("# TYPE radio_%s histogram" % name)
+                for deviceId, stats in links:
+                    histogram = getattr(stats, attribute)
+                    for bound, count in histogram.cumulative():
+                        lines.append('radio_%s_bucket{device="%s",le="%s"} %d' % (name, deviceId, bound, count))
+                    lines.append('radio_%s_sum{device="%s"} %s' % (name, deviceId, histogram.sum))
+                    lines.append('radio_%s_count{device="%s"} %d' % (name, deviceId, histogram.count))
+        return "\n".join(lines) + "\n"
+
+# Global instance shared by radioComm and the web server
+telemetry = RadioStats()
@@ -0,0 +1,61 @@
+# Fixed size ring buffers of measured samples (analog pins, Vcc of edge devices)
+# Times and values are kept in two array.array('d') of fixed capacity, so a buffer takes
+# 16 bytes per sample no matter how long the hub runs and no Python object is kept per
+# sample. Aggregates over a time window use numpy on the arrays if it's installed.
+import array, bisect, threading
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class RingBuffer:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array.array("d", [0.0]) * capacity
+        self.values = array.array("d", [0.0]) * capacity
+        self.count = 0      # samples stored, up to capacity
+        self.next = 0       # index the next sample is written to
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def append(self, sampledAt, value):
+        with self.lock:
+            self.times[self.next] = sampledAt
+            self.values[self.next] = value
+            self.next = (self.next + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    # Copy of the samples as (times, values) arrays, oldest first
+    def ordered(self):
+        with self.lock:
+            if self.count < self.capacity:
+                return (self.times[:self.count], self.values[:self.count])
+            return (self.times[self.next:] + self.times[:self.next], self.values[self.next:] + self.values[:self.next])
+
+    # Samples taken at 'since' (time.time()) or later as a list of (time, value)
+    def samples(self, since=0):
+        (times, values) = self.ordered()
+        start = bisect.bisect_left(times, since)
+        return list(zip(times[start:], values[start:]))
+
+    # Count, min, max, mean and rate of change (per second, between the first and the last
+    # sample) of the samples taken at 'since' or later, None if there are none
+    def aggregate(self, since=0):
+        (times, values) = self.ordered()
+        start = bisect.bisect_left(times, since)
+        count = len(times) - start
+        if count <= 0:
+            return None
+        if numpy:
+            window = numpy.frombuffer(values, dtype=numpy.float64)[start:]
+            (minimum, maximum, mean) = (float(window.min()), float(window.max()), float(window.mean()))
+        else:
+            window = values[start:]
+            (minimum, maximum, mean) = (min(window), max(window), sum(window) / count)
+        rate = None
+        if (times[-1] > times[start]):
+            rate = (values[-1] - values[start]) / (times[-1] - times[start])
+        return {"count": count, "min": minimum, "max": maximum, "mean": mean, "rate": rate,
+                "last": values[-1], "lastTime": times[-1]}
@@ -0,0 +1,166 @@
+# Crash safe store of pin states and schedules of the hub
+# Every change is appended to a journal file (one JSON record per line). Records are written
+# by a background thread which commits all records queued since its last write with one
+# write and one fsync (group commit), so recording a change never waits for the disk.
+# When the journal grows long it's compacted: the current state of all pins is written
+# to a snapshot file (atomically, through a temporary file and rename) and the journal
+# starts over. On startup the snapshot is loaded and the journal replayed on top of it.
+import json, os, threading, time
+
+# Make renames and file creations in a directory durable
+def fsyncDirectory(path):
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+class StateStore:
+    # Records in the journal which trigger compaction into a new snapshot
+    COMPACT_RECORDS = 10000
+    # Longest time a record waits in memory before it's written
+    COMMIT_INTERVAL = 0.05
+
+    def __init__(self, path):
+        self.snapshotPath = path + ".snapshot"
+        self.journalPath = path + ".journal"
+        self.rows = {}          # "deviceId:pinId" -> {"state": ..., "startTime": ..., "endTime": ...}
+        self.sequence = 0       # sequence number of the last record
+        self.queue = []         # records waiting to be written
+        self.unwritten = 0      # records queued or being written
+        self.journalRecords = 0
+        self.journal = None
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+        self.stats = {"records": 0, "commits": 0, "compactions": 0, "commitTime": 0.0}
+
+    # Read snapshot and journal, return {"deviceId:pinId": row}. A record torn by a crash
+    # in the middle of a write ends the journal. Starts the writer thread
+    def load(self):
+        snapshotSequence = 0
+        if os.path.exists(self.snapshotPath):
+            with open(self.snapshotPath) as snapshotFile:
+                snapshot = json.load(snapshotFile)
+            self.rows = snapshot["pins"]
+            snapshotSequence = self.sequence = snapshot["sequence"]
+        if os.path.exists(self.journalPath):
+            with open(self.journalPath, "rb+") as journalFile:
+                valid = 0
+                for line in journalFile:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("Incomplete record")
+                        record = json.loads(line.decode("utf-8"))
+                    except ValueError:
+                        break
+                    valid += len(line)
+                    # Records already in the snapshot are left from a crash during compaction
+                    if record["seq"] <= snapshotSequence:
+                        continue
+                    self.rows.setdefault(record["pin"], {}).update(record["row"])
+                    self.sequence = record["seq"]
+                    self.journalRecords += 1
+                # Cut off a torn record, so new records don't end up behind it
+                journalFile.seek(0, os.SEEK_END)
+                if valid < journalFile.tell():
+                    journalFile.truncate(valid)
+        self.journal = open(self.journalPath, "ab")
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="StateStore")
+        self.thread.daemon = True
+        self.thread.start()
+        return dict((key, dict(row)) for key, row in self.rows.items())
+
+    @staticmethod
+    def key(deviceId, pinId):
+        return "%d:%d" % (deviceId, pinId)
+
+    # Latest row of a pin (including changes not written yet) or None
+    def get(self, deviceId, pinId):
+        with self.condition:
+            row = self.rows.get(self.key(deviceId, pinId))
+            return None if row is None else dict(row)
+
+    # Queue a change of a pin, row is a dictionary with any of state, startTime, endTime.
+    # Values which are stored already aren't written again
+    def record(self, deviceId, pinId, row):
+        key = self.key(deviceId, pinId)
+        with self.condition:
+            current = self.rows.setdefault(key, {})
+            row = dict((name, value) for name, value in row.items() if current.get(name, None) != value)
+            if not row:
+                return
+            current.update(row)
+            self.queue.append((key, row))
+            self.unwritten += 1
+            if len(self.queue) == 1:
+                self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.queue:
+                    self.condition.wait()
+                if not self.queue and not self.running:
+                    return
+            # Give records arriving in a burst a chance to share the commit
+            time.sleep(self.COMMIT_INTERVAL)
+            with self.condition:
+                batch, self.queue = self.queue, []
+            self.commit(batch)
+            if self.journalRecords >= self.COMPACT_RECORDS:
+                self.compact()
+            with self.condition:
+                self.unwritten -= len(batch)
+                self.condition.notifyAll()
+
+    def commit(self, batch):
+        start = time.time()
+        lines = []
+        for (key, row) in batch:
+            self.sequence += 1
+            lines.append(json.dumps({"seq": self.sequence, "pin": key, "row": row}, sort_keys=True) + "\n")
+        self.journal.write("".join(lines).encode("utf-8"))
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.journalRecords += len(batch)
+        self.stats["records"] += len(batch)
+        self.stats["commits"] += 1
+        self.stats["commitTime"] += time.time() - start
+
+    # Write all rows to a new snapshot and start an empty journal. Rows may already hold
+    # changes which are still queued, they are written to the new journal later
+    def compact(self):
+        with self.condition:
+            rows = dict((key, dict(row)) for key, row in self.rows.items())
+        temporaryPath = self.snapshotPath + ".tmp"
+        with open(temporaryPath, "w") as snapshotFile:
+            json.dump({"sequence": self.sequence, "pins": rows}, snapshotFile, sort_keys=True)
+            snapshotFile.flush()
+            os.fsync(snapshotFile.fileno())
+        os.rename(temporaryPath, self.snapshotPath)
+        # The rename is durable only once the directory is synced, the old journal must
+        # not be emptied before that
+        fsyncDirectory(os.path.dirname(os.path.abspath(self.snapshotPath)))
+        self.journal.close()
+        self.journal = open(self.journalPath, "wb")
+        self.journalRecords = 0
+        self.stats["compactions"] += 1
+
+    # Wait until all records queued so far are on disk
+    def flush(self):
+        with self.condition:
+            while self.unwritten and self.thread:
+                self.condition.wait(1)
+
+    # Write what's queued and stop the writer thread
+    def close(self):
+        if self.thread is None:
+            return
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+        self.journal.close()
+        self.thread = None
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# Benchmark of stateStore.StateStore: cost of recording a change on the caller's thread,
+# records per group commit, and recovery time (snapshot load + journal replay) of a store
+# with thousands of pins. Also checks that a record torn by a crash is dropped on recovery.
+# Usage: python stateStoreBench.py [number_of_pins] [journal_records]
+import os
+import shutil
+import sys
+import tempfile
+import time
+from stateStore import StateStore
+
+PINS_PER_DEVICE = 8
+
+
+def pinAddress(index):
+    return (1 + index // PINS_PER_DEVICE, index % PINS_PER_DEVICE)
+
+
+# Record changes of all pins round robin until 'records' are queued, return usec per record
+def recordChanges(store, pins, records):
+    start = time.time()
+    for number in range(records):
+        (deviceId, pinId) = pinAddress(number % pins)
+        store.record(deviceId, pinId, {"state": number // pins % 2})
+    elapsed = time.time() - start
+    store.flush()
+    return 1e6 * elapsed / records
+
+
+# Time recovery of the store at path, return (seconds, pins loaded)
+def recover(path):
+    store = StateStore(path)
+    start = time.time()
+    rows = store.load()
+    elapsed = time.time() - start
+    store.close()
+    return (elapsed, len(rows))
+
+
+def runScenario(directory, name, pins, records, compactRecords):
+    path = os.path.join(directory, name)
+    store = StateStore(path)
+    store.COMPACT_RECORDS = compactRecords
+    store.load()
+    for index in range(pins):
+        (deviceId, pinId) = pinAddress(index)
+        store.record(deviceId, pinId, {"state": 0, "startTime": "21:30", "endTime": "22:00"})
+    usecPerRecord = recordChanges(store, pins, records)
+    store.close()
+    stats = store.stats
+    (recoveryTime, loaded) = recover(path)
+    return {"name": name, "usec_per_record": usecPerRecord, "commits": stats["commits"],
+            "records_per_commit": float(stats["records"]) / max(1, stats["commits"]),
+            "compactions": stats["compactions"], "journal_bytes": os.path.getsize(path + ".journal"),
+            "recovery_ms": 1000 * recoveryTime, "pins": loaded}
+
+
+# Cut the last record of a journal in half and check that recovery drops just that record
+def checkTornRecord(directory):
+    path = os.path.join(directory, "torn")
+    store = StateStore(path)
+    store.load()
+    store.record(1, 0, {"state": 1})
+    store.record(1, 1, {"state": 1})
+    store.close()
+    with open(path + ".journal", "rb+") as journal:
+        size = os.path.getsize(path + ".journal")
+        journal.truncate(size - 10)
+    store = StateStore(path)
+    store.load()
+    store.record(1, 1, {"state": 0})
+    store.close()
+    store = StateStore(path)
+    rows = store.load()
+    store.close()
+    return rows.get("1:0") == {"state": 1} and rows.get("1:1") == {"state": 0}
+
+
+if __name__ == '__main__':
+    pins = 5000
+    records = 200000
+    if len(sys.argv) > 1:
+        pins = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        records = int(sys.argv[2])
+
+    directory = tempfile.mkdtemp(prefix="stateStoreBench")
+    try:
+        print("%d pins, %d changes" % (pins, records))
+        print("%-20s %10s %8s %12s %11s %13s %12s" % ("scenario", "us/record", "commits", "records/commit",
+              "compactions", "journal bytes", "recovery ms"))
+        # Default compaction, and none at all (the whole history is replayed on recovery)
+        for (name, compactRecords) in [("compacted", StateStore.COMPACT_RECORDS), ("journal only", records + pins + 1)]:
+            result = runScenario(directory, name.replace(" ", "_"), pins, records, compactRecords)
+            result["name"] = name
+            print("%-20s %10.2f %8d %12.1f %11d %13d %12.1f" % (result["name"], result["usec_per_record"],
+                  result["commits"], result["records_per_commit"], result["compactions"], result["journal_bytes"],
+                  result["recovery_ms"]))
+            if result["pins"] != pins:
+                print("  recovered %d pins instead of %d" % (result["pins"], pins))
+        print("\nTorn last record dropped on recovery: %s" % ("ok" if checkTornRecord(directory) else "FAILED"))
+    finally:
+        shutil.rmtree(directory)